@@ -0,0 +1,84 @@
+"""Compare detection throughput and recall at different detection widths.
+
+Recall is measured against the faces found at full resolution on the same
+frames, a face counts as found when a box overlaps it with IoU >= 0.5.
+
+    python benchmarks/detection_scale.py clip1.mp4 clip2.mp4 --widths 0 1280 960 640
+"""
+import argparse
+import os
+import sys
+import time
+
+import cv2
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from stream_processing_server import detect_faces  # noqa: E402
+from tracker import iou  # noqa: E402
+
+
+def load_frames(paths, frames_per_source, stride):
+    frames = []
+    for path in paths:
+        image = cv2.imread(path)
+        if image is not None:
+            frames.append(image)
+            continue
+        cap = cv2.VideoCapture(path)
+        index = taken = 0
+        while taken < frames_per_source:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            if index % stride == 0:
+                frames.append(frame)
+                taken += 1
+            index += 1
+        cap.release()
+    return frames
+
+
+def matched(reference, boxes, threshold=0.5):
+    return sum(1 for ref in reference if any(iou(ref, box) >= threshold for box in boxes))
+
+
+def run(frames, width, repeat):
+    results = []
+    start = time.perf_counter()
+    for _ in range(repeat):
+        results = [detect_faces(frame, width) for frame in frames]
+    elapsed = time.perf_counter() - start
+    return results, elapsed / (repeat * len(frames))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('sources', nargs='+', help="video files or images")
+    parser.add_argument('--widths', type=int, nargs='+', default=[0, 1280, 960, 640, 480],
+                        help="detection widths to compare, 0 is full resolution")
+    parser.add_argument('--frames', type=int, default=50, help="frames taken from each video")
+    parser.add_argument('--stride', type=int, default=25, help="take every Nth frame of a video")
+    parser.add_argument('--repeat', type=int, default=1, help="passes over the frames per width")
+    args = parser.parse_args()
+
+    cv2.setNumThreads(1)
+    frames = load_frames(args.sources, args.frames, args.stride)
+    if not frames:
+        sys.exit("No frames could be read from the given sources")
+    print(f"{len(frames)} frames, {frames[0].shape[1]}x{frames[0].shape[0]}")
+
+    reference, _ = run(frames, 0, 1)
+    total_reference = sum(len(boxes) for boxes in reference)
+
+    print(f"{'width':>6} {'ms/frame':>9} {'frames/s':>9} {'faces':>6} {'recall':>7}")
+    for width in args.widths:
+        results, per_frame = run(frames, width, args.repeat)
+        found = sum(matched(ref, boxes) for ref, boxes in zip(reference, results))
+        recall = found / total_reference if total_reference else float('nan')
+        faces = sum(len(boxes) for boxes in results)
+        label = width or 'full'
+        print(f"{label:>6} {per_frame * 1000:9.1f} {1 / per_frame:9.1f} {faces:6d} {recall:7.2%}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+"""Compare the Haar cascade with the batched cv2.dnn SSD detector on the same frames.
+
+Reports frames/s and faces/s per detector, and the SSD at several batch
+sizes. With `--annotations`, detections are scored against hand-labelled
+faces (IoU >= 0.5) to count true and false positives. Without annotations
+each detector's boxes are checked against the other's: boxes only one
+detector finds are listed as unconfirmed, a rough stand-in for false
+positives that is worth eyeballing with `--dump`.
+
+    python benchmarks/detector_compare.py clip1.mp4 clip2.mp4 --batch 1 4 8
+    python benchmarks/detector_compare.py clip1.mp4 --annotations faces.json
+
+The annotations file maps a source path to `{frame_index: [[x, y, w, h], ...]}`,
+where frame_index is the frame number within that video (0 for an image).
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import cv2
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from detectors import SSD_CONFIG, SSD_WEIGHTS, HaarDetector, SSDDetector  # noqa: E402
+from tracker import iou  # noqa: E402
+
+
+def load_frames(paths, frames_per_source, stride):
+    """Return `(source, frame_index, frame)` for the sampled frames of every source."""
+    frames = []
+    for path in paths:
+        image = cv2.imread(path)
+        if image is not None:
+            frames.append((path, 0, image))
+            continue
+        cap = cv2.VideoCapture(path)
+        index = taken = 0
+        while taken < frames_per_source:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            if index % stride == 0:
+                frames.append((path, index, frame))
+                taken += 1
+            index += 1
+        cap.release()
+    return frames
+
+
+def matched(reference, boxes, threshold=0.5):
+    """Count the `boxes` that overlap some box of `reference`."""
+    return sum(1 for box in boxes if any(iou(ref, box) >= threshold for ref in reference))
+
+
+def run_haar(detector, frames, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        results = [detector.detect(frame) for frame in frames]
+    return results, (time.perf_counter() - start) / repeat
+
+
+def run_ssd(detector, frames, batch_size, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        results = []
+        for offset in range(0, len(frames), batch_size):
+            results.extend(detector.detect_batch(frames[offset:offset + batch_size]))
+    return results, (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('sources', nargs='+', help="video files or images")
+    parser.add_argument('--frames', type=int, default=50, help="frames taken from each video")
+    parser.add_argument('--stride', type=int, default=25, help="take every Nth frame of a video")
+    parser.add_argument('--repeat', type=int, default=1, help="passes over the frames per configuration")
+    parser.add_argument('--batch', type=int, nargs='+', default=[1, 4, 8], help="SSD batch sizes to compare")
+    parser.add_argument('--ssd-config', default=SSD_CONFIG)
+    parser.add_argument('--ssd-weights', default=SSD_WEIGHTS)
+    parser.add_argument('--ssd-confidence', type=float, default=0.6)
+    parser.add_argument('--annotations', help="JSON file with the true face boxes, see above")
+    parser.add_argument('--dump', help="directory to write frames with unconfirmed boxes drawn in")
+    args = parser.parse_args()
+
+    sampled = load_frames(args.sources, args.frames, args.stride)
+    if not sampled:
+        sys.exit("No frames could be read from the given sources")
+    frames = [frame for _, _, frame in sampled]
+    print(f"{len(frames)} frames, {frames[0].shape[1]}x{frames[0].shape[0]}")
+
+    haar = HaarDetector()
+    ssd = SSDDetector(args.ssd_config, args.ssd_weights, confidence=args.ssd_confidence)
+
+    runs = [('haar', *run_haar(haar, frames, args.repeat))]
+    for batch_size in args.batch:
+        runs.append((f'ssd x{batch_size}', *run_ssd(ssd, frames, batch_size, args.repeat)))
+
+    print(f"{'detector':>10} {'frames/s':>9} {'faces':>6} {'faces/s':>8}")
+    for label, results, elapsed in runs:
+        faces = sum(len(boxes) for boxes in results)
+        print(f"{label:>10} {len(frames) / elapsed:9.1f} {faces:6d} {faces / elapsed:8.1f}")
+
+    haar_results = runs[0][1]
+    ssd_results = runs[1][1]
+    if args.annotations:
+        with open(args.annotations) as f:
+            annotations = json.load(f)
+        print(f"\n{'detector':>10} {'true pos':>9} {'false pos':>10} {'missed':>7} {'precision':>10}")
+        for label, results in (('haar', haar_results), ('ssd', ssd_results)):
+            true_pos = false_pos = missed = 0
+            for (source, index, _), boxes in zip(sampled, results):
+                truth = annotations.get(source, {}).get(str(index))
+                if truth is None:
+                    continue
+                hits = matched(truth, boxes)
+                true_pos += hits
+                false_pos += len(boxes) - hits
+                missed += max(0, len(truth) - matched(boxes, truth))
+            precision = true_pos / (true_pos + false_pos) if true_pos + false_pos else float('nan')
+            print(f"{label:>10} {true_pos:9d} {false_pos:10d} {missed:7d} {precision:10.2%}")
+        return
+
+    haar_only = sum(len(h) - matched(s, h) for h, s in zip(haar_results, ssd_results))
+    ssd_only = sum(len(s) - matched(h, s) for h, s in zip(haar_results, ssd_results))
+    print(f"\nBoxes only Haar found: {haar_only}, only SSD found: {ssd_only} (unconfirmed, likely false positives)")
+    if args.dump:
+        os.makedirs(args.dump, exist_ok=True)
+        for number, ((source, index, frame), h, s) in enumerate(zip(sampled, haar_results, ssd_results)):
+            unconfirmed = [(box, (0, 0, 255)) for box in h if not matched(s, [box])]
+            unconfirmed += [(box, (255, 0, 0)) for box in s if not matched(h, [box])]
+            if not unconfirmed:
+                continue
+            canvas = frame.copy()
+            for (x, y, w, h_), color in unconfirmed:
+                cv2.rectangle(canvas, (int(x), int(y)), (int(x + w), int(y + h_)), color, 2)
+            name = f"{number:04d}_{os.path.basename(source)}_{index}.jpg"
+            cv2.imwrite(os.path.join(args.dump, name), canvas)
+        print(f"Frames with unconfirmed boxes written to {args.dump} (red: Haar only, blue: SSD only)")
+
+
+if __name__ == '__main__':
+    main()
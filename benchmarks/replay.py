@@ -0,0 +1,311 @@
+"""Replay local clips or synthetic frames through the real server pipeline.
+
+N simulated cameras run process_stream -> detection -> send_detection_results
+exactly as in production, but read from local sources paced at their native
+frame rate and upload to a local stub instead of the Cloud Run endpoint.
+
+    python benchmarks/replay.py --cameras 20 --source clip1.mp4 --source clip2.mp4
+    python benchmarks/replay.py --cameras 40 --source synthetic:1920x1080@25 --baseline old.json
+
+Sources are assigned to cameras round robin. `synthetic:WxH@FPS` renders a
+static scene with a moving object, add `:face.jpg` to paste a face image
+into it so the upload path is exercised too.
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import cv2
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import capture  # noqa: E402
+import metrics  # noqa: E402
+import stream_processing_server as server  # noqa: E402
+from detection import DetectionEngine  # noqa: E402
+from preview import PreviewCache  # noqa: E402
+from tracing import Tracer  # noqa: E402
+from registry import StreamRegistry  # noqa: E402
+from scheduler import SamplingScheduler  # noqa: E402
+from uploader import Uploader  # noqa: E402
+
+
+class PacedCapture:
+    """Hands out frames no faster than `fps`, like a live camera would."""
+
+    def __init__(self, fps):
+        self.interval = 1.0 / fps
+        self._next = time.monotonic()
+
+    def _wait(self):
+        now = time.monotonic()
+        if self._next > now:
+            time.sleep(self._next - now)
+        elif now - self._next > 1.0:
+            # Fell far behind, do not try to catch up with a burst
+            self._next = now
+        self._next += self.interval
+
+
+class ReplayCapture(PacedCapture):
+    """Loops a local video file at its native frame rate."""
+
+    def __init__(self, path):
+        self.cap = cv2.VideoCapture(path)
+        super().__init__(self.cap.get(cv2.CAP_PROP_FPS) or 25.0)
+
+    def isOpened(self):
+        return self.cap.isOpened()
+
+    def grab(self):
+        self._wait()
+        if self.cap.grab():
+            return True
+        self.cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+        return self.cap.grab()
+
+    def retrieve(self):
+        return self.cap.retrieve()
+
+    def release(self):
+        self.cap.release()
+
+
+class SyntheticCapture(PacedCapture):
+    """Renders `WxH@FPS[:face.jpg]`: a fixed background with one moving patch."""
+
+    def __init__(self, spec):
+        size, _, rest = spec.partition('@')
+        fps, _, face_path = rest.partition(':')
+        width, height = (int(v) for v in size.split('x'))
+        super().__init__(float(fps or 25))
+
+        rng = np.random.default_rng(0)
+        gradient = np.linspace(40, 200, width, dtype=np.uint8)
+        self.background = np.repeat(np.tile(gradient, (height, 1))[:, :, None], 3, axis=2)
+        self.background = cv2.add(self.background, rng.integers(0, 20, self.background.shape, dtype=np.uint8))
+        patch_size = max(16, height // 6)
+        if face_path:
+            self.patch = cv2.resize(cv2.imread(face_path), (patch_size, patch_size))
+        else:
+            self.patch = np.full((patch_size, patch_size, 3), 30, dtype=np.uint8)
+        self.frame_index = 0
+
+    def isOpened(self):
+        return True
+
+    def grab(self):
+        self._wait()
+        self.frame_index += 1
+        return True
+
+    def retrieve(self):
+        frame = self.background.copy()
+        height, width = frame.shape[:2]
+        size = self.patch.shape[0]
+        x = (self.frame_index * 4) % (width - size)
+        y = (height - size) // 2
+        frame[y:y+size, x:x+size] = self.patch
+        return True, frame
+
+    def release(self):
+        pass
+
+
+def open_source(url, open_timeout=None, read_timeout=None):
+    if url.startswith('synthetic:'):
+        return SyntheticCapture(url[len('synthetic:'):])
+    return ReplayCapture(url)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    delay = 0.0
+    requests_received = 0
+    lock = threading.Lock()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.delay:
+            time.sleep(self.delay)
+        with StubHandler.lock:
+            StubHandler.requests_received += 1
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def rss_bytes():
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def counter_total(counter):
+    return sum(value for _, _, value in counter.samples())
+
+
+def percentiles(samples):
+    if not samples:
+        return None
+    p50, p95, p99 = np.percentile(samples, [50, 95, 99])
+    return {"p50_ms": round(p50 * 1000, 1), "p95_ms": round(p95 * 1000, 1), "p99_ms": round(p99 * 1000, 1),
+            "samples": len(samples)}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(result, baseline):
+    print(f"\nCompared with {baseline.get('timestamp')} ({baseline.get('commit')}):")
+    for key in ("frames_analyzed_per_s", "cpu_percent_per_camera", "peak_rss_mb"):
+        old, new = baseline["results"].get(key), result["results"].get(key)
+        if old:
+            print(f"  {key:<24} {old:>10} -> {new:>10} ({(new - old) / old:+.1%})")
+    for stage in ("detection_latency", "upload_latency"):
+        old, new = baseline["results"].get(stage), result["results"].get(stage)
+        if old and new:
+            print(f"  {stage + ' p95':<24} {old['p95_ms']:>10} -> {new['p95_ms']:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--cameras', type=int, default=10, help="number of simulated cameras")
+    parser.add_argument('--source', action='append', default=[],
+                        help="video file or synthetic:WxH@FPS[:face.jpg], may be repeated")
+    parser.add_argument('--duration', type=float, default=60.0, help="measured seconds")
+    parser.add_argument('--warmup', type=float, default=5.0, help="seconds to run before measuring")
+    parser.add_argument('--sample-fps', type=float, default=server.DEFAULT_SAMPLE_FPS)
+    parser.add_argument('--min-sample-fps', type=float, help="let the scheduler vary rates from this")
+    parser.add_argument('--max-sample-fps', type=float, help="let the scheduler vary rates up to this")
+    parser.add_argument('--sample-budget-fps', type=float, default=0, help="frames/s budget over all cameras")
+    parser.add_argument('--motion-threshold', type=float, default=server.DEFAULT_MOTION_THRESHOLD)
+    parser.add_argument('--detection-width', type=int, default=server.DEFAULT_DETECTION_WIDTH)
+    parser.add_argument('--roi', help="regions every camera looks for faces in, as JSON (see roi.parse_roi)")
+    parser.add_argument('--detection-workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--queue-depth', type=int, default=2)
+    parser.add_argument('--upload-workers', type=int, default=4)
+    parser.add_argument('--batch-uploads', action='store_true')
+    parser.add_argument('--stub-delay', type=float, default=0.0, help="seconds the stub upstream takes per request")
+    parser.add_argument('--trace-sample-rate', type=float, default=0, help="fraction of frames to trace")
+    parser.add_argument('--trace-output', help="write the traced spans of the run here as Chrome trace JSON")
+    parser.add_argument('--output', help="where to write the JSON results "
+                                         "(default: benchmarks/results/replay-<timestamp>.json)")
+    parser.add_argument('--baseline', help="earlier results file to compare against")
+    args = parser.parse_args()
+    sources = args.source or ['synthetic:1920x1080@25']
+
+    StubHandler.delay = args.stub_delay
+    stub = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+
+    detection_latencies = []
+    upload_latencies = []
+
+    def analyze(job):
+        server.analyze_frame(job)
+        detection_latencies.append(time.monotonic() - job.captured_at)
+
+    def upload_done(job):
+        upload_latencies.append(time.monotonic() - job.captured_at)
+
+    capture.CAPTURE_BACKENDS['replay'] = open_source
+    if args.detection_workers > 1:
+        cv2.setNumThreads(1)
+    server.detection_engine = DetectionEngine(analyze, workers=args.detection_workers, queue_depth=args.queue_depth)
+    server.detection_engine.start()
+    server.uploader = Uploader(f'http://127.0.0.1:{stub.server_port}', workers=args.upload_workers,
+                               batch=args.batch_uploads, on_done=upload_done)
+    server.uploader.start()
+    server.preview_cache = PreviewCache()
+    server.tracer = Tracer(args.trace_sample_rate)
+    server.stream_registry = StreamRegistry(server.process_stream, server.StreamContext)
+    server.sampling_scheduler = SamplingScheduler(server.stream_registry.streams, budget_fps=args.sample_budget_fps)
+    server.sampling_scheduler.start()
+
+    for index in range(args.cameras):
+        options = server.camera_options({
+            "sample_fps": args.sample_fps,
+            "min_sample_fps": args.min_sample_fps or args.sample_fps,
+            "max_sample_fps": args.max_sample_fps or args.sample_fps,
+            "motion_threshold": args.motion_threshold,
+            "detection_width": args.detection_width,
+            "capture_backend": 'replay',
+            "roi": args.roi,
+        })
+        server.stream_registry.start(sources[index % len(sources)], f'bench-{index}', 'benchmark', options)
+
+    time.sleep(args.warmup)
+    detection_latencies.clear()
+    upload_latencies.clear()
+    analyzed_before = counter_total(metrics.FRAMES_ANALYZED) + counter_total(metrics.FRAMES_SKIPPED)
+    grabbed_before = counter_total(metrics.FRAMES_GRABBED)
+    requests_before = StubHandler.requests_received
+    cpu_before = time.process_time()
+    wall_before = time.monotonic()
+    rss_samples = []
+    while time.monotonic() - wall_before < args.duration:
+        time.sleep(min(1.0, args.duration))
+        rss_samples.append(rss_bytes())
+    wall = time.monotonic() - wall_before
+    cpu = time.process_time() - cpu_before
+    analyzed = counter_total(metrics.FRAMES_ANALYZED) + counter_total(metrics.FRAMES_SKIPPED) - analyzed_before
+    grabbed = counter_total(metrics.FRAMES_GRABBED) - grabbed_before
+    dropped = sum(counters["dropped"] for counters in server.detection_engine.stats().values())
+
+    server.stream_registry.stop_all()
+    server.sampling_scheduler.stop()
+    server.detection_engine.stop()
+    server.uploader.stop()
+    stub.shutdown()
+
+    result = {
+        "timestamp": datetime.now().isoformat(timespec='seconds'),
+        "commit": git_commit(),
+        "config": dict(vars(args), source=sources),
+        "results": {
+            "frames_grabbed_per_s": round(grabbed / wall, 1),
+            "frames_analyzed_per_s": round(analyzed / wall, 2),
+            "frames_dropped": dropped,
+            "uploads_per_s": round((StubHandler.requests_received - requests_before) / wall, 2),
+            "cpu_percent_per_camera": round(cpu / wall / args.cameras * 100, 2),
+            "detection_latency": percentiles(detection_latencies),
+            "upload_latency": percentiles(upload_latencies),
+            "rss_mb": round(rss_samples[-1] / 2**20, 1),
+            "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        },
+    }
+    print(json.dumps(result["results"], indent=2))
+
+    output = args.output or os.path.join(ROOT, 'benchmarks', 'results',
+                                         f"replay-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(result, f, indent=2)
+    print(f"Results written to {output}")
+    if args.trace_output:
+        with open(args.trace_output, 'w') as f:
+            json.dump({"traceEvents": server.tracer.export(), "displayTimeUnit": "ms"}, f)
+        print(f"Trace written to {args.trace_output}, open it in https://ui.perfetto.dev")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(result, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
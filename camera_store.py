@@ -0,0 +1,186 @@
+import csv
+import json
+import logging
+import sqlite3
+
+logger = logging.getLogger(__name__)
+
+CAMERA_FIELDS = ('rtsp_url', 'device_id', 'event_id')
+# Profile settings the GUIs offer for editing: key, label and how to read the text
+PROFILE_ENTRIES = (
+    ('sample_fps', "Sample FPS", float),
+    ('detection_width', "Detection Width", int),
+    ('jpeg_quality', "JPEG Quality", int),
+    ('detector_params', "Detector Params", json.loads),
+)
+
+
+def init_cameras_table(conn):
+    """Create the cameras table, one row per device_id.
+
+    Older databases may hold a device more than once. Its latest row is
+    kept, the others are logged in full and removed, and their device_ids
+    are returned so the GUIs can say which cameras were merged.
+    """
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS cameras (
+            id INTEGER PRIMARY KEY,
+            rtsp_url TEXT NOT NULL,
+            device_id TEXT NOT NULL,
+            event_id TEXT NOT NULL
+        )
+    ''')
+    columns = {row[1] for row in conn.execute('PRAGMA table_info(cameras)')}
+    # Both JSON: regions of interest (see roi.parse_roi, empty scans the whole frame)
+    # and the camera's detection profile (see stream_processing_server.PROFILE_FIELDS)
+    for column in ('roi', 'profile'):
+        if column not in columns:
+            conn.execute(f'ALTER TABLE cameras ADD COLUMN {column} TEXT')
+    duplicates = conn.execute('SELECT id, rtsp_url, device_id, event_id, roi, profile FROM cameras '
+                              'WHERE id NOT IN (SELECT MAX(id) FROM cameras GROUP BY device_id) ORDER BY id').fetchall()
+    if duplicates:
+        logger.warning("Removing %d older rows of cameras saved more than once", len(duplicates))
+        for row in duplicates:
+            logger.warning("Removed camera row id=%s rtsp_url=%s device_id=%s event_id=%s roi=%s profile=%s", *row)
+        conn.executemany('DELETE FROM cameras WHERE id = ?', [(row[0],) for row in duplicates])
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS cameras_device_id ON cameras (device_id)')
+    conn.commit()
+    return sorted({row[2] for row in duplicates})
+
+
+def save_cameras(conn, cameras):
+    """Insert or update cameras by device_id, all in one transaction.
+
+    A camera without a `roi` or `profile` key keeps the one it already has.
+    """
+    with conn:
+        conn.executemany(
+            'INSERT INTO cameras (rtsp_url, device_id, event_id, roi, profile) VALUES (?, ?, ?, ?, ?) '
+            'ON CONFLICT (device_id) DO UPDATE SET rtsp_url = excluded.rtsp_url, event_id = excluded.event_id, '
+            'roi = COALESCE(excluded.roi, roi), profile = COALESCE(excluded.profile, profile)',
+            [(camera['rtsp_url'], camera['device_id'], camera['event_id'], json_text(camera.get('roi')),
+              json_text(camera.get('profile'))) for camera in cameras])
+
+
+def json_text(value):
+    # Stored as JSON text, '' clears the value
+    if value is None or isinstance(value, str):
+        return value
+    return json.dumps(value)
+
+
+def fetch_roi(conn, device_id):
+    row = conn.execute('SELECT roi FROM cameras WHERE device_id = ?', (device_id,)).fetchone()
+    return row[0] if row else None
+
+
+def fetch_profile(conn, device_id):
+    """The camera's stored profile as a dict, empty if it has none."""
+    row = conn.execute('SELECT profile FROM cameras WHERE device_id = ?', (device_id,)).fetchone()
+    return json.loads(row[0]) if row and row[0] else {}
+
+
+def save_profile(conn, device_id, profile):
+    """Store a camera's profile, returns False if the camera is not in the table."""
+    with conn:
+        cursor = conn.execute('UPDATE cameras SET profile = ? WHERE device_id = ?',
+                              (json_text(profile), device_id))
+    return cursor.rowcount > 0
+
+
+def validate_cameras(items):
+    """Check a list of camera dicts and drop repeated device_ids, the last entry of a device wins.
+
+    Returns `(cameras, errors, duplicates)`: `(index, camera)` pairs of the
+    valid entries, `{"index", "device_id", "message"}` dicts for the bad
+    ones, and the device_ids that appeared more than once.
+    """
+    valid = {}
+    errors = []
+    duplicates = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            errors.append({"index": index, "device_id": None, "message": "Expected an object"})
+            continue
+        camera = dict(item)
+        missing = [field for field in CAMERA_FIELDS if not str(camera.get(field) or '').strip()]
+        if missing:
+            errors.append({"index": index, "device_id": camera.get('device_id'),
+                           "message": f"Missing {', '.join(missing)}"})
+            continue
+        for field in CAMERA_FIELDS:
+            camera[field] = str(camera[field]).strip()
+        if camera['device_id'] in valid:
+            duplicates.append(camera['device_id'])
+            del valid[camera['device_id']]
+        valid[camera['device_id']] = (index, camera)
+    return list(valid.values()), errors, duplicates
+
+
+def profile_entry_texts(profile):
+    """The text each profile entry of the GUIs starts with, `{key: text}`."""
+    texts = {}
+    for key, _, _ in PROFILE_ENTRIES:
+        value = profile.get(key)
+        texts[key] = '' if value is None else json.dumps(value) if isinstance(value, dict) else str(value)
+    return texts
+
+
+def parse_profile_entries(texts, initial=None):
+    """Read the GUI's profile entries, `{key: text}`. An empty entry becomes None, i.e. the default.
+
+    With `initial`, the texts the entries started with, only the entries
+    the user changed are returned, so settings the GUIs do not show stay
+    as they are.
+    """
+    profile = {}
+    for key, label, parse in PROFILE_ENTRIES:
+        text = texts.get(key, '').strip()
+        if initial is not None and text == initial.get(key, '').strip():
+            continue
+        try:
+            profile[key] = parse(text) if text else None
+        except ValueError as err:
+            raise ValueError(f"Invalid {label}: {err}")
+    return profile
+
+
+def merge_profile(profile, changes):
+    """Apply profile changes, settings set to None go back to the default and are left out."""
+    merged = dict(profile)
+    if changes.get('sample_fps') is not None:
+        # The range follows a new rate unless it is given as well
+        merged.pop('min_sample_fps', None)
+        merged.pop('max_sample_fps', None)
+    if 'detector' in changes:
+        merged.pop('detector_params', None)
+    merged.update(changes)
+    return {key: value for key, value in merged.items() if value is not None}
+
+
+def read_camera_file(path):
+    """Read cameras from a JSON list (or `{"cameras": [...]}`) or a CSV file with a header row."""
+    with open(path, newline='') as f:
+        if path.lower().endswith('.json'):
+            data = json.load(f)
+            return data.get('cameras', []) if isinstance(data, dict) else data
+        return list(csv.DictReader(f))
+
+
+def load_cameras(path):
+    """Return the cameras saved by the configuration GUIs as dicts, one per device_id.
+
+    If a device_id was saved more than once, the most recent row wins.
+    """
+    # Read-only, so a mistyped path fails instead of creating an empty database
+    conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    try:
+        conn.row_factory = sqlite3.Row
+        rows = conn.execute('SELECT * FROM cameras ORDER BY id').fetchall()
+    finally:
+        conn.close()
+    cameras = {}
+    for row in rows:
+        cameras.pop(row['device_id'], None)
+        cameras[row['device_id']] = dict(row)
+    return list(cameras.values())
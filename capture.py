@@ -0,0 +1,257 @@
+import logging
+import threading
+import time
+
+import cv2
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class OpenCVCapture:
+    """Default backend: FFmpeg through cv2.VideoCapture, every frame is decoded on grab."""
+
+    def __init__(self, url, open_timeout=None, read_timeout=3.0):
+        if url.startswith('rtsp://'):
+            # Append the transport protocol to the RTSP URL
+            url += f"?rtsp_transport=tcp&timeout={int(read_timeout * 1000)}"
+        self.url = url
+        if open_timeout:
+            self.cap = cv2.VideoCapture(url, cv2.CAP_FFMPEG,
+                                        [cv2.CAP_PROP_OPEN_TIMEOUT_MSEC, int(open_timeout * 1000)])
+        else:
+            self.cap = cv2.VideoCapture(url)
+
+    def isOpened(self):
+        return self.cap.isOpened()
+
+    def grab(self):
+        return self.cap.grab()
+
+    def retrieve(self):
+        return self.cap.retrieve()
+
+    def release(self):
+        self.cap.release()
+
+
+class KeyframeCapture:
+    """PyAV backend that only ever decodes keyframes.
+
+    `grab` demuxes packets without decoding them and stops at the next
+    keyframe, `retrieve` decodes just that keyframe. Keyframes decode on
+    their own, so the P/B frames in between are never touched and the
+    achievable sample rate is bounded by the camera's GOP length.
+    """
+
+    def __init__(self, url, open_timeout=5.0, read_timeout=5.0):
+        try:
+            import av
+        except ImportError:
+            raise RuntimeError("The 'pyav' capture backend needs PyAV, install it with `pip install av`")
+
+        self.url = url
+        self.container = None
+        self._packet = None
+        options = {'rtsp_transport': 'tcp'} if url.startswith('rtsp://') else {}
+        try:
+            self.container = av.open(url, options=options, timeout=(open_timeout, read_timeout))
+        except av.FFmpegError as err:
+            logger.warning("Unable to open %s: %s", url, err)
+            return
+        self._video = self.container.streams.video[0]
+        self._video.codec_context.skip_frame = 'NONKEY'
+        # Frame threading would hold keyframes back until several more arrive
+        self._video.codec_context.thread_type = 'SLICE'
+        self._packets = self.container.demux(self._video)
+
+    def isOpened(self):
+        return self.container is not None
+
+    def grab(self):
+        import av
+        try:
+            for packet in self._packets:
+                if packet.is_keyframe and packet.size:
+                    self._packet = packet
+                    return True
+        except av.FFmpegError as err:
+            logger.warning("Reading %s failed: %s", self.url, err)
+        return False
+
+    def retrieve(self):
+        import av
+        if self._packet is None:
+            return False, None
+        packet, self._packet = self._packet, None
+        try:
+            for frame in self._video.codec_context.decode(packet):
+                return True, frame.to_ndarray(format='bgr24')
+        except av.FFmpegError as err:
+            logger.warning("Decoding a keyframe from %s failed: %s", self.url, err)
+        return False, None
+
+    def release(self):
+        if self.container is not None:
+            self.container.close()
+            self.container = None
+
+
+CAPTURE_BACKENDS = {
+    'opencv': OpenCVCapture,
+    'pyav': KeyframeCapture,
+}
+
+
+def open_capture(backend, url, open_timeout=None, read_timeout=None):
+    """Open `url` with a backend, giving up on the connection after `open_timeout` seconds
+    and on a read after `read_timeout` seconds, where set."""
+    if backend not in CAPTURE_BACKENDS:
+        raise ValueError(f"Unknown capture backend {backend!r}, expected one of {', '.join(CAPTURE_BACKENDS)}")
+    timeouts = {}
+    if open_timeout:
+        timeouts['open_timeout'] = open_timeout
+    if read_timeout:
+        timeouts['read_timeout'] = read_timeout
+    return CAPTURE_BACKENDS[backend](url, **timeouts)
+
+
+class LatestFrameCapture:
+    """Drains a stream continuously and keeps only the newest sampled frame.
+
+    Every frame is grabbed so the decoder buffer never backs up, but only one
+    frame per sample interval is retrieved (fully decoded) and published,
+    both to `read()` callers and to the optional `on_frame(seq, frame,
+    captured_at, trace)` sink. `trace` is the frame's tracing.FrameTrace
+    when a `tracer` picked it, otherwise None. `sample_interval` may be
+    changed while running.
+    """
+
+    def __init__(self, cap, device_id, sample_fps, on_frame=None, tracer=None):
+        self.cap = cap
+        self.device_id = device_id
+        self.on_frame = on_frame
+        self.tracer = tracer
+        self.sample_interval = 1.0 / sample_fps if sample_fps > 0 else 0.0
+        self.frames_grabbed = 0
+        self.frames_published = 0
+
+        self._cond = threading.Condition()
+        self._frame = None
+        self._captured_at = 0.0
+        self._seq = 0
+        self._running = False
+        self._stopped = False
+        self._thread = None
+
+    def start(self):
+        with self._cond:
+            if self._stopped:
+                return
+            self._running = True
+        self._thread = threading.Thread(target=self._run, name=f"capture-{self.device_id}", daemon=True)
+        self._thread.start()
+
+    def run(self):
+        """Capture on the calling thread until the stream ends or `stop()` is called."""
+        with self._cond:
+            if self._stopped:
+                return
+            self._running = True
+        self._run()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._running = False
+            self._cond.notify_all()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def _run(self):
+        grabbed_counter = metrics.FRAMES_GRABBED.labels(self.device_id)
+        sampled_counter = metrics.FRAMES_SAMPLED.labels(self.device_id)
+        last_sample = float('-inf')
+        try:
+            while self._running:
+                grab_started = time.monotonic()
+                if not self.cap.grab():
+                    logger.warning("Failed to grab frame from device %s", self.device_id)
+                    break
+                self.frames_grabbed += 1
+                grabbed_counter.inc()
+
+                now = time.monotonic()
+                if now - last_sample < self.sample_interval:
+                    continue
+                trace = self.tracer.start_frame(self.device_id) if self.tracer is not None else None
+                ret, frame = self.cap.retrieve()
+                if not ret:
+                    continue
+                if trace is not None:
+                    trace.add('grab', grab_started, now)
+                    trace.add('retrieve', now, time.monotonic())
+                last_sample = now
+                sampled_counter.inc()
+
+                with self._cond:
+                    self._frame = frame
+                    self._captured_at = now
+                    self._seq += 1
+                    self.frames_published += 1
+                    seq = self._seq
+                    self._cond.notify_all()
+                if self.on_frame is not None:
+                    self.on_frame(seq, frame, now, trace)
+        finally:
+            with self._cond:
+                self._running = False
+                self._cond.notify_all()
+
+    def read(self, last_seq=0, timeout=None):
+        """Wait for a frame newer than `last_seq`.
+
+        Returns `(seq, frame, captured_at)` where `captured_at` is a
+        `time.monotonic()` timestamp, or None once the stream has ended.
+        """
+        with self._cond:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while self._seq <= last_seq:
+                if not self._running:
+                    return None
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+            return self._seq, self._frame, self._captured_at
+
+
+class FrameAgeStats:
+    """Tracks how old frames are by the time detection runs on them, per camera."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def record(self, device_id, age):
+        with self._lock:
+            stats = self._stats.get(device_id)
+            if stats is None:
+                stats = self._stats[device_id] = {"count": 0, "last": 0.0, "max": 0.0, "total": 0.0}
+            stats["count"] += 1
+            stats["last"] = age
+            stats["max"] = max(stats["max"], age)
+            stats["total"] += age
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                device_id: {
+                    "frames_analyzed": stats["count"],
+                    "last_frame_age_ms": round(stats["last"] * 1000, 1),
+                    "max_frame_age_ms": round(stats["max"] * 1000, 1),
+                    "mean_frame_age_ms": round(stats["total"] / stats["count"] * 1000, 1),
+                }
+                for device_id, stats in self._stats.items()
+            }
@@ -0,0 +1,84 @@
+import contextlib
+import json
+import sqlite3
+import time
+
+import requests
+
+EVENTS_URL = "https://citra-api-qp4p25cifq-ww.a.run.app/events/events_with_cameras"
+
+
+class CatalogCache:
+    """The API's events_with_cameras document, cached in SQLite so it is at hand offline.
+
+    `refresh` asks the API with If-None-Match/If-Modified-Since, so an
+    unchanged catalog costs a 304 instead of the whole document. Every
+    call opens its own connection, the cache can be used from any thread.
+    """
+
+    def __init__(self, path='cameras.db', url=EVENTS_URL, ttl=300.0, timeout=10):
+        self.path = path
+        self.url = url
+        self.ttl = ttl
+        self.timeout = timeout
+        with self._connect() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS catalog_cache (
+                    url TEXT PRIMARY KEY,
+                    body TEXT NOT NULL,
+                    etag TEXT,
+                    last_modified TEXT,
+                    fetched_at REAL NOT NULL
+                )
+            ''')
+
+    def load(self):
+        """Return `(events, fetched_at)` from the cache, `(None, None)` if nothing was fetched yet."""
+        with self._connect() as conn:
+            row = conn.execute('SELECT body, fetched_at FROM catalog_cache WHERE url = ?', (self.url,)).fetchone()
+        if row is None:
+            return None, None
+        return json.loads(row[0]), row[1]
+
+    def is_stale(self):
+        _, fetched_at = self.load()
+        return fetched_at is None or time.time() - fetched_at >= self.ttl
+
+    def refresh(self):
+        """Revalidate the cached catalog with the API, returns `(events, changed)`.
+
+        Raises requests' exceptions when the API cannot be reached or
+        fails, the cache is left as it was then.
+        """
+        with self._connect() as conn:
+            row = conn.execute('SELECT body, etag, last_modified FROM catalog_cache WHERE url = ?',
+                               (self.url,)).fetchone()
+        headers = {}
+        if row is not None:
+            if row[1]:
+                headers['If-None-Match'] = row[1]
+            if row[2]:
+                headers['If-Modified-Since'] = row[2]
+        response = requests.get(self.url, headers=headers, timeout=self.timeout)
+
+        if response.status_code == 304 and row is not None:
+            with self._connect() as conn:
+                conn.execute('UPDATE catalog_cache SET fetched_at = ? WHERE url = ?', (time.time(), self.url))
+            return json.loads(row[0]), False
+        response.raise_for_status()
+        events = response.json()
+        body = json.dumps(events)
+        with self._connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO catalog_cache (url, body, etag, last_modified, fetched_at) '
+                         'VALUES (?, ?, ?, ?, ?)', (self.url, body, response.headers.get('ETag'),
+                                                    response.headers.get('Last-Modified'), time.time()))
+        return events, row is None or body != row[0]
+
+    @contextlib.contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=5)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
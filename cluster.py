@@ -0,0 +1,364 @@
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class LeaseStore:
+    """The cameras of a cluster and the node holding each camera's lease, in an SQLite file the nodes share.
+
+    A lease is claimed with a single conditional UPDATE, so two nodes can
+    never both win the same camera. Lease times are wall-clock seconds,
+    nodes on different machines need synchronised clocks and a file
+    system that supports SQLite's locking.
+    """
+
+    def __init__(self, path, busy_timeout=5.0):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=busy_timeout, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS cluster_nodes (
+                node_id TEXT PRIMARY KEY,
+                url TEXT,
+                capacity REAL NOT NULL,
+                heartbeat REAL NOT NULL
+            )
+        ''')
+        # version goes up with every change of a camera's configuration, so its owner notices it
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS cluster_cameras (
+                device_id TEXT PRIMARY KEY,
+                rtsp_url TEXT NOT NULL,
+                event_id TEXT NOT NULL,
+                options TEXT NOT NULL,
+                version INTEGER NOT NULL DEFAULT 1,
+                owner TEXT,
+                lease_until REAL NOT NULL DEFAULT 0,
+                state TEXT,
+                live_since REAL
+            )
+        ''')
+
+    def put_camera(self, rtsp_url, device_id, event_id, options):
+        """Add a camera or update its configuration, returns True if it is new to the cluster."""
+        text = json.dumps(options, sort_keys=True)
+        with self._lock:
+            with self._conn:
+                self._conn.execute('BEGIN IMMEDIATE')
+                row = self._conn.execute('SELECT rtsp_url, event_id, options FROM cluster_cameras WHERE device_id = ?',
+                                         (device_id,)).fetchone()
+                if row is None:
+                    self._conn.execute('INSERT INTO cluster_cameras (device_id, rtsp_url, event_id, options) '
+                                       'VALUES (?, ?, ?, ?)', (device_id, rtsp_url, event_id, text))
+                elif row != (rtsp_url, event_id, text):
+                    self._conn.execute('UPDATE cluster_cameras SET rtsp_url = ?, event_id = ?, options = ?, '
+                                       'version = version + 1 WHERE device_id = ?',
+                                       (rtsp_url, event_id, text, device_id))
+        return row is None
+
+    def remove_camera(self, device_id):
+        with self._lock:
+            cursor = self._conn.execute('DELETE FROM cluster_cameras WHERE device_id = ?', (device_id,))
+        return cursor.rowcount > 0
+
+    def camera(self, device_id):
+        cameras = self._select('WHERE device_id = ?', (device_id,))
+        return cameras[0] if cameras else None
+
+    def cameras(self):
+        return self._select('ORDER BY device_id', ())
+
+    def heartbeat(self, node_id, url, capacity, now):
+        with self._lock:
+            self._conn.execute('INSERT INTO cluster_nodes (node_id, url, capacity, heartbeat) VALUES (?, ?, ?, ?) '
+                               'ON CONFLICT (node_id) DO UPDATE SET url = excluded.url, capacity = excluded.capacity, '
+                               'heartbeat = excluded.heartbeat', (node_id, url, capacity, now))
+
+    def nodes(self, since):
+        """`{node_id: {"url", "capacity", "heartbeat"}}` of the nodes seen since `since`."""
+        with self._lock:
+            rows = self._conn.execute('SELECT node_id, url, capacity, heartbeat FROM cluster_nodes '
+                                      'WHERE heartbeat >= ?', (since,)).fetchall()
+        return {node_id: {"url": url, "capacity": capacity, "heartbeat": heartbeat}
+                for node_id, url, capacity, heartbeat in rows}
+
+    def renew(self, node_id, until, states):
+        """Extend every lease `node_id` holds to `until` and record the `(state, live_since)` of its cameras.
+
+        Returns the cameras the node holds, i.e. the ones it should run.
+        Cameras that were removed or taken over since are not among them.
+        """
+        with self._lock:
+            with self._conn:
+                self._conn.execute('BEGIN IMMEDIATE')
+                self._conn.execute('UPDATE cluster_cameras SET lease_until = ? WHERE owner = ?', (until, node_id))
+                self._conn.executemany(
+                    'UPDATE cluster_cameras SET state = ?, live_since = ? WHERE device_id = ? AND owner = ?',
+                    [(state, live_since, device_id, node_id) for device_id, (state, live_since) in states.items()])
+        return self._select('WHERE owner = ?', (node_id,))
+
+    def claim(self, node_id, device_id, now, until):
+        """Take the lease of a camera nobody holds a valid lease on, returns whether it worked."""
+        with self._lock:
+            cursor = self._conn.execute(
+                'UPDATE cluster_cameras SET owner = ?, lease_until = ?, state = NULL, live_since = NULL '
+                'WHERE device_id = ? AND (owner IS NULL OR lease_until < ?)', (node_id, until, device_id, now))
+        return cursor.rowcount > 0
+
+    def release(self, node_id, device_id):
+        """Give up the lease of a camera, so other nodes can claim it at once."""
+        with self._lock:
+            self._conn.execute('UPDATE cluster_cameras SET owner = NULL, lease_until = 0, state = NULL, '
+                               'live_since = NULL WHERE device_id = ? AND owner = ?', (device_id, node_id))
+
+    def leave(self, node_id):
+        with self._lock:
+            with self._conn:
+                self._conn.execute('BEGIN IMMEDIATE')
+                self._conn.execute('UPDATE cluster_cameras SET owner = NULL, lease_until = 0, state = NULL, '
+                                   'live_since = NULL WHERE owner = ?', (node_id,))
+                self._conn.execute('DELETE FROM cluster_nodes WHERE node_id = ?', (node_id,))
+
+    def _select(self, where, args):
+        with self._lock:
+            rows = self._conn.execute('SELECT device_id, rtsp_url, event_id, options, version, owner, lease_until, '
+                                      f'state, live_since FROM cluster_cameras {where}', args).fetchall()
+        return [{"device_id": device_id, "rtsp_url": rtsp_url, "event_id": event_id, "options": json.loads(options),
+                 "version": version, "owner": owner, "lease_until": lease_until, "state": state,
+                 "live_since": live_since}
+                for device_id, rtsp_url, event_id, options, version, owner, lease_until, state, live_since in rows]
+
+
+def plan_claims(cameras, nodes, now):
+    """Place the cameras nobody holds a valid lease on, returns `{device_id: node_id}`.
+
+    Each free camera goes to the node with the lowest load after taking
+    it, the load being the node's valid leases divided by its capacity.
+    Every node computes the same plan from the same rows, so nodes do not
+    race for the same cameras.
+    """
+    load = {node_id: 0 for node_id in nodes}
+    free = []
+    for camera in cameras:
+        if camera['owner'] is None or camera['lease_until'] < now:
+            free.append(camera['device_id'])
+        elif camera['owner'] in load:
+            load[camera['owner']] += 1
+    plan = {}
+    for device_id in free:
+        node_id = min(load, key=lambda node: ((load[node] + 1) / nodes[node]['capacity'], node))
+        plan[device_id] = node_id
+        load[node_id] += 1
+    return plan
+
+
+class ClusterNode:
+    """Runs this node's share of a cluster's cameras on `local`, a `StreamRegistry` or `Supervisor`.
+
+    Cameras started through any node go into the shared `LeaseStore`.
+    Every `lease / 4` seconds a node renews the leases it holds, starts the
+    cameras it newly holds or whose configuration changed, claims its share
+    of the cameras without a valid lease (see `plan_claims`) and hands a
+    camera back when another node would be less loaded even after taking
+    it. A node that cannot renew stops its cameras before its leases run
+    out, so no camera is processed twice. The cameras of a node that died
+    are claimed the moment its leases expire, at most one lease period
+    after it last renewed them.
+
+    It offers the same start/stop/snapshot calls as `registry.StreamRegistry`,
+    so the control endpoints can use it as their registry.
+    """
+
+    def __init__(self, store, local, node_id=None, url=None, capacity=1.0, lease=15.0):
+        if capacity <= 0 or lease <= 0:
+            raise ValueError("capacity and lease must be above 0")
+        self.store = store
+        self.local = local
+        self.node_id = node_id or f"{socket.gethostname()}:{os.getpid()}"
+        self.url = url
+        self.capacity = capacity
+        self.lease = lease
+        self.interval = lease / 4
+
+        # Configuration version of every camera this node runs
+        self._running = {}
+        # Until when the leases confirmed by the last renewal hold
+        self._valid_until = 0.0
+        self._tick_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start_node(self):
+        self._thread = threading.Thread(target=self._run, name="cluster-node", daemon=True)
+        self._thread.start()
+
+    def leave(self):
+        """Stop this node's cameras and release their leases, so the other nodes take them over right away."""
+        self._stopping.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+        with self._tick_lock:
+            for device_id in list(self._running):
+                self._drop(device_id)
+        try:
+            self.store.leave(self.node_id)
+        except sqlite3.Error as err:
+            logger.warning("Unable to release the leases of node %s: %s", self.node_id, err)
+
+    def start(self, rtsp_url, device_id, event_id, options):
+        """Add or update a camera of the cluster, returns True if it is new.
+
+        Whichever node holds its lease starts or reconfigures it on its
+        next check, this node checks right away.
+        """
+        new = self.store.put_camera(rtsp_url, device_id, event_id, options)
+        self._wake.set()
+        return new
+
+    def stop(self, device_id):
+        removed = self.store.remove_camera(device_id)
+        self._wake.set()
+        return removed
+
+    def configuration(self, device_id):
+        camera = self.store.camera(device_id)
+        if camera is None:
+            return None
+        return camera['rtsp_url'], camera['event_id'], camera['options']
+
+    def get(self, device_id):
+        return self.local.get(device_id)
+
+    def streams(self):
+        return self.local.streams()
+
+    def snapshot(self):
+        """This node's streams plus the cluster's other cameras, each with the node running it."""
+        streams = [dict(stream, node=self.node_id) for stream in self.local.snapshot()]
+        try:
+            cameras = self.store.cameras()
+        except sqlite3.Error as err:
+            logger.warning("Unable to read the cluster's cameras: %s", err)
+            return streams
+        now = time.time()
+        local = {stream['device_id'] for stream in streams}
+        for camera in cameras:
+            if camera['device_id'] in local:
+                continue
+            held = camera['owner'] is not None and camera['lease_until'] >= now
+            streams.append({"device_id": camera['device_id'], "rtsp_url": camera['rtsp_url'],
+                            "event_id": camera['event_id'],
+                            "state": (camera['state'] or 'starting') if held else 'unassigned',
+                            "live_since": camera['live_since'] if held else None,
+                            "node": camera['owner'] if held else None})
+        return streams
+
+    def owner_url(self, device_id):
+        """URL of the node running `device_id` if that is another node, otherwise None."""
+        camera = self.store.camera(device_id)
+        if camera is None or camera['owner'] in (None, self.node_id) or camera['lease_until'] < time.time():
+            return None
+        node = self.store.nodes(time.time() - self.lease).get(camera['owner'])
+        return node['url'] if node else None
+
+    def nodes(self):
+        """The live nodes with the cameras each one holds."""
+        now = time.time()
+        nodes = self.store.nodes(now - self.lease)
+        for node in nodes.values():
+            node['cameras'] = []
+        for camera in self.store.cameras():
+            if camera['owner'] in nodes and camera['lease_until'] >= now:
+                nodes[camera['owner']]['cameras'].append(camera['device_id'])
+        return nodes
+
+    def _run(self):
+        while not self._stopping.is_set():
+            wait = self.interval
+            try:
+                with self._tick_lock:
+                    wait = self._tick()
+            except sqlite3.Error as err:
+                logger.warning("Cluster store %s unavailable: %s", self.store.path, err)
+                if self._running and time.time() > self._valid_until - self.interval:
+                    # The leases may lapse before the next renewal, stop before another node takes over
+                    logger.warning("Stopping %d cameras, their leases could not be renewed", len(self._running))
+                    with self._tick_lock:
+                        for device_id in list(self._running):
+                            self._drop(device_id)
+            self._wake.wait(wait)
+            self._wake.clear()
+
+    def _tick(self):
+        now = time.time()
+        until = now + self.lease
+        states = {stream['device_id']: (stream['state'], stream['live_since']) for stream in self.local.snapshot()
+                  if stream['device_id'] in self._running}
+        self.store.heartbeat(self.node_id, self.url, self.capacity, now)
+        held = self.store.renew(self.node_id, until, states)
+        self._valid_until = until
+
+        # Removed from the cluster, or taken over after this node failed to renew in time
+        held_ids = {camera['device_id'] for camera in held}
+        for device_id in set(self._running) - held_ids:
+            self._drop(device_id)
+        for camera in held:
+            self._apply(camera)
+
+        cameras = self.store.cameras()
+        nodes = self.store.nodes(now - self.lease)
+        plan = plan_claims(cameras, nodes, now)
+        for camera in cameras:
+            if plan.get(camera['device_id']) == self.node_id and \
+                    self.store.claim(self.node_id, camera['device_id'], now, until):
+                self._apply(camera)
+        if not plan:
+            self._shed(cameras, nodes, now)
+
+        # Wake up when the next lease of another node runs out, in case that node is gone
+        expiries = [camera['lease_until'] for camera in cameras
+                    if camera['owner'] not in (None, self.node_id) and camera['lease_until'] >= now]
+        return max(0.05, min([self.interval] + [expiry - time.time() + 0.01 for expiry in expiries]))
+
+    def _shed(self, cameras, nodes, now):
+        # Hand back one camera per check while another node would still be less loaded after taking it
+        load = {node_id: 0 for node_id in nodes}
+        for camera in cameras:
+            if camera['owner'] in load and camera['lease_until'] >= now:
+                load[camera['owner']] += 1
+        if not self._running or self.node_id not in load:
+            return
+        mine = load[self.node_id] / self.capacity
+        if any((count + 1) / nodes[node_id]['capacity'] < mine
+               for node_id, count in load.items() if node_id != self.node_id):
+            device_id = max(self._running)
+            logger.warning("Handing device %s to a less loaded node", device_id)
+            self._drop(device_id)
+            self.store.release(self.node_id, device_id)
+
+    def _apply(self, camera):
+        device_id = camera['device_id']
+        if self._running.get(device_id) == camera['version']:
+            return
+        try:
+            self.local.start(camera['rtsp_url'], device_id, camera['event_id'], camera['options'])
+        except (ValueError, RuntimeError) as err:
+            logger.warning("Unable to start device %s: %s", device_id, err)
+            return
+        self._running[device_id] = camera['version']
+
+    def _drop(self, device_id):
+        self._running.pop(device_id, None)
+        try:
+            self.local.remove(device_id, wait=False)
+        except RuntimeError as err:
+            logger.warning("Unable to stop device %s: %s", device_id, err)
@@ -1,10 +1,28 @@
 import sys
+import threading
+import time
 import requests
-from PyQt5.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, QPushButton, QLabel, QLineEdit, QComboBox, QTableWidget, QTableWidgetItem, QMessageBox, QHeaderView)
-from PyQt5.QtCore import Qt
+from PyQt5.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, QPushButton, QLabel, QLineEdit, QComboBox, QTableWidget, QTableWidgetItem, QMessageBox, QHeaderView, QFileDialog, QDialog, QFormLayout, QDialogButtonBox)
+from PyQt5.QtCore import QObject, Qt, QTimer, pyqtSignal
+from PyQt5.QtGui import QPixmap
+import json
 import sqlite3
 
+from camera_store import (PROFILE_ENTRIES, init_cameras_table, merge_profile, parse_profile_entries,
+                          profile_entry_texts, read_camera_file, save_cameras, validate_cameras)
+from catalog import CatalogCache
+from roi import parse_roi
+
+# Seconds the cached event catalog counts as fresh, and between retries while the API is unreachable
+CATALOG_TTL = 300
+CATALOG_RETRY = 30
+
 class MainWindow(QMainWindow):
+    # Outcome of sending an edited profile to the server, from the thread that sent it
+    profile_pushed = pyqtSignal(str)
+    # Outcome of a camera import as (title, message), from the thread that ran it
+    import_finished = pyqtSignal(str, str)
+
     def __init__(self):
         super().__init__()
         self.init_db()
@@ -21,6 +39,19 @@ class MainWindow(QMainWindow):
 
         self.fetch_cameras()  # Fetch existing cameras to populate the table on startup
         self.apply_stylesheet()
+
+        # The cached catalog fills the dropdowns right away, the refresher updates them when the API answers
+        self.catalog = CatalogCache(ttl=CATALOG_TTL)
+        self.catalog_refresher = CatalogRefresher(self.catalog, self)
+        self.catalog_refresher.loaded.connect(self.show_events)
+        self.catalog_refresher.status.connect(self.statusBar().showMessage)
+        events, fetched_at = self.catalog.load()
+        if events is not None:
+            self.show_events(events)
+            self.statusBar().showMessage(f"Events from {time.strftime('%Y-%m-%d %H:%M', time.localtime(fetched_at))}")
+        self.catalog_refresher.start()
+        self.profile_pushed.connect(self.statusBar().showMessage)
+        self.import_finished.connect(self.show_import_result)
         self.show()
 
     def create_inputs(self):
@@ -54,32 +85,36 @@ class MainWindow(QMainWindow):
     def create_buttons(self):
         layout = QHBoxLayout()
         self.register_button = QPushButton('Register Camera')
+        self.edit_button = QPushButton('Edit Camera')
         self.delete_button = QPushButton('Delete Camera')
         self.reconnect_button = QPushButton('Reconnect Camera')
+        self.import_button = QPushButton('Import Cameras')
+        self.preview_button = QPushButton('Preview')
 
         self.register_button.clicked.connect(self.register_camera)
+        self.edit_button.clicked.connect(self.edit_camera)
         self.delete_button.clicked.connect(self.delete_camera)
         self.reconnect_button.clicked.connect(self.reconnect_camera)
+        self.import_button.clicked.connect(self.import_cameras)
+        self.preview_button.clicked.connect(self.preview_camera)
 
         layout.addWidget(self.register_button)
+        layout.addWidget(self.edit_button)
         layout.addWidget(self.delete_button)
         layout.addWidget(self.reconnect_button)
+        layout.addWidget(self.import_button)
+        layout.addWidget(self.preview_button)
 
         self.layout.addLayout(layout)
 
     def init_db(self):
         conn = sqlite3.connect('cameras.db')
-        cursor = conn.cursor()
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS cameras (
-                id INTEGER PRIMARY KEY,
-                rtsp_url TEXT NOT NULL,
-                device_id TEXT NOT NULL,
-                event_id TEXT NOT NULL
-            )
-        ''')
-        conn.commit()
+        merged = init_cameras_table(conn)
         conn.close()
+        if merged:
+            QMessageBox.warning(self, 'Duplicate Cameras',
+                                'These cameras were saved more than once, only their latest entry was kept: '
+                                + ', '.join(merged))
 
     def fetch_cameras(self):
         conn = sqlite3.connect('cameras.db')
@@ -94,13 +129,28 @@ class MainWindow(QMainWindow):
         conn.close()
 
     def fetch_events_and_cameras(self):
-        response = requests.get("https://citra-api-qp4p25cifq-ww.a.run.app/events/events_with_cameras")
-        if response.status_code == 200:
-            events = response.json()
-            self.event_dropdown.clear()
-            for event in events:
-                self.event_dropdown.addItem(event['name'], event)
-            self.update_cameras_dropdown(events[0]['cameras'])
+        # Checked in the background, the dropdowns change once a newer catalog arrives
+        self.statusBar().showMessage('Checking for event updates...')
+        self.catalog_refresher.refresh_now()
+
+    def show_events(self, events):
+        """Fill the dropdowns with `events`, keeping the selected event and camera if they are still listed."""
+        event = self.event_dropdown.currentData()
+        event_id = event['eventId'] if event else None
+        camera_id = self.camera_dropdown.currentData()
+
+        self.event_dropdown.blockSignals(True)
+        self.event_dropdown.clear()
+        for event in events:
+            self.event_dropdown.addItem(event['name'], event)
+        index = next((i for i, event in enumerate(events) if event['eventId'] == event_id), 0)
+        self.event_dropdown.setCurrentIndex(index if events else -1)
+        self.event_dropdown.blockSignals(False)
+
+        self.update_cameras_dropdown(events[index]['cameras'] if events else [])
+        index = self.camera_dropdown.findData(camera_id)
+        if index >= 0:
+            self.camera_dropdown.setCurrentIndex(index)
 
     def update_cameras_dropdown(self, cameras):
         self.camera_dropdown.clear()
@@ -138,12 +188,65 @@ class MainWindow(QMainWindow):
 
     def save_camera_to_db(self, rtsp_url, camera_id, event_id):
         conn = sqlite3.connect('cameras.db')
-        cursor = conn.cursor()
-        cursor.execute('INSERT INTO cameras (rtsp_url, device_id, event_id) VALUES (?, ?, ?)',
-                       (rtsp_url, camera_id, event_id))
-        conn.commit()
+        save_cameras(conn, [{"rtsp_url": rtsp_url, "device_id": camera_id, "event_id": event_id}])
         conn.close()
 
+    def import_cameras(self):
+        path, _ = QFileDialog.getOpenFileName(self, 'Import Cameras', '', 'Camera lists (*.csv *.json);;All files (*)')
+        if not path:
+            return
+
+        try:
+            cameras, errors, duplicates = validate_cameras(read_camera_file(path))
+        except (OSError, ValueError) as err:
+            QMessageBox.warning(self, 'Error', f'Unable to read {path}: {err}')
+            return
+        if not cameras:
+            QMessageBox.warning(self, 'Error', f'No valid cameras in {path}')
+            return
+
+        # Registering and saving hundreds of cameras takes a while, import_finished reports back
+        self.import_button.setEnabled(False)
+        self.statusBar().showMessage(f'Importing {len(cameras)} cameras from {path}...')
+        threading.Thread(target=self.register_imported, args=(cameras, errors, duplicates),
+                         name="import-cameras", daemon=True).start()
+
+    def register_imported(self, cameras, errors, duplicates):
+        # Runs on a thread of its own, the result reaches the window through import_finished
+        try:
+            response = requests.post("http://localhost:5000/register_cameras",
+                                     json=[camera for _, camera in cameras], timeout=30)
+            response.raise_for_status()
+            result = response.json()
+            registered = set(result['registered'])
+
+            conn = sqlite3.connect('cameras.db')
+            try:
+                save_cameras(conn, [camera for _, camera in cameras if camera['device_id'] in registered])
+            finally:
+                conn.close()
+        except (requests.exceptions.RequestException, ValueError, sqlite3.Error) as err:
+            self.import_finished.emit('Error', str(err))
+            return
+
+        messages = [f'Registered {len(registered)} cameras.']
+        if duplicates:
+            messages.append(f"Listed more than once, last entry used: {', '.join(sorted(set(duplicates)))}")
+        # The server numbers its errors by position in the list it was sent
+        errors += [dict(error, index=cameras[error['index']][0]) for error in result['errors']]
+        for error in sorted(errors, key=lambda error: error['index']):
+            messages.append(f"Row {error['index'] + 1} ({error['device_id'] or '-'}): {error['message']}")
+        self.import_finished.emit('Import Cameras', '\n'.join(messages))
+
+    def show_import_result(self, title, message):
+        self.import_button.setEnabled(True)
+        self.statusBar().clearMessage()
+        self.fetch_cameras()
+        if title == 'Error':
+            QMessageBox.warning(self, title, message)
+        else:
+            QMessageBox.information(self, title, message)
+
     def get_selected_camera_id(self):
         selected_row = self.table.currentRow()
         if selected_row == -1:
@@ -159,7 +262,7 @@ class MainWindow(QMainWindow):
         # Get current values to pre-fill the dialog (optional)
         conn = sqlite3.connect('cameras.db')
         cursor = conn.cursor()
-        cursor.execute('SELECT rtsp_url, device_id, event_id FROM cameras WHERE id = ?', (camera_id,))
+        cursor.execute('SELECT rtsp_url, device_id, event_id, roi, profile FROM cameras WHERE id = ?', (camera_id,))
         camera = cursor.fetchone()
         conn.close()
 
@@ -167,18 +270,52 @@ class MainWindow(QMainWindow):
             QMessageBox.warning(self, 'Error', 'Failed to fetch camera details!')
             return
 
-        # Open the edit dialog
-        details = EditCameraDialog.get_new_camera_details(self)
+        # Open the edit dialog, the ROI applies the next time the camera is started
+        details = EditCameraDialog.get_new_camera_details(self, camera)
         if details:
+            profile = merge_profile(json.loads(camera[4]) if camera[4] else {}, details['profile'])
             conn = sqlite3.connect('cameras.db')
             cursor = conn.cursor()
-            cursor.execute('UPDATE cameras SET rtsp_url = ?, device_id = ?, event_id = ? WHERE id = ?',
-                        (details['rtsp_url'], details['device_id'], details['event_id'], camera_id))
-            conn.commit()
-            conn.close()
+            try:
+                cursor.execute('UPDATE cameras SET rtsp_url = ?, device_id = ?, event_id = ?, roi = ?, profile = ? WHERE id = ?',
+                            (details['rtsp_url'], details['device_id'], details['event_id'], details['roi'],
+                             json.dumps(profile), camera_id))
+                conn.commit()
+            except sqlite3.IntegrityError:
+                # device_id is unique, the camera keeps its old values
+                conn.rollback()
+                QMessageBox.warning(self, 'Duplicate Device ID',
+                                    f"Another camera already uses device ID {details['device_id']}.")
+                return
+            finally:
+                conn.close()
             self.fetch_cameras()
+
+            # Apply the profile to the running camera without reconnecting it, the status bar tells how it went.
+            # A renamed camera keeps running under its old device ID until it is started again.
+            if details['profile']:
+                self.statusBar().showMessage(f"Sending the profile of {camera[1]} to the server...")
+                threading.Thread(target=self.push_profile, args=(camera[1], details['profile']),
+                                 name="push-profile", daemon=True).start()
             QMessageBox.information(self, 'Success', 'Camera updated successfully!')
 
+    def push_profile(self, device_id, profile):
+        # Runs on a thread of its own, the result reaches the window through profile_pushed
+        try:
+            response = requests.put(f"http://localhost:5000/cameras/{device_id}/profile", json=profile, timeout=10)
+            if response.status_code == 200:
+                if response.json().get('restarted'):
+                    message = f'Camera {device_id} reconnects to apply the new profile'
+                else:
+                    message = f'The new profile is applied to camera {device_id}'
+            elif response.status_code == 404:
+                message = f'Camera {device_id} is not running, the profile applies once it is started'
+            else:
+                message = f"The server did not apply the profile of {device_id}: {response.json().get('message')}"
+        except (requests.exceptions.RequestException, ValueError) as err:
+            message = f'The server could not be reached: {err}'
+        self.profile_pushed.emit(message)
+
     def delete_camera(self):
         camera_id = self.get_selected_camera_id()
         if not camera_id:
@@ -199,7 +336,7 @@ class MainWindow(QMainWindow):
 
         conn = sqlite3.connect('cameras.db')
         cursor = conn.cursor()
-        cursor.execute('SELECT rtsp_url, device_id, event_id FROM cameras WHERE id = ?', (camera_id,))
+        cursor.execute('SELECT rtsp_url, device_id, event_id, roi, profile FROM cameras WHERE id = ?', (camera_id,))
         camera = cursor.fetchone()
         conn.close()
 
@@ -207,12 +344,16 @@ class MainWindow(QMainWindow):
             QMessageBox.warning(self, 'Error', 'Failed to fetch camera details!')
             return
 
-        rtsp_url, device_id, event_id = camera
+        rtsp_url, device_id, event_id, roi, profile = camera
         data = {
             "rtsp_url": rtsp_url,
             "device_id": device_id,
             "event_id": event_id
         }
+        if roi:
+            data["roi"] = roi
+        if profile:
+            data["profile"] = profile
 
         try:
             response = requests.post("http://localhost:5000/register_camera", json=data)
@@ -223,6 +364,14 @@ class MainWindow(QMainWindow):
         except requests.exceptions.RequestException as err:
             QMessageBox.warning(self, 'Error', str(err))
 
+    def preview_camera(self):
+        selected_row = self.table.currentRow()
+        if selected_row == -1:
+            QMessageBox.warning(self, 'Error', 'No camera selected!')
+            return
+        device_id = self.table.item(selected_row, 2).text()
+        PreviewDialog(device_id, self).show()
+
     def apply_stylesheet(self):
         self.setStyleSheet("""
             QWidget {
@@ -245,6 +394,169 @@ class MainWindow(QMainWindow):
             }
         """)
 
+class EditCameraDialog(QDialog):
+    def __init__(self, camera, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle('Edit Camera')
+        rtsp_url, device_id, event_id, roi, profile = camera
+        profile = json.loads(profile) if profile else {}
+        self.rtsp_url_entry = QLineEdit(rtsp_url)
+        self.device_id_entry = QLineEdit(device_id)
+        self.event_id_entry = QLineEdit(event_id)
+        self.roi_entry = QLineEdit(roi or '')
+        self.roi_entry.setPlaceholderText('[[x, y, w, h], [[x, y], [x, y], [x, y]], ...] as fractions, empty for the whole frame')
+
+        layout = QFormLayout(self)
+        layout.addRow('RTSP URL:', self.rtsp_url_entry)
+        layout.addRow('Device ID:', self.device_id_entry)
+        layout.addRow('Event ID:', self.event_id_entry)
+        layout.addRow('ROI:', self.roi_entry)
+        # Detection profile, empty entries use the server's defaults
+        self.profile_entries = {}
+        self.initial_profile_texts = profile_entry_texts(profile)
+        for key, label, _ in PROFILE_ENTRIES:
+            entry = QLineEdit(self.initial_profile_texts[key])
+            self.profile_entries[key] = entry
+            layout.addRow(f'{label}:', entry)
+        buttons = QDialogButtonBox(QDialogButtonBox.Save | QDialogButtonBox.Cancel)
+        buttons.accepted.connect(self.accept)
+        buttons.rejected.connect(self.reject)
+        layout.addRow(buttons)
+
+    def accept(self):
+        try:
+            parse_roi(self.roi_entry.text())
+            parse_profile_entries(self.profile_texts())
+        except ValueError as err:
+            QMessageBox.warning(self, 'Invalid Settings', str(err))
+            return
+        super().accept()
+
+    def profile_texts(self):
+        return {key: entry.text() for key, entry in self.profile_entries.items()}
+
+    @staticmethod
+    def get_new_camera_details(parent, camera):
+        dialog = EditCameraDialog(camera, parent)
+        if dialog.exec_() != QDialog.Accepted:
+            return None
+        return {
+            "rtsp_url": dialog.rtsp_url_entry.text(),
+            "device_id": dialog.device_id_entry.text(),
+            "event_id": dialog.event_id_entry.text(),
+            "roi": dialog.roi_entry.text().strip(),
+            # Only the entries the user changed, settings not shown here keep their value
+            "profile": parse_profile_entries(dialog.profile_texts(), dialog.initial_profile_texts),
+        }
+
+class CatalogRefresher(QObject):
+    """Keeps the event catalog cache fresh on a thread of its own.
+
+    A changed catalog is handed to the window through `loaded`, and what
+    happened through `status`. Signals reach the window on its own thread.
+    """
+
+    loaded = pyqtSignal(object)
+    status = pyqtSignal(str)
+
+    def __init__(self, cache, parent=None):
+        super().__init__(parent)
+        self.cache = cache
+        self._wake = threading.Event()
+        self._force = False
+
+    def start(self):
+        threading.Thread(target=self._run, name="catalog-refresh", daemon=True).start()
+
+    def refresh_now(self):
+        self._force = True
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            wait = CATALOG_RETRY
+            try:
+                if self._force or self.cache.is_stale():
+                    self._force = False
+                    events, changed = self.cache.refresh()
+                    if changed:
+                        self.loaded.emit(events)
+                    self.status.emit('Events updated' if changed else 'Events are up to date')
+                # Next check once the cached catalog turns stale
+                _, fetched_at = self.cache.load()
+                wait = max(1.0, fetched_at + self.cache.ttl - time.time())
+            except (requests.exceptions.RequestException, ValueError, sqlite3.Error) as err:
+                _, fetched_at = self.cache.load()
+                cached = (f", showing events from {time.strftime('%Y-%m-%d %H:%M', time.localtime(fetched_at))}"
+                          if fetched_at else '')
+                self.status.emit(f'Unable to reach the event API{cached}: {err}')
+            self._wake.wait(wait)
+            self._wake.clear()
+
+class PreviewDialog(QDialog):
+    """Thumbnail of a camera's latest frame from the server, refreshed every couple of seconds.
+
+    Snapshots are fetched on a thread of their own and handed back through
+    `loaded` or `failed`, so a slow server never blocks the window.
+    """
+
+    loaded = pyqtSignal(bytes)
+    failed = pyqtSignal(str)
+
+    def __init__(self, device_id, parent=None):
+        super().__init__(parent)
+        self.device_id = device_id
+        self.setWindowTitle(f'Preview {device_id}')
+        self.setAttribute(Qt.WA_DeleteOnClose)
+        self.image_label = QLabel('Waiting for a frame...')
+        self.image_label.setAlignment(Qt.AlignCenter)
+        layout = QVBoxLayout(self)
+        layout.addWidget(self.image_label)
+
+        self.fetching = False
+        self.loaded.connect(self.show_image)
+        self.failed.connect(self.show_error)
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.refresh)
+        self.timer.start(2000)
+        self.refresh()
+
+    def refresh(self):
+        # A tick while the last snapshot is still on its way is dropped
+        if self.fetching:
+            return
+        self.fetching = True
+        threading.Thread(target=self.fetch, name=f"preview-{self.device_id}", daemon=True).start()
+
+    def fetch(self):
+        signal = self.failed
+        try:
+            response = requests.get(f"http://localhost:5000/snapshot/{self.device_id}", params={"width": 320},
+                                    timeout=2)
+            if response.status_code in (404, 503):
+                result = response.json().get('message', 'No frame available')
+            elif response.status_code != 200:
+                result = f'HTTP error {response.status_code}'
+            else:
+                signal, result = self.loaded, response.content
+        except (requests.exceptions.RequestException, ValueError) as err:
+            result = str(err)
+        try:
+            signal.emit(result)
+        except RuntimeError:
+            # The dialog was closed meanwhile
+            pass
+
+    def show_image(self, jpeg):
+        self.fetching = False
+        pixmap = QPixmap()
+        pixmap.loadFromData(jpeg, 'JPG')
+        self.image_label.setPixmap(pixmap)
+
+    def show_error(self, message):
+        self.fetching = False
+        self.image_label.setText(message)
+
 if __name__ == '__main__':
     app = QApplication(sys.argv)
     mw = MainWindow()
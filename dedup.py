@@ -0,0 +1,73 @@
+import collections
+import threading
+import time
+
+import cv2
+import numpy as np
+
+
+def dhash(crop, size=8):
+    """64-bit difference hash of a crop: brightness gradients of a tiny grayscale copy."""
+    gray = cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY) if crop.ndim == 3 else crop
+    small = cv2.resize(gray, (size + 1, size), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+class DuplicateCache:
+    """Recent face hashes per event, to drop crops another camera already uploaded.
+
+    A crop is a duplicate when a crop of the same event from a different
+    camera, seen within `ttl` seconds, has a hash within `max_distance`
+    bits. Repeats from the same camera are left to its tracker. Entries are
+    kept in least recently matched order, and the oldest go first once
+    there are `max_entries` of them.
+    """
+
+    def __init__(self, max_distance=10, ttl=5.0, max_entries=10000):
+        self.max_distance = max_distance
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._events = collections.defaultdict(dict)
+        self._ids = 0
+
+    def check(self, event_id, device_id, crop, now=None):
+        """Return True if `crop` duplicates a recent one, otherwise remember it and return False."""
+        value = dhash(crop)
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            entries = self._events[event_id]
+            for entry_id, (other_device, other_value, seen_at) in list(entries.items()):
+                if now - seen_at > self.ttl:
+                    self._remove(entry_id)
+                    continue
+                if other_device != device_id and (value ^ other_value).bit_count() <= self.max_distance:
+                    self._entries.move_to_end(entry_id)
+                    self.hits += 1
+                    return True
+
+            self.misses += 1
+            self._ids += 1
+            self._entries[self._ids] = event_id
+            # Looked up again, pruning may have dropped the event's dict
+            self._events[event_id][self._ids] = (device_id, value, now)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+            return False
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
+
+    def _remove(self, entry_id):
+        # Caller holds the lock
+        event_id = self._entries.pop(entry_id)
+        entries = self._events[event_id]
+        del entries[entry_id]
+        if not entries:
+            del self._events[event_id]
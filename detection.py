@@ -0,0 +1,270 @@
+import collections
+import itertools
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+
+import cv2
+
+from frame_ring import FrameRing
+
+logger = logging.getLogger(__name__)
+
+# `stream` is the per-camera context, anything with a `device_id` attribute.
+# `ring_ref` is `(ring, slot, seq)` when `frame` is a view into a FrameRing.
+# `trace` is the frame's tracing.FrameTrace when it was picked for tracing.
+FrameJob = collections.namedtuple('FrameJob', ['stream', 'frame', 'captured_at', 'seq', 'ring_ref', 'trace'],
+                                  defaults=(None, None))
+
+
+class MotionGate:
+    """Decides whether a frame changed enough to be worth running the detector on.
+
+    Frames are shrunk to a small blurred grayscale thumbnail and compared
+    with the thumbnail of the last frame the detector ran on. Comparing with
+    the last analysed frame instead of the previous sample means slow
+    changes add up until they cross the threshold. `threshold` is the
+    fraction of thumbnail pixels that must change, 0 disables the gate.
+    """
+
+    def __init__(self, threshold, width=64, pixel_delta=25):
+        self.threshold = threshold
+        self.width = width
+        self.pixel_delta = pixel_delta
+        self.runs = 0
+        self.skips = 0
+        self._reference = None
+
+    def should_detect(self, frame):
+        if self.threshold <= 0:
+            self.runs += 1
+            return True
+
+        height = max(1, frame.shape[0] * self.width // frame.shape[1])
+        small = cv2.resize(frame, (self.width, height), interpolation=cv2.INTER_AREA)
+        if small.ndim == 3:
+            small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        small = cv2.GaussianBlur(small, (5, 5), 0)
+
+        if self._reference is not None and self._reference.shape == small.shape:
+            diff = cv2.absdiff(small, self._reference)
+            changed = cv2.countNonZero(cv2.threshold(diff, self.pixel_delta, 255, cv2.THRESH_BINARY)[1])
+            if changed < self.threshold * small.size:
+                self.skips += 1
+                return False
+
+        self._reference = small
+        self.runs += 1
+        return True
+
+
+class DetectionEngine:
+    """Fixed-size pool of detection workers shared by every camera.
+
+    Each camera gets its own bounded queue. When the pool falls behind, the
+    oldest queued frame of that camera is dropped instead of letting latency
+    grow. A camera is handed to at most one worker at a time, so per-camera
+    state needs no locking in the handler, and cameras with pending frames
+    take turns so a busy one cannot starve the rest.
+    """
+
+    def __init__(self, handler, workers=None, queue_depth=2):
+        self.handler = handler
+        self.workers = workers or os.cpu_count() or 1
+        self.queue_depth = queue_depth
+
+        self._lock = threading.Lock()
+        self._queues = {}
+        self._scheduled = set()
+        self._ready = queue.Queue()
+        self._counters = collections.defaultdict(lambda: {"submitted": 0, "dropped": 0, "processed": 0})
+        self._threads = []
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f"detector-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        for _ in self._threads:
+            self._ready.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def submit(self, job):
+        device_id = job.stream.device_id
+        with self._lock:
+            pending = self._queues.get(device_id)
+            if pending is None:
+                pending = self._queues[device_id] = collections.deque()
+            counters = self._counters[device_id]
+            counters["submitted"] += 1
+            if len(pending) >= self.queue_depth:
+                pending.popleft()
+                counters["dropped"] += 1
+            pending.append(job)
+            if device_id not in self._scheduled:
+                self._scheduled.add(device_id)
+                self._ready.put(device_id)
+
+    def discard(self, device_id):
+        """Forget any frames still queued for a camera."""
+        with self._lock:
+            pending = self._queues.get(device_id)
+            if pending:
+                pending.clear()
+
+    def _worker(self):
+        while True:
+            device_id = self._ready.get()
+            if device_id is None:
+                return
+            with self._lock:
+                pending = self._queues[device_id]
+                job = pending.popleft() if pending else None
+
+            if job is not None:
+                try:
+                    self.handler(job)
+                except Exception:
+                    logger.exception("Detection failed for device %s", device_id)
+                with self._lock:
+                    self._counters[device_id]["processed"] += 1
+
+            with self._lock:
+                if pending:
+                    self._ready.put(device_id)
+                else:
+                    self._scheduled.discard(device_id)
+
+    def stats(self):
+        with self._lock:
+            return {
+                device_id: dict(counters, queued=len(self._queues.get(device_id, ())))
+                for device_id, counters in self._counters.items()
+            }
+
+
+class DetectorPool:
+    """Runs the face detector in separate processes on frames shared through FrameRings.
+
+    Only `(ring name, slot, seq, params)` crosses the process boundary, the
+    detector processes read the frame straight out of shared memory.
+    `detect` blocks the calling detection worker until the answer arrives,
+    and returns None when the frame was overwritten before it was looked at.
+    """
+
+    def __init__(self, processes, target, args=(), timeout=10.0):
+        self.processes = processes
+        self.target = target
+        self.args = args
+        self.timeout = timeout
+
+        self._context = multiprocessing.get_context('spawn')
+        self._requests = self._context.Queue()
+        self._replies = self._context.Queue()
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._request_ids = itertools.count()
+        self._workers = []
+        self._stopping = threading.Event()
+        self._dispatcher = None
+
+    def start(self):
+        self._workers = [self._spawn(index) for index in range(self.processes)]
+        self._dispatcher = threading.Thread(target=self._dispatch, name="detector-pool", daemon=True)
+        self._dispatcher.start()
+
+    def stop(self):
+        self._stopping.set()
+        for _ in self._workers:
+            self._requests.put(None)
+        for process in self._workers:
+            process.join(self.timeout)
+            if process.is_alive():
+                process.terminate()
+        self._dispatcher.join()
+
+    def detect(self, ring, slot, seq, **params):
+        request_id = next(self._request_ids)
+        waiter = [threading.Event(), None, None]
+        with self._lock:
+            self._pending[request_id] = waiter
+        self._requests.put((request_id, ring.name, slot, seq, params))
+        if not waiter[0].wait(self.timeout):
+            with self._lock:
+                self._pending.pop(request_id, None)
+            raise RuntimeError(f"No detector process answered within {self.timeout}s")
+        if waiter[2] is not None:
+            raise RuntimeError(waiter[2])
+        return waiter[1]
+
+    def _spawn(self, index):
+        process = self._context.Process(target=self.target,
+                                        args=(*self.args, self._requests, self._replies),
+                                        name=f"detector-process-{index}", daemon=True)
+        process.start()
+        return process
+
+    def _dispatch(self):
+        while not self._stopping.is_set():
+            try:
+                request_id, ok, result = self._replies.get(timeout=1.0)
+            except queue.Empty:
+                for index, process in enumerate(self._workers):
+                    if not process.is_alive() and not self._stopping.is_set():
+                        logger.warning("Detector process %d exited with code %s, restarting it",
+                                       index, process.exitcode)
+                        self._workers[index] = self._spawn(index)
+                continue
+            with self._lock:
+                waiter = self._pending.pop(request_id, None)
+            # The caller may have timed out already
+            if waiter is not None:
+                waiter[1], waiter[2] = (result, None) if ok else (None, result)
+                waiter[0].set()
+
+
+def serve_detection(detect, requests, replies, idle_timeout=60.0):
+    """Detector process side of `DetectorPool`: answer requests with `detect(frame, **params)`."""
+    rings = {}
+    while True:
+        try:
+            request = requests.get()
+        except (EOFError, OSError):
+            return
+        if request is None:
+            return
+        request_id, name, slot, seq, params = request
+        try:
+            entry = rings.get(name)
+            if entry is None:
+                entry = rings[name] = [FrameRing.attach(name), 0.0]
+            ring = entry[0]
+            entry[1] = time.monotonic()
+            faces = None
+            frame = ring.read(slot, seq)
+            if frame is not None:
+                faces = detect(frame, **params)
+                del frame
+                if not ring.is_current(slot, seq):
+                    faces = None
+            replies.put((request_id, True, faces))
+        except FileNotFoundError:
+            # The camera stopped and its ring is gone
+            replies.put((request_id, True, None))
+        except Exception as err:
+            logger.exception("Detection request for ring %s failed", name)
+            replies.put((request_id, False, str(err)))
+
+        # Let go of rings whose camera stopped or got a new ring
+        now = time.monotonic()
+        for name, (ring, last_used) in list(rings.items()):
+            if now - last_used > idle_timeout:
+                ring.close()
+                del rings[name]
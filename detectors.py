@@ -0,0 +1,144 @@
+import logging
+import os
+import queue
+import threading
+import time
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+MODELS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models')
+HAAR_CASCADE = cv2.data.haarcascades + 'haarcascade_frontalface_default.xml'
+# OpenCV's ResNet-10 SSD face model, from opencv/samples/dnn/face_detector
+SSD_CONFIG = os.path.join(MODELS_DIR, 'deploy.prototxt')
+SSD_WEIGHTS = os.path.join(MODELS_DIR, 'res10_300x300_ssd_iter_140000.caffemodel')
+
+
+def _filter_sizes(boxes, min_size, max_size):
+    if min_size[0]:
+        boxes = boxes[(boxes[:, 2] >= min_size[0]) & (boxes[:, 3] >= min_size[1])]
+    if max_size[0]:
+        boxes = boxes[(boxes[:, 2] <= max_size[0]) & (boxes[:, 3] <= max_size[1])]
+    return boxes
+
+
+class HaarDetector:
+    """OpenCV's frontal face Haar cascade, the original detector."""
+
+    # Settings a camera may tune, with their types (see `detect`)
+    PARAMS = {'scale_factor': float, 'min_neighbors': int}
+
+    def __init__(self, path=HAAR_CASCADE):
+        self.cascade = cv2.CascadeClassifier(path)
+        if self.cascade.empty():
+            raise RuntimeError(f"Unable to load the Haar cascade from {path}")
+
+    def detect(self, frame, min_size=(0, 0), max_size=(0, 0), scale_factor=1.1, min_neighbors=5):
+        """Return face boxes as (x, y, w, h) in the coordinates of `frame`."""
+        # Convert the frame to grayscale (necessary for the Haarcascade classifier)
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+        faces = self.cascade.detectMultiScale(gray, scaleFactor=scale_factor, minNeighbors=min_neighbors,
+                                              minSize=min_size, maxSize=max_size)
+        return np.asarray(faces, dtype=int).reshape(-1, 4)
+
+
+class SSDDetector:
+    """ResNet-10 SSD face detector run with cv2.dnn on the CPU.
+
+    The network takes a fixed 300x300 input, so frames of any camera can
+    share a forward pass. `detect` calls from several detection workers are
+    collected for up to `max_wait` seconds, or until `max_batch` frames are
+    waiting, and run through the network as one `blobFromImages` batch on a
+    thread that owns the network.
+    """
+
+    PARAMS = {'confidence': float}
+
+    def __init__(self, config=SSD_CONFIG, weights=SSD_WEIGHTS, confidence=0.6, max_batch=8, max_wait=0.01):
+        for path in (config, weights):
+            if not os.path.exists(path):
+                raise RuntimeError(f"The 'ssd' detector needs {path}, download deploy.prototxt and "
+                                   "res10_300x300_ssd_iter_140000.caffemodel from OpenCV's samples/dnn/face_detector")
+        self.net = cv2.dnn.readNetFromCaffe(config, weights)
+        self.confidence = confidence
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.batches = 0
+        self.frames = 0
+
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def detect(self, frame, min_size=(0, 0), max_size=(0, 0), confidence=None):
+        """Return face boxes as (x, y, w, h) in the coordinates of `frame`.
+
+        `confidence` overrides the detector's minimum confidence for this frame.
+        """
+        if frame.ndim == 2:
+            frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="ssd-batcher", daemon=True)
+                self._thread.start()
+        request = [frame, threading.Event(), None, confidence]
+        self._queue.put(request)
+        request[1].wait()
+        if isinstance(request[2], Exception):
+            raise request[2]
+        return _filter_sizes(request[2], min_size, max_size)
+
+    def detect_batch(self, frames, confidences=None):
+        """Run one forward pass over `frames`, returns their boxes in the same order.
+
+        `confidences` optionally gives each frame its own minimum confidence.
+        """
+        blob = cv2.dnn.blobFromImages(frames, 1.0, (300, 300), (104.0, 177.0, 123.0))
+        self.net.setInput(blob)
+        # One row per detection: image index, class, confidence, then the box as fractions of the image
+        detections = self.net.forward().reshape(-1, 7)
+        detections = detections[detections[:, 0] >= 0]
+        self.batches += 1
+        self.frames += len(frames)
+
+        results = []
+        for index, frame in enumerate(frames):
+            height, width = frame.shape[:2]
+            confidence = self.confidence if confidences is None or confidences[index] is None else confidences[index]
+            rows = detections[(detections[:, 0] == index) & (detections[:, 2] >= confidence)]
+            x1 = np.clip(rows[:, 3] * width, 0, width)
+            y1 = np.clip(rows[:, 4] * height, 0, height)
+            x2 = np.clip(rows[:, 5] * width, 0, width)
+            y2 = np.clip(rows[:, 6] * height, 0, height)
+            boxes = np.round(np.stack([x1, y1, x2 - x1, y2 - y1], axis=1)).astype(int)
+            results.append(boxes[(boxes[:, 2] > 0) & (boxes[:, 3] > 0)])
+        return results
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                results = self.detect_batch([request[0] for request in batch], [request[3] for request in batch])
+            except Exception as err:
+                logger.exception("Batched face detection failed")
+                results = [err] * len(batch)
+            for request, result in zip(batch, results):
+                request[2] = result
+                request[1].set()
+
+
+DETECTORS = {
+    'haar': HaarDetector,
+    'ssd': SSDDetector,
+}
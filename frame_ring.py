@@ -0,0 +1,114 @@
+import logging
+from multiprocessing import shared_memory
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Layout: a small ring header, one header row per slot, then the slot buffers
+_RING_HEADER = np.dtype([('slots', '<u8'), ('slot_bytes', '<u8')])
+_SLOT_HEADER = np.dtype([('seq', '<u8'), ('timestamp', '<f8'),
+                         ('height', '<u4'), ('width', '<u4'), ('channels', '<u4'), ('pad', '<u4')])
+
+
+def _open(name):
+    try:
+        # Only the creator should unlink the segment when it goes away
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        return shared_memory.SharedMemory(name=name)
+
+
+class FrameRing:
+    """Ring of preallocated shared-memory frame slots for one camera.
+
+    The writer copies each frame into the next slot, overwriting the oldest
+    one, and hands `(slot, seq, timestamp)` to the consumer instead of the
+    frame. Readers in any process attach by `name` and get a read-only numpy
+    view of the slot, no copy involved. A slot carries the sequence number
+    of the frame in it and is zeroed while being rewritten, so a reader whose
+    frame was overwritten sees a mismatch: `read` returns None, and
+    `is_current` tells whether it changed while the view was in use.
+    """
+
+    def __init__(self, shm, owner):
+        self.shm = shm
+        self.name = shm.name
+        self._owner = owner
+        ring = np.ndarray((), _RING_HEADER, buffer=shm.buf)
+        self.slots = int(ring['slots'])
+        self.slot_bytes = int(ring['slot_bytes'])
+        self._headers = np.ndarray((self.slots,), _SLOT_HEADER, buffer=shm.buf, offset=_RING_HEADER.itemsize)
+        self._data_offset = _RING_HEADER.itemsize + self.slots * _SLOT_HEADER.itemsize
+        self._next_seq = 1
+
+    @classmethod
+    def create(cls, slots, frame_shape):
+        """Allocate a ring of `slots` slots for uint8 frames up to `frame_shape`."""
+        slot_bytes = int(np.prod(frame_shape))
+        size = _RING_HEADER.itemsize + slots * (_SLOT_HEADER.itemsize + slot_bytes)
+        shm = shared_memory.SharedMemory(create=True, size=size)
+        ring = np.ndarray((), _RING_HEADER, buffer=shm.buf)
+        ring['slots'] = slots
+        ring['slot_bytes'] = slot_bytes
+        del ring
+        np.ndarray((slots,), _SLOT_HEADER, buffer=shm.buf, offset=_RING_HEADER.itemsize).fill(0)
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name):
+        return cls(_open(name), owner=False)
+
+    def fits(self, frame):
+        return frame.dtype == np.uint8 and frame.size <= self.slot_bytes
+
+    def write(self, frame, timestamp):
+        """Copy a frame into the oldest slot, returns `(slot, seq)` to hand to readers."""
+        if not self.fits(frame):
+            raise ValueError(f"Frame of shape {frame.shape} does not fit a {self.slot_bytes} byte slot")
+        seq = self._next_seq
+        self._next_seq += 1
+        slot = seq % self.slots
+        header = self._headers[slot]
+        # Invalidate first so readers never take a half-written slot for the old frame
+        header['seq'] = 0
+        np.copyto(self._view(slot, frame.shape, writeable=True), frame)
+        height, width = frame.shape[:2]
+        header['height'], header['width'] = height, width
+        header['channels'] = frame.shape[2] if frame.ndim == 3 else 0
+        header['timestamp'] = timestamp
+        header['seq'] = seq
+        return slot, seq
+
+    def read(self, slot, seq):
+        """Return a read-only view of frame `seq`, or None if its slot has been reused."""
+        headers = self._headers
+        if headers is None or headers[slot]['seq'] != seq:
+            return None
+        header = headers[slot]
+        height, width, channels = int(header['height']), int(header['width']), int(header['channels'])
+        view = self._view(slot, (height, width, channels) if channels else (height, width))
+        return view if self.is_current(slot, seq) else None
+
+    def is_current(self, slot, seq):
+        headers = self._headers
+        return headers is not None and headers[slot]['seq'] == seq
+
+    def timestamp(self, slot):
+        return float(self._headers[slot]['timestamp'])
+
+    def close(self):
+        self._headers = None
+        try:
+            self.shm.close()
+        except BufferError:
+            # A frame view is still in use somewhere, the mapping goes away with it
+            logger.debug("Frame ring %s still has views, leaving it mapped", self.name)
+        if self._owner:
+            self.shm.unlink()
+
+    def _view(self, slot, shape, writeable=False):
+        offset = self._data_offset + slot * self.slot_bytes
+        view = np.ndarray(shape, np.uint8, buffer=self.shm.buf, offset=offset)
+        view.flags.writeable = writeable
+        return view
@@ -0,0 +1,205 @@
+"""Minimal Prometheus-style metrics with text exposition.
+
+Counters and histograms are updated in the hot path, so each labelled child
+only holds a small lock around a few additions. Values that already live
+elsewhere (queue depths, stream states) are read at scrape time through
+collectors registered with `REGISTRY.register_collector`.
+"""
+import bisect
+import threading
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _CounterChild:
+    __slots__ = ('_lock', 'value')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class _HistogramChild:
+    __slots__ = ('_lock', '_bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds):
+        self._lock = threading.Lock()
+        self._bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self._bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._children = {}
+
+    def labels(self, *values):
+        """Return the child for these label values, bind it once and reuse it in hot loops."""
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def remove(self, *values):
+        with self._lock:
+            self._children.pop(values, None)
+
+    def _items(self):
+        with self._lock:
+            return list(self._children.items())
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def samples(self):
+        for values, child in self._items():
+            yield self.name, dict(zip(self.labelnames, values)), child.value
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def samples(self):
+        for values, child in self._items():
+            labels = dict(zip(self.labelnames, values))
+            with child._lock:
+                counts, total, count = list(child.counts), child.sum, child.count
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                yield self.name + '_bucket', dict(labels, le=_format_value(float(bound))), cumulative
+            yield self.name + '_sum', labels, total
+            yield self.name + '_count', labels, count
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._add(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=Histogram.DEFAULT_BUCKETS):
+        return self._add(Histogram(name, documentation, labelnames, buckets))
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def register_collector(self, collector):
+        """`collector()` yields `(name, kind, documentation, [(labels, value), ...])` at scrape time."""
+        self._collectors.append(collector)
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+        for collector in self._collectors:
+            for name, kind, documentation, samples in collector():
+                lines.append(f'# HELP {name} {documentation}')
+                lines.append(f'# TYPE {name} {kind}')
+                for labels, value in samples:
+                    lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+def merge_expositions(expositions, label='worker'):
+    """Merge `(label_value, text)` expositions from several processes into one.
+
+    Every sample gets an extra label naming its source, and each family keeps
+    a single HELP/TYPE header so the result is still valid exposition text.
+    """
+    families = {}
+    for label_value, text in expositions:
+        extra = f'{label}="{_escape(label_value)}"'
+        family = None
+        for line in text.splitlines():
+            if line.startswith('# '):
+                _, kind, name, _ = (line.split(' ', 3) + [''])[:4]
+                family = families.setdefault(name, {"HELP": None, "TYPE": None, "samples": []})
+                family[kind] = family[kind] or line
+                continue
+            if not line or family is None:
+                continue
+            name, _, value = line.rpartition(' ')
+            if name.endswith('}'):
+                name = f'{name[:-1]},{extra}}}'
+            else:
+                name = f'{name}{{{extra}}}'
+            family["samples"].append(f'{name} {value}')
+
+    lines = []
+    for family in families.values():
+        lines.extend(header for header in (family["HELP"], family["TYPE"]) if header)
+        lines.extend(family["samples"])
+    return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+FRAMES_GRABBED = REGISTRY.counter('citra_frames_grabbed_total', "Frames read from the camera stream", ['camera'])
+FRAMES_SAMPLED = REGISTRY.counter('citra_frames_sampled_total', "Frames decoded and handed to detection", ['camera'])
+FRAMES_ANALYZED = REGISTRY.counter('citra_frames_analyzed_total', "Frames the face detector ran on", ['camera'])
+FRAMES_SKIPPED = REGISTRY.counter('citra_frames_skipped_total', "Frames skipped because the scene did not change", ['camera'])
+FRAMES_STALE = REGISTRY.counter('citra_frames_stale_total', "Frames overwritten in the shared frame ring before detection finished", ['camera'])
+FRAME_AGE = REGISTRY.histogram('citra_frame_age_seconds', "Age of a frame when detection picks it up", ['camera'])
+DETECTION_LATENCY = REGISTRY.histogram('citra_detection_seconds', "Time spent running the face detector on a frame", ['camera'])
+FACES_DETECTED = REGISTRY.counter('citra_faces_detected_total', "Faces found by the detector", ['camera'])
+DUPLICATE_HITS = REGISTRY.counter('citra_duplicate_crops_total', "Crops dropped because another camera of the event just uploaded the same face", ['camera'])
+DUPLICATE_MISSES = REGISTRY.counter('citra_duplicate_checks_passed_total', "Crops checked against the duplicate cache and kept", ['camera'])
+UPLOAD_LATENCY = REGISTRY.histogram('citra_upload_seconds', "Duration of upload requests to the detection API", ['camera'])
+UPLOAD_RESPONSES = REGISTRY.counter('citra_upload_responses_total', "Upload requests by HTTP status, 'error' when no response arrived", ['camera', 'status'])
+END_TO_END_LATENCY = REGISTRY.histogram('citra_end_to_end_seconds', "Time from frame capture until its uploads finished", ['camera'])
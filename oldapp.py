@@ -1,22 +1,92 @@
+import io
+import json
+import queue
+import threading
+import time
 import tkinter as tk
-from tkinter import messagebox, font, ttk
+from tkinter import filedialog, messagebox, font, ttk
 import requests
 import sqlite3
+from PIL import Image, ImageTk
+
+from camera_store import (PROFILE_ENTRIES, fetch_profile, fetch_roi, init_cameras_table, merge_profile,
+                          parse_profile_entries, profile_entry_texts, read_camera_file, save_cameras, save_profile,
+                          validate_cameras)
+from roi import parse_roi
+
+SERVER_URL = "http://localhost:5000"
+# Seconds a request to the server may take before it counts as failed
+REQUEST_TIMEOUT = 10
+# Width of the preview thumbnails and how often they are refreshed, in milliseconds
+PREVIEW_WIDTH = 320
+PREVIEW_REFRESH_MS = 2000
+
+# Live per-camera state from the server, by device_id
+camera_status = {}
+
+
+class BackgroundWorker:
+    """Runs database and network jobs away from the Tk main loop.
+
+    Jobs run one after another on a single thread that owns the only
+    database connection, as `job(conn)`. Results and errors are handed
+    to callbacks on the Tk thread, which picks them up in `poll`.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._jobs = queue.Queue()
+        self._callbacks = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="gui-worker", daemon=True)
+        self._thread.start()
+
+    def submit(self, job, on_done=None, on_error=None):
+        self._jobs.put((job, on_done, on_error))
+
+    def post(self, callback, *args):
+        """Run `callback(*args)` on the Tk thread, safe to call from any thread."""
+        self._callbacks.put((callback, args))
+
+    def poll(self, root):
+        while True:
+            try:
+                callback, args = self._callbacks.get_nowait()
+            except queue.Empty:
+                break
+            callback(*args)
+        root.after(50, self.poll, root)
+
+    def _run(self):
+        conn = sqlite3.connect(self.db_path)
+        while True:
+            job, on_done, on_error = self._jobs.get()
+            try:
+                result = job(conn)
+            except Exception as err:
+                if on_error is not None:
+                    self.post(on_error, err)
+                else:
+                    self.post(show_error, err)
+                continue
+            if on_done is not None:
+                self.post(on_done, result)
+
+
+def show_error(err):
+    if isinstance(err, requests.exceptions.HTTPError):
+        messagebox.showerror("Error", f"HTTP error occurred: {err}")
+    else:
+        messagebox.showerror("Error", f"Error occurred: {err}")
 
 # Initialize SQLite Database
-def init_db():
-    conn = sqlite3.connect('cameras.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS cameras (
-            id INTEGER PRIMARY KEY,
-            rtsp_url TEXT NOT NULL,
-            device_id TEXT NOT NULL,
-            event_id TEXT NOT NULL
-        )
-    ''')
-    conn.commit()
-    conn.close()
+def init_db(conn):
+    return init_cameras_table(conn)
+
+def show_merged_cameras(merged):
+    if merged:
+        messagebox.showwarning("Duplicate Cameras",
+                               "These cameras were saved more than once, only their latest entry was kept: "
+                               + ", ".join(merged))
 
 def register_camera():
     rtsp_url = rtsp_url_entry.get()
@@ -33,58 +103,156 @@ def register_camera():
         "event_id": event_id
     }
 
-    # Send POST request to the server
-    try:
-        response = requests.post("http://localhost:5000/register_camera", json=data)
+    def job(conn):
+        # Send POST request to the server
+        response = requests.post(f"{SERVER_URL}/register_camera", json=data, timeout=REQUEST_TIMEOUT)
         response.raise_for_status()  # This will raise an HTTPError if the HTTP request returned an unsuccessful status code
+        save_camera_to_db(conn, rtsp_url, device_id, event_id)
+        return fetch_cameras(conn)
 
-        if response.status_code == 200:
-            save_camera_to_db(rtsp_url, device_id, event_id)
-            messagebox.showinfo("Success", "Camera registered successfully!")
-            update_camera_table()
-    except requests.exceptions.HTTPError as err:
-        messagebox.showerror("Error", f"HTTP error occurred: {err}")
-    except requests.exceptions.RequestException as err:
-        messagebox.showerror("Error", f"Error occurred: {err}")
+    def done(rows):
+        messagebox.showinfo("Success", "Camera registered successfully!")
+        sync_camera_rows(rows)
 
-def save_camera_to_db(rtsp_url, device_id, event_id):
-    conn = sqlite3.connect('cameras.db')
-    cursor = conn.cursor()
-    cursor.execute('INSERT INTO cameras (rtsp_url, device_id, event_id) VALUES (?, ?, ?)',
-                   (rtsp_url, device_id, event_id))
-    conn.commit()
-    conn.close()
+    worker.submit(job, done)
+
+def save_camera_to_db(conn, rtsp_url, device_id, event_id):
+    save_cameras(conn, [{"rtsp_url": rtsp_url, "device_id": device_id, "event_id": event_id}])
 
-def fetch_cameras():
-    conn = sqlite3.connect('cameras.db')
+def import_cameras():
+    path = filedialog.askopenfilename(title="Import Cameras",
+                                      filetypes=[("Camera lists", "*.csv *.json"), ("All files", "*.*")])
+    if not path:
+        return
+
+    def job(conn):
+        cameras, errors, duplicates = validate_cameras(read_camera_file(path))
+        if not cameras:
+            raise ValueError(f"No valid cameras in {path}")
+        # One request for the whole list, the server starts them with staggered connects
+        response = requests.post(f"{SERVER_URL}/register_cameras", json=[camera for _, camera in cameras],
+                                 timeout=REQUEST_TIMEOUT * 3)
+        response.raise_for_status()
+        result = response.json()
+        registered = set(result['registered'])
+        save_cameras(conn, [camera for _, camera in cameras if camera['device_id'] in registered])
+        messages = [f"Registered {len(registered)} cameras."]
+        if duplicates:
+            messages.append(f"Listed more than once, last entry used: {', '.join(sorted(set(duplicates)))}")
+        # The server numbers its errors by position in the list it was sent
+        errors += [dict(error, index=cameras[error['index']][0]) for error in result['errors']]
+        for error in sorted(errors, key=lambda error: error['index']):
+            messages.append(f"Row {error['index'] + 1} ({error['device_id'] or '-'}): {error['message']}")
+        return "\n".join(messages), fetch_cameras(conn)
+
+    def done(result):
+        message, rows = result
+        sync_camera_rows(rows)
+        messagebox.showinfo("Import Cameras", message)
+
+    worker.submit(job, done)
+
+def fetch_cameras(conn):
     cursor = conn.cursor()
     cursor.execute('SELECT id, rtsp_url, device_id, event_id FROM cameras')
-    rows = cursor.fetchall()
-    conn.close()
-    return rows
+    return cursor.fetchall()
 
 def get_thread_count():
-    try:
-        response = requests.get("http://localhost:5000/active_threads")
+    def job(conn):
+        response = requests.get(f"{SERVER_URL}/active_threads", timeout=REQUEST_TIMEOUT)
         response.raise_for_status()
         thread_count = response.json().get('active_threads')
-        messagebox.showinfo("Active Threads", f"Number of active threads: {thread_count}")
-    except requests.exceptions.RequestException as e:
-        messagebox.showerror("Error", f"An error occurred: {e}")
+
+        # Summarise the streams as well, the thread count alone says little
+        response = requests.get(f"{SERVER_URL}/streams", timeout=REQUEST_TIMEOUT)
+        response.raise_for_status()
+        streams = response.json().get('streams', [])
+        states = {}
+        for stream in streams:
+            states[stream['state']] = states.get(stream['state'], 0) + 1
+        summary = ", ".join(f"{count} {state}" for state, count in sorted(states.items())) or "none"
+        return (f"Number of active threads: {thread_count}\n"
+                f"Streams ({len(streams)}): {summary}\n"
+                f"Full per-camera statistics: {SERVER_URL}/metrics")
+
+    worker.submit(job, lambda text: messagebox.showinfo("Active Threads", text))
 
 def update_camera_table():
-    for row in camera_table.get_children():
-        camera_table.delete(row)
-    for row in fetch_cameras():
-        camera_table.insert('', 'end', values=row)
+    worker.submit(fetch_cameras, sync_camera_rows)
+
+def sync_camera_rows(rows):
+    """Bring the table in line with the database rows, touching only rows that changed."""
+    wanted = {str(row[0]): row for row in rows}
+    for item in camera_table.get_children():
+        if item not in wanted:
+            camera_table.delete(item)
+    for item, row in wanted.items():
+        values = tuple(row) + status_columns(row[2])
+        if camera_table.exists(item):
+            if tuple(camera_table.item(item, 'values')) != tuple(str(v) for v in values):
+                camera_table.item(item, values=values)
+        else:
+            camera_table.insert('', 'end', iid=item, values=values)
+
+def status_columns(device_id):
+    status = camera_status.get(device_id)
+    if status is None:
+        return ("not running", "-", "-")
+    fps = "-" if status.get('fps') is None else f"{status['fps']:.1f}"
+    last_detection = status.get('last_detection')
+    last_detection = time.strftime('%H:%M:%S', time.localtime(last_detection)) if last_detection else "-"
+    return (status['state'], fps, last_detection)
+
+def apply_stream_updates(rows, removed=(), replace=False):
+    if replace:
+        # A snapshot or a lost connection, forget cameras it does not mention
+        removed = set(camera_status) - {row['device_id'] for row in rows}
+    for row in rows:
+        camera_status[row['device_id']] = row
+    for device_id in removed:
+        camera_status.pop(device_id, None)
+    changed = {row['device_id'] for row in rows} | set(removed)
+    for item in camera_table.get_children():
+        device_id = camera_table.set(item, "Device ID")
+        if device_id in changed:
+            for column, value in zip(STATUS_COLUMNS, status_columns(device_id)):
+                camera_table.set(item, column, value)
+
+def watch_streams():
+    """Follow the server's live stream events on a thread of its own, reconnecting when it drops."""
+    while True:
+        try:
+            with requests.get(f"{SERVER_URL}/streams/live", stream=True, timeout=(REQUEST_TIMEOUT, 30)) as response:
+                response.raise_for_status()
+                event, data = None, []
+                for line in response.iter_lines(decode_unicode=True):
+                    if line.startswith('event:'):
+                        event = line[len('event:'):].strip()
+                    elif line.startswith('data:'):
+                        data.append(line[len('data:'):].strip())
+                    elif not line and data:
+                        payload = json.loads('\n'.join(data))
+                        if event == 'snapshot':
+                            worker.post(apply_stream_updates, payload, (), True)
+                        elif event == 'update':
+                            worker.post(apply_stream_updates, payload)
+                        elif event == 'remove':
+                            worker.post(apply_stream_updates, [], payload)
+                        event, data = None, []
+        except (requests.exceptions.RequestException, ValueError):
+            pass
+        # The server is down or restarting, show that and try again shortly
+        worker.post(apply_stream_updates, [], (), True)
+        time.sleep(2)
 
 
 def edit_camera():
     # Get selected item to edit
-    selected_item = camera_table.selection()[0]
-    if not selected_item:
+    selection = camera_table.selection()
+    if not selection:
         messagebox.showinfo("Info", "Please select a camera to edit.")
         return
+    selected_item = selection[0]
     camera = camera_table.item(selected_item, 'values')
 
     # Open a new window to edit the item
@@ -107,41 +275,156 @@ def edit_camera():
     event_id_entry = ttk.Entry(edit_window, textvariable=event_id_var)
     event_id_entry.grid(row=2, column=1)
 
+    # Regions to look for faces in, filled in once read from the database
+    ttk.Label(edit_window, text="ROI:").grid(row=3, column=0)
+    roi_var = tk.StringVar()
+    roi_entry = ttk.Entry(edit_window, textvariable=roi_var, width=40)
+    roi_entry.grid(row=3, column=1)
+    ttk.Label(edit_window, text="[[x, y, w, h], [[x, y], [x, y], [x, y]], ...] as fractions of the frame, "
+                                "empty for the whole frame").grid(row=4, column=0, columnspan=2)
+
+    # Detection profile, empty entries use the server's defaults
+    profile_vars = {}
+    for row, (key, label, _) in enumerate(PROFILE_ENTRIES, start=5):
+        ttk.Label(edit_window, text=f"{label}:").grid(row=row, column=0)
+        profile_vars[key] = tk.StringVar()
+        ttk.Entry(edit_window, textvariable=profile_vars[key], width=40).grid(row=row, column=1)
+
+    # What the profile entries started with, only the entries changed from it are saved
+    initial_texts = {}
+
+    def fill(stored):
+        roi, profile = stored
+        roi_var.set(roi or '')
+        initial_texts.update(profile_entry_texts(profile))
+        for key, var in profile_vars.items():
+            var.set(initial_texts[key])
+
+    worker.submit(lambda conn: (fetch_roi(conn, camera[2]), fetch_profile(conn, camera[2])), fill)
+
     # Save button
-    save_button = ttk.Button(edit_window, text="Save", command=lambda: save_changes(selected_item, rtsp_url_var.get(), device_id_var.get(), event_id_var.get(), edit_window))
-    save_button.grid(row=3, column=0, columnspan=2)
+    save_button = ttk.Button(edit_window, text="Save", command=lambda: save_changes(selected_item, rtsp_url_var.get(), device_id_var.get(), event_id_var.get(), roi_var.get(), {key: var.get() for key, var in profile_vars.items()}, initial_texts, edit_window))
+    save_button.grid(row=5 + len(PROFILE_ENTRIES), column=0, columnspan=2)
 
-def save_changes(selected_item, rtsp_url, device_id, event_id, edit_window):
-    # Update the table
-    camera_table.item(selected_item, values=(camera_table.item(selected_item, "values")[0], rtsp_url, device_id, event_id))
+def save_changes(selected_item, rtsp_url, device_id, event_id, roi, profile_texts, initial_texts, edit_window):
+    try:
+        parse_roi(roi)
+        profile = parse_profile_entries(profile_texts, initial_texts)
+    except ValueError as err:
+        messagebox.showwarning("Warning", str(err))
+        return
+
+    # Update the row in place
+    previous = camera_table.item(selected_item, "values")
+    camera_id = previous[0]
+    values = (camera_id, rtsp_url, device_id, event_id)
+    camera_table.item(selected_item, values=values + status_columns(device_id))
+
+    def job(conn):
+        # Update the database, the ROI applies the next time the camera is started
+        try:
+            update_db_with_changes(conn, values, roi.strip())
+        except sqlite3.IntegrityError:
+            conn.rollback()
+            raise
+        save_profile(conn, device_id, merge_profile(fetch_profile(conn, device_id), profile))
+
+        if not profile:
+            return "Camera saved."
+        # The profile goes to the running camera right away, without reconnecting it.
+        # A renamed camera keeps running under its old device ID until it is started again.
+        response = requests.put(f"{SERVER_URL}/cameras/{previous[2]}/profile", json=profile, timeout=REQUEST_TIMEOUT)
+        if response.status_code == 404:
+            return "Camera saved. It is not running, the profile applies once it is started."
+        response.raise_for_status()
+        if response.json().get('restarted'):
+            return "Camera saved, it reconnects to apply the new profile."
+        return "Camera saved and the profile applied to the running camera."
 
-    # Update the database
-    update_db_with_changes(camera_table.item(selected_item, "values"))
+    def failed(err):
+        if not isinstance(err, sqlite3.IntegrityError):
+            show_error(err)
+            return
+        # device_id is unique, nothing was saved so the row goes back to what it was
+        if camera_table.exists(selected_item):
+            camera_table.item(selected_item, values=previous)
+        messagebox.showwarning("Warning", f"Another camera already uses device ID {device_id}.")
+
+    worker.submit(job, lambda message: messagebox.showinfo("Success", message), failed)
 
     # Close the edit window
     edit_window.destroy()
 
-    # Update the camera table view
-    update_camera_table()
-
-def update_db_with_changes(values):
-    # Connect to the database
-    conn = sqlite3.connect('cameras.db')
+def update_db_with_changes(conn, values, roi):
     cursor = conn.cursor()
     
     # Update the camera record
-    cursor.execute('UPDATE cameras SET rtsp_url = ?, device_id = ?, event_id = ? WHERE id = ?', (values[1], values[2], values[3], values[0]))
+    cursor.execute('UPDATE cameras SET rtsp_url = ?, device_id = ?, event_id = ?, roi = ? WHERE id = ?', (values[1], values[2], values[3], roi, values[0]))
     conn.commit()
-    conn.close()
     
 def check_camera_status():
     selected_item = camera_table.focus()
     if not selected_item:
         messagebox.showinfo("Info", "Please select a camera to check.")
         return
-    camera = camera_table.item(selected_item)['values']
-    # Implement camera status check logic here
-    messagebox.showinfo("Status", f"Status check for camera {camera[2]} not implemented.")
+    device_id = camera_table.set(selected_item, "Device ID")
+    status = camera_status.get(device_id)
+    if status is None:
+        messagebox.showinfo("Status", f"Camera {device_id} is not running on the server.")
+        return
+    state, fps, last_detection = status_columns(device_id)
+    details = [f"State: {state}", f"Frames read per second: {fps}", f"Last detection: {last_detection}",
+               f"Sampled for detection: {status.get('sample_fps') or '-'} per second",
+               f"Reconnects: {status.get('reconnects', 0)}"]
+    if status.get('last_error'):
+        details.append(f"Last error: {status['last_error']}")
+    messagebox.showinfo("Status", f"Camera {device_id}\n" + "\n".join(details))
+
+def show_preview():
+    selected_item = camera_table.focus()
+    if not selected_item:
+        messagebox.showinfo("Info", "Please select a camera to preview.")
+        return
+    device_id = camera_table.set(selected_item, "Device ID")
+
+    # The server sends the frame it already holds, no second connection to the camera
+    preview_window = tk.Toplevel(root)
+    preview_window.title(f"Preview {device_id}")
+    preview_label = ttk.Label(preview_window, text="Waiting for a frame...")
+    preview_label.pack(padx=10, pady=10)
+
+    def job(conn):
+        response = requests.get(f"{SERVER_URL}/snapshot/{device_id}", params={"width": PREVIEW_WIDTH},
+                                timeout=REQUEST_TIMEOUT)
+        if response.status_code in (404, 503):
+            return response.json().get('message')
+        response.raise_for_status()
+        image = Image.open(io.BytesIO(response.content))
+        image.load()
+        return image
+
+    def done(result):
+        if not preview_window.winfo_exists():
+            return
+        if isinstance(result, str):
+            preview_label.configure(text=result, image='')
+        else:
+            photo = ImageTk.PhotoImage(result)
+            preview_label.configure(image=photo, text='')
+            # Tk does not hold on to the image itself
+            preview_label.image = photo
+        preview_window.after(PREVIEW_REFRESH_MS, refresh)
+
+    def failed(err):
+        if preview_window.winfo_exists():
+            preview_label.configure(text=f"Error occurred: {err}", image='')
+            preview_window.after(PREVIEW_REFRESH_MS, refresh)
+
+    def refresh():
+        if preview_window.winfo_exists():
+            worker.submit(job, done, failed)
+
+    refresh()
 
 def set_window_size(root):
     screen_width = root.winfo_screenwidth()
@@ -162,24 +445,28 @@ def connect_to_camera():
 
     data = {
         "rtsp_url": rtsp_url,
-        "device_id": device_id,
-        "event_id": event_id
+        "device_id": str(device_id),
+        "event_id": str(event_id)
     }
 
-    try:
-        response = requests.post("http://localhost:5000/start_processing", json=data)
+    def job(conn):
+        roi = fetch_roi(conn, data['device_id'])
+        if roi:
+            data['roi'] = roi
+        profile = fetch_profile(conn, data['device_id'])
+        if profile:
+            data['profile'] = profile
+        response = requests.post(f"{SERVER_URL}/start_processing", json=data, timeout=REQUEST_TIMEOUT)
         response.raise_for_status()
+        return response.json().get('message', 'Started processing the stream')
 
-        if response.status_code == 200:
-            messagebox.showinfo("Success", response.json().get('message', 'Started processing the stream'))
-    except requests.exceptions.HTTPError as err:
-        messagebox.showerror("Error", f"HTTP error occurred: {err}")
-    except requests.exceptions.RequestException as err:
-        messagebox.showerror("Error", f"Error occurred: {err}")
+    worker.submit(job, lambda message: messagebox.showinfo("Success", message))
 
 
 # UI Design
 root = tk.Tk()
+worker = BackgroundWorker('cameras.db')
+worker.submit(init_db, show_merged_cameras)
 root.title("CITRA Event Manager")
 
 style = ttk.Style(root)
@@ -240,7 +527,8 @@ table_frame['borderwidth'] = 2
 table_frame['relief'] = 'ridge'
 
 #Camera Table
-columns = ("ID", "RTSP URL", "Device ID", "Event ID")
+STATUS_COLUMNS = ("State", "FPS", "Last Detection")
+columns = ("ID", "RTSP URL", "Device ID", "Event ID") + STATUS_COLUMNS
 camera_table = ttk.Treeview(table_frame, columns=columns, show='headings', height=5)
 for col in columns:
     camera_table.heading(col, text=col)
@@ -276,13 +564,29 @@ root.geometry('800x600') # Width x Height
 edit_button = ttk.Button(buttons_frame, text="Edit Camera", command=edit_camera)
 edit_button.grid(row=0, column=2, padx=10, pady=20, sticky="ew")
 
+# Camera status button
+status_button = ttk.Button(buttons_frame, text="Camera Status", command=check_camera_status)
+status_button.grid(row=0, column=3, padx=10, pady=20, sticky="ew")
+
+# Bulk import button
+import_button = ttk.Button(buttons_frame, text="Import Cameras", command=import_cameras)
+import_button.grid(row=0, column=4, padx=10, pady=20, sticky="ew")
+
+# Preview button
+preview_button = ttk.Button(buttons_frame, text="Preview", command=show_preview)
+preview_button.grid(row=0, column=5, padx=10, pady=20, sticky="ew")
+
 # Make the layout responsive
-for i in range(3):  # Update to the number of buttons you have
+for i in range(6):  # Update to the number of buttons you have
     buttons_frame.grid_columnconfigure(i, weight=1)
     registration_frame.grid_columnconfigure(i, weight=1)
 
 table_frame.grid_rowconfigure(0, weight=1)
 table_frame.grid_columnconfigure(0, weight=1)
 
+# Pick up results of background jobs and follow the live camera states
+worker.poll(root)
+threading.Thread(target=watch_streams, name="stream-watcher", daemon=True).start()
+
 # Run the application
 root.mainloop()
\ No newline at end of file
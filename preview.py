@@ -0,0 +1,65 @@
+import threading
+
+import cv2
+
+
+def encode_jpeg(frame, width=0, quality=70):
+    """JPEG bytes of `frame`, scaled down to `width` pixels wide if it is wider (0 keeps its size)."""
+    height, frame_width = frame.shape[:2]
+    if width and frame_width > width:
+        frame = cv2.resize(frame, (width, round(height * width / frame_width)), interpolation=cv2.INTER_AREA)
+    ok, jpeg = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok:
+        raise RuntimeError("Unable to encode the frame as JPEG")
+    return jpeg.tobytes()
+
+
+class _Encoded:
+    def __init__(self, seq):
+        self.seq = seq
+        self.lock = threading.Lock()
+        self.images = {}
+
+
+class PreviewCache:
+    """JPEG encodes of each camera's latest frame, shared by every viewer.
+
+    An encode is kept per frame sequence number and size/quality pair, so
+    any number of snapshot and preview clients cost one encode per new
+    frame. Viewers asking for a frame that is being encoded wait for it
+    instead of encoding it again.
+    """
+
+    def __init__(self, width=640, quality=70):
+        self.width = width
+        self.quality = quality
+        self.encodes = 0
+        self.hits = 0
+
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def jpeg(self, device_id, seq, frame, width=None, quality=None):
+        width = self.width if width is None else width
+        quality = self.quality if quality is None else quality
+        if not 0 <= width <= 10000 or not 1 <= quality <= 100:
+            raise ValueError("width must be between 0 and 10000 and quality between 1 and 100")
+        with self._lock:
+            entry = self._entries.get(device_id)
+            if entry is None or entry.seq != seq:
+                entry = self._entries[device_id] = _Encoded(seq)
+        with entry.lock:
+            image = entry.images.get((width, quality))
+            if image is None:
+                image = entry.images[(width, quality)] = encode_jpeg(frame, width, quality)
+                self.encodes += 1
+            else:
+                self.hits += 1
+            return image
+
+    def discard(self, device_id):
+        with self._lock:
+            self._entries.pop(device_id, None)
+
+    def stats(self):
+        return {"encodes": self.encodes, "hits": self.hits}
@@ -0,0 +1,231 @@
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+CONNECTING = 'connecting'
+RUNNING = 'running'
+BACKOFF = 'backoff'
+STOPPED = 'stopped'
+
+
+class ManagedStream:
+    """Lifecycle state of one camera pipeline, owned by a `StreamRegistry`."""
+
+    # Options that only take effect on a new connection, None for all of them
+    restart_options = None
+
+    def __init__(self, rtsp_url, device_id, event_id, options):
+        self.rtsp_url = rtsp_url
+        self.device_id = device_id
+        self.event_id = event_id
+        self.options = options
+
+        self.state = STOPPED
+        self.state_since = time.time()
+        self.connects = 0
+        self.reconnects = 0
+        self.last_error = None
+        # Wall-clock time the stream last went live
+        self.live_since = None
+        # Set by the pipeline while it runs so the registry can interrupt it
+        self.capture = None
+
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread = None
+        # Set when the stream is started again before its thread finished stopping
+        self._resume = False
+
+    @property
+    def stopping(self):
+        return self._stop.is_set()
+
+    @property
+    def restart_requested(self):
+        """Whether the connection being made or run has to be reopened, e.g. for new options."""
+        return self._wake.is_set()
+
+    def set_state(self, state, error=None):
+        self.state = state
+        self.state_since = time.time()
+        if state == RUNNING:
+            self.live_since = self.state_since
+        if error is not None:
+            self.last_error = error
+
+    def configure(self, rtsp_url, event_id, options):
+        self.rtsp_url = rtsp_url
+        self.event_id = event_id
+        self.options = options
+
+    def needs_restart(self, rtsp_url, options):
+        """Whether moving to this configuration needs the camera to be reconnected."""
+        if rtsp_url != self.rtsp_url:
+            return True
+        if self.restart_options is None:
+            return options != self.options
+        return any(options.get(key) != self.options.get(key) for key in self.restart_options)
+
+    def _interrupt(self):
+        self._wake.set()
+        capture = self.capture
+        if capture is not None:
+            capture.stop()
+
+    def describe(self):
+        return {
+            "device_id": self.device_id,
+            "rtsp_url": self.rtsp_url,
+            "event_id": self.event_id,
+            "state": self.state,
+            "state_since": self.state_since,
+            "connects": self.connects,
+            "reconnects": self.reconnects,
+            "live_since": self.live_since,
+            "last_error": self.last_error,
+        }
+
+
+class StreamRegistry:
+    """Keeps exactly one pipeline per device_id and reconnects it when it drops.
+
+    `run_stream(stream)` runs a pipeline on the stream's own thread until the
+    camera disconnects or `stream.capture` is stopped. It should call
+    `stream.set_state(RUNNING)` once frames flow. Failed or dropped streams
+    are retried with jittered exponential backoff, which starts over after a
+    stream made it to RUNNING.
+    """
+
+    def __init__(self, run_stream, stream_factory=ManagedStream, initial_backoff=1.0, max_backoff=60.0):
+        self.run_stream = run_stream
+        self.stream_factory = stream_factory
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self._lock = threading.Lock()
+        self._streams = {}
+
+    def start(self, rtsp_url, device_id, event_id, options):
+        """Start a camera, or update it if it is already known.
+
+        Returns True when a pipeline was started, False when one was already
+        live. A live pipeline whose configuration changed is reconfigured in
+        place, and restarted only if `needs_restart` says so. One waiting
+        out a backoff retries immediately. A stream still stopping, e.g.
+        stuck connecting, is handed back to its thread once that finishes,
+        so this never waits for a pipeline to end.
+        """
+        with self._lock:
+            stream = self._streams.get(device_id)
+            if stream is None:
+                stream = self._streams[device_id] = self.stream_factory(rtsp_url, device_id, event_id, options)
+            elif stream._thread is not None and stream._thread.is_alive() and not stream.stopping:
+                changed = (stream.rtsp_url, stream.event_id, stream.options) != (rtsp_url, event_id, options)
+                if changed:
+                    restart = stream.needs_restart(rtsp_url, options)
+                    stream.configure(rtsp_url, event_id, options)
+                    if restart:
+                        stream._interrupt()
+                elif stream.state == BACKOFF:
+                    stream._wake.set()
+                return False
+            elif stream._thread is not None and stream._thread.is_alive():
+                stream.configure(rtsp_url, event_id, options)
+                stream._resume = True
+                return True
+            else:
+                stream.configure(rtsp_url, event_id, options)
+
+            stream._stop.clear()
+            stream._wake.clear()
+            stream.set_state(CONNECTING)
+            stream._thread = threading.Thread(target=self._supervise, args=(stream,),
+                                              name=f"stream-{device_id}", daemon=True)
+            stream._thread.start()
+            return True
+
+    def stop(self, device_id, wait=True):
+        with self._lock:
+            stream = self._streams.get(device_id)
+            if stream is None:
+                return False
+            stream._resume = False
+            stream._stop.set()
+            thread = stream._thread
+        stream._interrupt()
+        if wait and thread is not None and thread is not threading.current_thread():
+            thread.join()
+        return True
+
+    def remove(self, device_id, wait=True):
+        """Stop a camera and forget it, e.g. because it moved elsewhere."""
+        stopped = self.stop(device_id, wait)
+        with self._lock:
+            self._streams.pop(device_id, None)
+        return stopped
+
+    def stop_all(self):
+        for device_id in list(self._streams):
+            self.stop(device_id)
+
+    def get(self, device_id):
+        with self._lock:
+            return self._streams.get(device_id)
+
+    def configuration(self, device_id):
+        """`(rtsp_url, event_id, options)` of a camera that is not stopped, otherwise None."""
+        stream = self.get(device_id)
+        if stream is None or stream.stopping:
+            return None
+        return stream.rtsp_url, stream.event_id, stream.options
+
+    def streams(self):
+        with self._lock:
+            return list(self._streams.values())
+
+    def snapshot(self):
+        return [stream.describe() for stream in self.streams()]
+
+    def _supervise(self, stream):
+        failures = 0
+        while True:
+            while not stream.stopping:
+                stream.set_state(CONNECTING)
+                stream.capture = None
+                stream.connects += 1
+                try:
+                    self.run_stream(stream)
+                except Exception as err:
+                    logger.exception("Pipeline for device %s crashed", stream.device_id)
+                    stream.last_error = str(err)
+                stream.capture = None
+                if stream.stopping:
+                    break
+
+                # A stream that got going starts its backoff over
+                failures = 1 if stream.state == RUNNING else failures + 1
+                if stream._wake.is_set():
+                    # Restart requested (e.g. new configuration), reconnect right away
+                    stream._wake.clear()
+                    delay = 0
+                else:
+                    delay = min(self.max_backoff, self.initial_backoff * 2 ** (failures - 1))
+                    delay *= random.uniform(0.5, 1.0)
+                stream.set_state(BACKOFF)
+                stream.reconnects += 1
+                logger.warning("Stream for device %s dropped, reconnecting in %.1fs", stream.device_id, delay)
+                stream._wake.wait(delay)
+                stream._wake.clear()
+
+            with self._lock:
+                if not stream._resume:
+                    stream.set_state(STOPPED)
+                    stream._thread = None
+                    return
+                # Started again while stopping, run the new configuration on this thread
+                stream._resume = False
+                stream._stop.clear()
+                stream._wake.clear()
+                failures = 0
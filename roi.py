@@ -0,0 +1,75 @@
+import json
+
+import cv2
+import numpy as np
+
+
+def parse_roi(value):
+    """Validate a camera's regions of interest, given as a list or as its JSON text.
+
+    Each region is a rectangle `[x, y, w, h]` or a polygon `[[x, y], [x, y],
+    [x, y], ...]`, in fractions of the frame width and height so they hold
+    at any resolution. Returns the regions as lists of `[x, y]` corners, or
+    None when the whole frame should be scanned.
+    """
+    if isinstance(value, str):
+        try:
+            value = json.loads(value) if value.strip() else None
+        except json.JSONDecodeError as err:
+            raise ValueError(f"roi is not valid JSON: {err}")
+    if not value:
+        return None
+    if not isinstance(value, list):
+        raise ValueError("roi must be a list of rectangles or polygons")
+    regions = []
+    for region in value:
+        try:
+            if len(region) == 4 and all(isinstance(v, (int, float)) for v in region):
+                x, y, w, h = (float(v) for v in region)
+                points = [[x, y], [x + w, y], [x + w, y + h], [x, y + h]]
+            else:
+                points = [[float(px), float(py)] for px, py in region]
+        except (TypeError, ValueError):
+            raise ValueError(f"Invalid roi region {region!r}, expected [x, y, w, h] or a list of [x, y] points")
+        if len(points) < 3 or not all(0 <= v <= 1 for point in points for v in point):
+            raise ValueError(f"Invalid roi region {region!r}, coordinates are fractions of the frame between 0 and 1")
+        regions.append(points)
+    return regions
+
+
+def roi_rects(regions, width, height):
+    """Bounding rectangles of the regions in pixels, overlapping ones merged into one."""
+    rects = []
+    for points in regions:
+        corners = np.array(points) * (width, height)
+        x1, y1 = (int(v) for v in np.floor(corners.min(axis=0)))
+        x2, y2 = (int(v) for v in np.ceil(corners.max(axis=0)))
+        if x2 > x1 and y2 > y1:
+            rects.append([x1, y1, min(x2, width), min(y2, height)])
+
+    # Merge until no two rectangles overlap, so no part of the frame is scanned twice
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(rects)):
+            for j in range(i + 1, len(rects)):
+                a, b = rects[i], rects[j]
+                if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                    rects[i] = [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+                    del rects[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return [(x1, y1, x2 - x1, y2 - y1) for x1, y1, x2, y2 in rects]
+
+
+def inside_roi(regions, boxes, width, height):
+    """Keep the boxes whose centre lies within one of the regions."""
+    if not len(boxes):
+        return boxes
+    polygons = [(np.array(points) * (width, height)).astype(np.float32) for points in regions]
+    keep = [any(cv2.pointPolygonTest(polygon, (float(x + w / 2), float(y + h / 2)), False) >= 0
+                for polygon in polygons)
+            for x, y, w, h in boxes]
+    return boxes[np.array(keep, dtype=bool)]
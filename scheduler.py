@@ -0,0 +1,159 @@
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def fair_shares(demands, capacity):
+    """Split `capacity` max-min fairly: nobody gets more than asked, the rest is shared equally."""
+    shares = {}
+    remaining = capacity
+    pending = sorted(demands.items(), key=lambda item: item[1])
+    while pending:
+        level = remaining / len(pending)
+        key, demand = pending[0]
+        if demand > level:
+            # Everybody left wants more than an equal split
+            for key, _ in pending:
+                shares[key] = level
+            return shares
+        shares[key] = demand
+        remaining -= demand
+        pending.pop(0)
+    return shares
+
+
+class SamplingScheduler:
+    """Sets the sampling rate of every camera from its recent activity, within a global budget.
+
+    A camera's activity jumps to 1 when faces are found and to 0.5 on motion,
+    then halves every `half_life` seconds. Its wanted rate lies between its
+    `min_sample_fps` and `max_sample_fps` in proportion to its activity.
+    Every `interval` seconds the wanted rates are fitted into the budget:
+    each camera first gets its minimum, the rest is shared max-min fairly so
+    busy cameras get more without starving quiet ones. The budget is
+    `budget_fps` frames per second, and with `cpu_budget` set it is also
+    lowered while this process uses more than that percentage of the
+    machine's CPU.
+    """
+
+    def __init__(self, streams, budget_fps=0.0, cpu_budget=0.0, interval=1.0, half_life=30.0):
+        self.streams = streams
+        self.budget_fps = budget_fps
+        self.cpu_budget = cpu_budget
+        self.interval = interval
+        self.half_life = half_life
+
+        self._lock = threading.Lock()
+        self._activity = {}
+        self._rates = {}
+        self._wanted_total = 0.0
+        self._cpu_limit = None
+        self._cpu_percent = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="sampling-scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def record(self, device_id, motion, faces):
+        """Feed the outcome of one sample: whether the scene moved and how many faces were found."""
+        now = time.monotonic()
+        with self._lock:
+            activity = self._decayed(device_id, now)
+            if faces:
+                activity = 1.0
+            elif motion:
+                activity = max(activity, 0.5)
+            self._activity[device_id] = (activity, now)
+
+    def rate(self, stream):
+        """The rate a camera should sample at right now."""
+        with self._lock:
+            return self._rates.get(stream.device_id, stream.options['max_sample_fps'])
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            return {
+                device_id: {"sample_fps": round(rate, 3), "activity": round(self._decayed(device_id, now), 3)}
+                for device_id, rate in self._rates.items()
+            }
+
+    def rebalance(self):
+        streams = [stream for stream in self.streams() if stream.capture is not None]
+        now = time.monotonic()
+        with self._lock:
+            wanted = {}
+            minimums = {}
+            for stream in streams:
+                low, high = stream.options['min_sample_fps'], stream.options['max_sample_fps']
+                minimums[stream.device_id] = low
+                wanted[stream.device_id] = low + (high - low) * self._decayed(stream.device_id, now)
+            self._activity = {device_id: self._activity[device_id] for device_id in wanted
+                              if device_id in self._activity}
+
+            self._wanted_total = sum(wanted.values())
+            budget = self._budget()
+            if budget is None or sum(wanted.values()) <= budget:
+                rates = wanted
+            elif sum(minimums.values()) >= budget:
+                # Not even the minimums fit, scale them down alike
+                scale = budget / sum(minimums.values())
+                rates = {device_id: low * scale for device_id, low in minimums.items()}
+            else:
+                extra = fair_shares({device_id: wanted[device_id] - minimums[device_id] for device_id in wanted},
+                                    budget - sum(minimums.values()))
+                rates = {device_id: minimums[device_id] + extra[device_id] for device_id in wanted}
+            self._rates = rates
+
+        for stream in streams:
+            rate = rates.get(stream.device_id)
+            capture = stream.capture
+            if rate is not None and capture is not None:
+                capture.sample_interval = 1.0 / rate
+
+    def _budget(self):
+        budgets = [limit for limit in (self.budget_fps, self._cpu_limit) if limit]
+        return min(budgets) if budgets else None
+
+    def _decayed(self, device_id, now):
+        # Caller holds the lock
+        activity, since = self._activity.get(device_id, (0.0, now))
+        return activity * 0.5 ** ((now - since) / self.half_life)
+
+    def _update_cpu_limit(self, cpu_percent):
+        allocated = sum(self._rates.values())
+        if not allocated:
+            return
+        # Smooth the measurement so one busy second does not swing every rate
+        self._cpu_percent = cpu_percent if self._cpu_percent is None else (self._cpu_percent + cpu_percent) / 2
+        ratio = self.cpu_budget / max(self._cpu_percent, 1e-6)
+        if ratio < 1.0:
+            self._cpu_limit = allocated * max(ratio, 0.5)
+        elif self._cpu_limit is not None and ratio > 1.1:
+            # Creep back up, and drop the limit once every camera would get what it wants
+            self._cpu_limit *= min(ratio, 1.2)
+            if self._cpu_limit >= self._wanted_total:
+                self._cpu_limit = None
+
+    def _run(self):
+        cores = os.cpu_count() or 1
+        last_cpu, last_wall = time.process_time(), time.monotonic()
+        while not self._stop.wait(self.interval):
+            if self.cpu_budget:
+                cpu, wall = time.process_time(), time.monotonic()
+                self._update_cpu_limit((cpu - last_cpu) / (wall - last_wall) / cores * 100)
+                last_cpu, last_wall = cpu, wall
+            try:
+                self.rebalance()
+            except Exception:
+                logger.exception("Rebalancing sample rates failed")
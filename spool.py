@@ -0,0 +1,188 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class SpoolEntry:
+    __slots__ = ('id', 'device_id', 'data', 'images', 'attempts', 'captured_at')
+
+    def __init__(self, id, device_id, data, images, attempts, captured_at=None):
+        self.id = id
+        self.device_id = device_id
+        self.data = data
+        self.images = images
+        self.attempts = attempts
+        # Wall-clock time the frame was captured, survives restarts unlike time.monotonic()
+        self.captured_at = captured_at
+
+
+class UploadSpool:
+    """Durable queue of pending uploads in an SQLite WAL database.
+
+    Each row is one request: form fields plus the JPEG bytes of its images.
+    Rows are claimed oldest first in bulk, acknowledged once sent, or put
+    back with a retry time. The spool is capped by size, row count and age,
+    and the oldest rows are evicted first when a cap is hit.
+    """
+
+    def __init__(self, path, max_bytes=512 * 2**20, max_rows=100000, max_age=24 * 3600, expiry_interval=60.0):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_rows = max_rows
+        self.max_age = max_age
+        self.expiry_interval = expiry_interval
+        self.evicted = 0
+        self._expiry_checked = 0.0
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        # Losing the last few rows on power loss is fine, an fsync per detection is not
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS upload_spool (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                created_at REAL NOT NULL,
+                device_id TEXT NOT NULL,
+                meta TEXT NOT NULL,
+                payload BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt REAL NOT NULL DEFAULT 0,
+                claimed INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS upload_spool_ready ON upload_spool (claimed, next_attempt)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS upload_spool_created ON upload_spool (created_at)')
+        # Rows claimed by a previous run were never acknowledged, send them again
+        self._conn.execute('UPDATE upload_spool SET claimed = 0 WHERE claimed = 1')
+        self._rows, self._bytes = self._conn.execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM upload_spool').fetchone()
+
+    def put(self, requests):
+        """Store `(device_id, data, images, captured_at)` requests, images being `(filename, jpeg, fields)`.
+
+        `captured_at` is the wall-clock capture time of the frame, or None.
+        Returns the ids of the new rows.
+        """
+        now = time.time()
+        rows = []
+        for device_id, data, images, captured_at in requests:
+            meta = json.dumps({
+                "data": data,
+                "images": [[filename, len(jpeg), fields] for filename, jpeg, fields in images],
+                "captured_at": captured_at,
+            })
+            payload = b''.join(jpeg for _, jpeg, _ in images)
+            rows.append((now, device_id, meta, payload, len(payload)))
+
+        with self._lock:
+            with self._conn:
+                self._conn.execute('BEGIN')
+                ids = [self._conn.execute('INSERT INTO upload_spool (created_at, device_id, meta, payload, size) '
+                                          'VALUES (?, ?, ?, ?, ?)', row).lastrowid for row in rows]
+            self._rows += len(rows)
+            self._bytes += sum(row[4] for row in rows)
+            self._enforce_caps()
+        return ids
+
+    def claim(self, limit):
+        """Take up to `limit` of the oldest rows that are due, they stay hidden until acked or retried."""
+        with self._lock:
+            with self._conn:
+                self._conn.execute('BEGIN IMMEDIATE')
+                rows = self._conn.execute(
+                    'SELECT id, device_id, meta, payload, attempts FROM upload_spool '
+                    'WHERE claimed = 0 AND next_attempt <= ? ORDER BY id LIMIT ?', (time.time(), limit)).fetchall()
+                self._conn.executemany('UPDATE upload_spool SET claimed = 1 WHERE id = ?', [(row[0],) for row in rows])
+
+        entries = []
+        for id, device_id, meta, payload, attempts in rows:
+            meta = json.loads(meta)
+            images = []
+            offset = 0
+            for filename, length, fields in meta["images"]:
+                images.append((filename, payload[offset:offset + length], fields))
+                offset += length
+            entries.append(SpoolEntry(id, device_id, meta["data"], images, attempts, meta.get("captured_at")))
+        return entries
+
+    def ack(self, ids):
+        """Remove rows that were delivered, or rejected for good."""
+        if not ids:
+            return
+        with self._lock:
+            self._delete('id IN ({})'.format(','.join('?' * len(ids))), ids)
+
+    def retry(self, ids, delay):
+        if not ids:
+            return
+        with self._lock:
+            with self._conn:
+                self._conn.execute('BEGIN')
+                self._conn.executemany(
+                    'UPDATE upload_spool SET claimed = 0, attempts = attempts + 1, next_attempt = ? WHERE id = ?',
+                    [(time.time() + delay, id) for id in ids])
+
+    def release(self, ids):
+        """Hand claimed rows back untouched, e.g. when the drainer stops."""
+        if not ids:
+            return
+        with self._lock:
+            with self._conn:
+                self._conn.execute('BEGIN')
+                self._conn.executemany('UPDATE upload_spool SET claimed = 0 WHERE id = ?', [(id,) for id in ids])
+
+    def evict_expired(self):
+        """Drop rows older than `max_age`, at most once per `expiry_interval` however often it is called."""
+        with self._lock:
+            now = time.time()
+            if now - self._expiry_checked < self.expiry_interval:
+                return
+            self._expiry_checked = now
+            evicted = self._delete('created_at < ?', (now - self.max_age,))
+            self.evicted += evicted
+        if evicted:
+            logger.warning("Evicted %d uploads older than %ds from the spool", evicted, self.max_age)
+
+    def depth(self):
+        with self._lock:
+            return self._rows, self._bytes
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _enforce_caps(self):
+        # Caller holds the lock
+        if self._rows <= self.max_rows and self._bytes <= self.max_bytes:
+            return
+        excess_rows = max(0, self._rows - self.max_rows)
+        excess_bytes = max(0, self._bytes - self.max_bytes)
+        cutoff = None
+        freed_rows = freed_bytes = 0
+        for id, size in self._conn.execute('SELECT id, size FROM upload_spool ORDER BY id'):
+            if freed_rows >= excess_rows and freed_bytes >= excess_bytes:
+                break
+            cutoff = id
+            freed_rows += 1
+            freed_bytes += size
+        if cutoff is not None:
+            evicted = self._delete('id <= ?', (cutoff,))
+            self.evicted += evicted
+            logger.warning("Spool full, evicted the %d oldest uploads", evicted)
+
+    def _delete(self, where, params):
+        # Caller holds the lock
+        with self._conn:
+            self._conn.execute('BEGIN')
+            count, size = self._conn.execute(
+                f'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM upload_spool WHERE {where}', params).fetchone()
+            self._conn.execute(f'DELETE FROM upload_spool WHERE {where}', params)
+        self._rows -= count
+        self._bytes -= size
+        return count
@@ -1,22 +1,221 @@
+import argparse
+import json
 import logging
-from flask import Flask, request
+import os
+from flask import Flask, Response, redirect, request
 import threading
-import queue
 import cv2
+import numpy as np
 import time
-import requests
+import socket
+import sqlite3
 from datetime import datetime, timezone
-import tempfile
 import pytz
 
+from camera_store import (fetch_profile, init_cameras_table, load_cameras, merge_profile, save_profile,
+                          validate_cameras)
+from capture import CAPTURE_BACKENDS, FrameAgeStats, LatestFrameCapture, open_capture
+from cluster import ClusterNode, LeaseStore
+import metrics
+from dedup import DuplicateCache
+from detectors import DETECTORS
+from detection import DetectionEngine, DetectorPool, FrameJob, MotionGate, serve_detection
+from frame_ring import FrameRing
+from preview import PreviewCache
+from registry import RUNNING, ManagedStream, StreamRegistry
+from roi import inside_roi, parse_roi, roi_rects
+from scheduler import SamplingScheduler
+from spool import UploadSpool
+from supervisor import Supervisor, serve_commands
+from tracker import FaceTracker
+from tracing import Tracer, span
+from uploader import Uploader, UploadJob
+
 # Set up logging to ignore messages less severe than WARNING
 logging.basicConfig(level=logging.WARNING)
 
 
 app = Flask(__name__)
-connection_queue = queue.Queue()
+frame_age_stats = FrameAgeStats()
+# Created at startup, see the __main__ block
+detection_engine = None
+uploader = None
+# Runs detect_faces in separate processes with --detection-processes
+detector_pool = None
+sampling_scheduler = None
+# Drops crops another camera of the same event just uploaded, None with --dedup-ttl 0
+duplicate_cache = None
+# JPEGs of the latest frames for /snapshot and /preview
+preview_cache = None
+# Per-stage timings of a sample of frames for /debug/trace
+tracer = None
+# A StreamRegistry, or a Supervisor that routes to worker processes in --processes mode
+stream_registry = None
+supervisor = None
+# A ClusterNode that shares the cameras with other servers in --cluster-db mode, it is the registry then
+cluster = None
+# Progress of --resume, see resume_cameras
+resume_status = {}
+
+UPLOAD_URL = "https://emotion-detection-app-bw5vqucpuq-ww.a.run.app"
+JPEG_QUALITY = 95
+
+# Frames analysed per second per camera unless the camera asks for another rate
+DEFAULT_SAMPLE_FPS = 0.5
+# Range the scheduler moves a camera's rate in, None pins it to sample_fps (see --min/--max-sample-fps)
+DEFAULT_MIN_SAMPLE_FPS = None
+DEFAULT_MAX_SAMPLE_FPS = None
+# Fraction of a small thumbnail that has to change before the detector runs again
+DEFAULT_MOTION_THRESHOLD = 0.005
+# Width the cascade runs at, 0 keeps the camera's resolution (see --detection-width)
+DEFAULT_DETECTION_WIDTH = 0
+# Seconds between uploads of the same tracked face, 0 uploads each face only once
+DEFAULT_TRACK_REFRESH_INTERVAL = 30.0
+# How frames are pulled from the camera, one of capture.CAPTURE_BACKENDS
+DEFAULT_CAPTURE_BACKEND = 'opencv'
+# Seconds to wait for a camera to accept the connection (see --connect-timeout)
+DEFAULT_CONNECT_TIMEOUT = 10.0
+# Seconds between connects when many cameras start at once (see --connect-stagger)
+CONNECT_STAGGER = 0.1
+# Face detector cameras use unless they pick their own, one of detectors.DETECTORS
+DEFAULT_DETECTOR = 'haar'
+# Most frames per second a /preview stream sends (see --preview-fps)
+PREVIEW_FPS = 5.0
+# Where the GUIs keep cameras, /cameras/<device_id>/profile saves profiles there too (see --cameras-db)
+CAMERAS_DB = 'cameras.db'
+# Whether init_cameras_table already brought CAMERAS_DB up to date in this process
+cameras_db_ready = False
+
+# Camera options that make up a camera's profile, stored with it in cameras.db and
+# changed on the fly through /cameras/<device_id>/profile
+PROFILE_FIELDS = ('sample_fps', 'min_sample_fps', 'max_sample_fps', 'motion_threshold', 'detection_width',
+                  'min_face_size', 'max_face_size', 'track_refresh_interval', 'detector', 'detector_params',
+                  'jpeg_quality', 'capture_backend', 'connect_timeout', 'read_timeout')
+
+# Detectors are created on first use and shared by every camera of the process
+face_detectors = {}
+face_detectors_lock = threading.Lock()
+# Constructor arguments per detector name, filled from the command line
+detector_settings = {}
+
+
+class StreamContext(ManagedStream):
+    """Configuration and per-camera state shared by the stages of one stream.
+
+    The stages read `options` for every frame, so only a change of how the
+    camera is connected to needs a restart.
+    """
+
+    restart_options = ('capture_backend', 'connect_timeout', 'read_timeout')
+
+    def __init__(self, rtsp_url, device_id, event_id, options):
+        super().__init__(rtsp_url, device_id, event_id, options)
+        self.motion_gate = MotionGate(options['motion_threshold'])
+        self.tracker = FaceTracker(options['track_refresh_interval'])
+        # Wall-clock time faces were last found on this camera
+        self.last_detection = None
 
-face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+    def describe(self):
+        description = super().describe()
+        capture = self.capture
+        description.update(
+            frames_grabbed=capture.frames_grabbed if capture else 0,
+            sample_fps=round(1.0 / capture.sample_interval, 3) if capture and capture.sample_interval else None,
+            last_detection=self.last_detection,
+        )
+        return description
+
+    def configure(self, rtsp_url, event_id, options):
+        if self.needs_restart(rtsp_url, options):
+            self.motion_gate = MotionGate(options['motion_threshold'])
+            self.tracker = FaceTracker(options['track_refresh_interval'])
+        else:
+            # Keep the motion reference and the tracks of the running stream
+            self.motion_gate.threshold = options['motion_threshold']
+            self.tracker.refresh_interval = options['track_refresh_interval']
+        super().configure(rtsp_url, event_id, options)
+
+def camera_options(data):
+    # Optional per-camera settings that can be sent along with a registration,
+    # a stored `profile` fills in the ones that are not given
+    if not isinstance(data, dict):
+        raise ValueError("Expected an object of camera settings")
+    profile = data.get('profile') or {}
+    if isinstance(profile, str):
+        profile = json.loads(profile)
+    if not isinstance(profile, dict):
+        raise ValueError("profile must be an object of settings")
+    unknown = set(profile) - set(PROFILE_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown profile settings {', '.join(sorted(unknown))}")
+    data = dict(profile, **{key: value for key, value in data.items() if key != 'profile'})
+
+    sample_fps = option_value(data, 'sample_fps', float, DEFAULT_SAMPLE_FPS)
+    options = {
+        "sample_fps": sample_fps,
+        "min_sample_fps": option_value(data, 'min_sample_fps', float, DEFAULT_MIN_SAMPLE_FPS or sample_fps),
+        "max_sample_fps": option_value(data, 'max_sample_fps', float, DEFAULT_MAX_SAMPLE_FPS or sample_fps),
+        "motion_threshold": option_value(data, 'motion_threshold', float, DEFAULT_MOTION_THRESHOLD),
+        "detection_width": option_value(data, 'detection_width', int, DEFAULT_DETECTION_WIDTH),
+        # Smallest and largest face to look for, in full-resolution pixels (0 = no limit)
+        "min_face_size": option_value(data, 'min_face_size', int, 0),
+        "max_face_size": option_value(data, 'max_face_size', int, 0),
+        "track_refresh_interval": option_value(data, 'track_refresh_interval', float,
+                                               DEFAULT_TRACK_REFRESH_INTERVAL),
+        "capture_backend": data.get('capture_backend', DEFAULT_CAPTURE_BACKEND),
+        "connect_timeout": option_value(data, 'connect_timeout', float, DEFAULT_CONNECT_TIMEOUT),
+        # Seconds a read from an RTSP camera may stall before the stream counts as dropped
+        "read_timeout": option_value(data, 'read_timeout', float, 3.0),
+        "detector": data.get('detector', DEFAULT_DETECTOR),
+        # Tuning the detector accepts, e.g. scale_factor and min_neighbors for 'haar'
+        "detector_params": data.get('detector_params') or {},
+        "jpeg_quality": option_value(data, 'jpeg_quality', int, JPEG_QUALITY),
+        # Parts of the frame to look for faces in, None scans all of it
+        "roi": parse_roi(data.get('roi')),
+    }
+    # An idle camera still needs samples, or motion would never be noticed
+    if not 0 < options['min_sample_fps'] <= options['max_sample_fps']:
+        raise ValueError("min_sample_fps must be above 0 and at most max_sample_fps")
+    if not isinstance(options['capture_backend'], str) or options['capture_backend'] not in CAPTURE_BACKENDS:
+        raise ValueError(f"Unknown capture_backend {options['capture_backend']!r}")
+    if not isinstance(options['detector'], str) or options['detector'] not in DETECTORS:
+        raise ValueError(f"Unknown detector {options['detector']!r}")
+    if isinstance(options['detector_params'], str):
+        options['detector_params'] = json.loads(options['detector_params'])
+    if not isinstance(options['detector_params'], dict):
+        raise ValueError("detector_params must be an object of detector settings")
+    param_types = DETECTORS[options['detector']].PARAMS
+    unknown = set(options['detector_params']) - set(param_types)
+    if unknown:
+        raise ValueError(f"The {options['detector']!r} detector has no settings {', '.join(sorted(unknown))}")
+    options['detector_params'] = {key: option_value(options['detector_params'], key, param_types[key], None)
+                                  for key in options['detector_params']}
+    if not 1 <= options['jpeg_quality'] <= 100:
+        raise ValueError("jpeg_quality must be between 1 and 100")
+    try:
+        get_detector(options['detector'])
+    except RuntimeError as err:
+        raise ValueError(str(err))
+    return options
+
+def option_value(data, key, kind, default):
+    # Wrong types are the client's mistake, they answer 400 like any other bad value
+    value = data.get(key, default)
+    try:
+        return kind(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{key} must be {'an integer' if kind is int else 'a number'}, not {value!r}")
+
+def get_detector(name):
+    with face_detectors_lock:
+        detector = face_detectors.get(name)
+        if detector is None:
+            detector = face_detectors[name] = DETECTORS[name](**detector_settings.get(name, {}))
+        return detector
+
+@app.errorhandler(ValueError)
+def invalid_request(err):
+    return {"message": str(err)}, 400
 
 
 @app.route('/register_camera', methods=['POST'])
@@ -26,90 +225,820 @@ def register_camera_endpoint():
     rtsp_url = data['rtsp_url']
     device_id = data['device_id']
     event_id = data['event_id']  
-    connection_queue.put((rtsp_url, device_id, event_id))
+    stream_registry.start(rtsp_url, device_id, event_id, camera_options(data))
     return {"message": "Camera registered successfully"}
 
+@app.route('/register_cameras', methods=['POST'])
+def register_cameras_endpoint():
+    """Register a list of cameras (or `{"cameras": [...]}`) in one request.
+
+    Every entry is validated on its own and a device_id listed twice keeps
+    its last entry. The valid cameras are started in the background with
+    staggered connects, the response lists them along with the rejected
+    entries.
+    """
+    data = request.json
+    items = data.get('cameras') if isinstance(data, dict) else data
+    if not isinstance(items, list):
+        raise ValueError("Expected a list of cameras")
+    cameras, errors, duplicates = validate_cameras(items)
+    accepted = []
+    for index, camera in cameras:
+        try:
+            camera_options(camera)
+        except (ValueError, TypeError) as err:
+            errors.append({"index": index, "device_id": camera['device_id'], "message": str(err)})
+            continue
+        accepted.append(camera)
+    threading.Thread(target=start_cameras, args=(accepted, CONNECT_STAGGER), name="register-cameras",
+                     daemon=True).start()
+    result = {"registered": [camera['device_id'] for camera in accepted], "duplicates": duplicates, "errors": errors}
+    return result, 400 if errors and not accepted else 200
+
+@app.route('/cameras/<device_id>/profile', methods=['GET'])
+def get_profile_endpoint(device_id):
+    configuration = stream_registry.configuration(device_id)
+    if configuration is None:
+        return {"message": f"Unknown device {device_id}"}, 404
+    options = configuration[2]
+    return {"device_id": device_id, "profile": {key: options[key] for key in PROFILE_FIELDS}}
+
+@app.route('/cameras/<device_id>/profile', methods=['PUT'])
+def put_profile_endpoint(device_id):
+    """Change profile settings of a running camera, settings left out keep their value and
+    settings set to null go back to the default.
+
+    The change applies from the next frame without reopening the stream,
+    unless it touches how the camera is connected to. The settings are
+    also saved with the camera in --cameras-db so they survive a restart.
+    """
+    changes = request.json
+    if not isinstance(changes, dict):
+        raise ValueError("Expected an object of profile settings")
+    unknown = set(changes) - set(PROFILE_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown profile settings {', '.join(sorted(unknown))}")
+    configuration = stream_registry.configuration(device_id)
+    if configuration is None:
+        return {"message": f"Unknown device {device_id}"}, 404
+    rtsp_url, event_id, current = configuration
+    options = camera_options(merge_profile(current, changes))
+    restarted = any(options[key] != current[key] for key in StreamContext.restart_options)
+    stream_registry.start(rtsp_url, device_id, event_id, options)
+    return {"device_id": device_id, "profile": {key: options[key] for key in PROFILE_FIELDS},
+            "restarted": restarted, "saved": store_profile(device_id, changes)}
+
+def store_profile(device_id, changes):
+    global cameras_db_ready
+    # Only a database the GUIs created, a missing one is not made up here
+    if not os.path.exists(CAMERAS_DB):
+        return False
+    conn = sqlite3.connect(CAMERAS_DB, timeout=5)
+    try:
+        if not cameras_db_ready:
+            # Older databases lack the profile column, migrating once per process is enough
+            init_cameras_table(conn)
+            cameras_db_ready = True
+        return save_profile(conn, device_id, merge_profile(fetch_profile(conn, device_id), changes))
+    except sqlite3.Error as err:
+        print(f"Unable to save the profile of device {device_id}: {err}")
+        return False
+    finally:
+        conn.close()
+
 @app.route('/start_processing', methods=['POST'])
 def start_processing_endpoint():
     data = request.json
     rtsp_url = data['rtsp_url']
     device_id = data['device_id']
     event_id = data['event_id']
-    connection_queue.put((rtsp_url, device_id, event_id))
+    if not stream_registry.start(rtsp_url, device_id, event_id, camera_options(data)):
+        return {"message": f"Stream from device {device_id} is already being processed"}
     return {"message": f"Started processing stream from device {device_id}"}
 
+@app.route('/stop_processing', methods=['POST'])
+def stop_processing_endpoint():
+    device_id = request.json['device_id']
+    if not stream_registry.stop(device_id):
+        return {"message": f"Unknown device {device_id}"}, 404
+    return {"message": f"Stopped processing stream from device {device_id}"}
+
+@app.route('/streams', methods=['GET'])
+def streams_endpoint():
+    return {"streams": stream_registry.snapshot()}
+
+@app.route('/resume_status', methods=['GET'])
+def resume_status_endpoint():
+    return resume_status
+
+@app.route('/streams/live', methods=['GET'])
+def live_streams_endpoint():
+    """Server-sent events with the state of every camera.
+
+    The first `snapshot` event lists all cameras. After that, every
+    `interval` seconds, an `update` event carries the cameras whose row
+    changed and a `remove` event the device_ids that went away. fps is
+    the rate frames are read from the camera.
+    """
+    interval = max(0.2, float(request.args.get('interval', 1.0)))
+
+    def events():
+        rows = {}
+        grabbed = {}
+        last_tick = time.monotonic()
+        first = True
+        while True:
+            now = time.monotonic()
+            current = {}
+            for stream in stream_registry.snapshot():
+                device_id = stream['device_id']
+                count = stream.get('frames_grabbed', 0)
+                before = grabbed.get(device_id)
+                # The counter starts over when the stream reconnects
+                fps = None if before is None else round(max(0, count - before if count >= before else count)
+                                                        / (now - last_tick), 1)
+                grabbed[device_id] = count
+                current[device_id] = dict(stream, fps=fps)
+            last_tick = now
+
+            if first:
+                yield f"event: snapshot\ndata: {json.dumps(list(current.values()))}\n\n"
+                first = False
+            else:
+                changed = [row for device_id, row in current.items() if rows.get(device_id) != row]
+                removed = [device_id for device_id in rows if device_id not in current]
+                if changed:
+                    yield f"event: update\ndata: {json.dumps(changed)}\n\n"
+                if removed:
+                    yield f"event: remove\ndata: {json.dumps(removed)}\n\n"
+                if not changed and not removed:
+                    # Keeps proxies from closing the connection and notices clients that left
+                    yield ": keepalive\n\n"
+            rows = current
+            time.sleep(interval)
+
+    return Response(events(), mimetype='text/event-stream', headers={"Cache-Control": "no-cache"})
+
+@app.route('/snapshot/<device_id>', methods=['GET'])
+def snapshot_endpoint(device_id):
+    """The latest frame of a camera as a JPEG, `width` and `quality` override the --preview-* defaults."""
+    moved = cluster_redirect(device_id)
+    if moved:
+        return moved
+    width, quality = request.args.get('width', type=int), request.args.get('quality', type=int)
+    try:
+        latest = find_preview(device_id, width, quality)
+    except KeyError:
+        return {"message": f"Unknown device {device_id}"}, 404
+    except RuntimeError as err:
+        return {"message": str(err)}, 503
+    if latest is None:
+        return {"message": f"No frame from device {device_id} yet"}, 503
+    return Response(latest[1], mimetype='image/jpeg', headers={"Cache-Control": "no-cache"})
+
+@app.route('/preview/<device_id>', methods=['GET'])
+def preview_endpoint(device_id):
+    """MJPEG stream of a camera's latest frames, sent as they are sampled and at most `fps` a second.
+
+    Frames come from the pipeline's own connection, so previews never open
+    another session to the camera. A camera is only sampled as often as
+    the scheduler decides, so an idle camera updates slowly.
+    """
+    moved = cluster_redirect(device_id)
+    if moved:
+        return moved
+    width, quality = request.args.get('width', type=int), request.args.get('quality', type=int)
+    fps = min(request.args.get('fps', PREVIEW_FPS, type=float), PREVIEW_FPS)
+    if fps <= 0:
+        raise ValueError("fps must be above 0")
+    try:
+        find_preview(device_id, width, quality)
+    except KeyError:
+        return {"message": f"Unknown device {device_id}"}, 404
+
+    def frames():
+        frame_id = image = None
+        sent_at = 0.0
+        while True:
+            try:
+                # Only the id comes back while the frame is unchanged
+                latest = find_preview(device_id, width, quality, frame_id)
+            except KeyError:
+                return
+            except RuntimeError:
+                latest = None
+            now = time.monotonic()
+            if latest is not None and latest[1] is not None:
+                frame_id, image = latest
+            elif image is None or now - sent_at < 10:
+                # Unchanged, though resent now and then so clients that left are noticed
+                time.sleep(1.0 / fps)
+                continue
+            sent_at = now
+            yield (b"--frame\r\nContent-Type: image/jpeg\r\nContent-Length: "
+                   + str(len(image)).encode() + b"\r\n\r\n" + image + b"\r\n")
+            time.sleep(1.0 / fps)
+
+    return Response(frames(), mimetype='multipart/x-mixed-replace; boundary=frame',
+                    headers={"Cache-Control": "no-cache"})
+
+def cluster_redirect(device_id):
+    # Frames only exist on the node running the camera, send the client there
+    url = cluster.owner_url(device_id) if cluster else None
+    if url is None:
+        return None
+    return redirect(url.rstrip('/') + request.full_path.rstrip('?'), code=307)
+
+def find_preview(device_id, width=None, quality=None, since=None):
+    if supervisor:
+        return supervisor.call_owner(device_id, 'preview', device_id, width, quality, since)
+    return latest_preview(device_id, width, quality, since)
+
+def latest_preview(device_id, width=None, quality=None, since=None):
+    """Return `(frame_id, jpeg)` for the newest frame of a camera, None before its first frame.
+
+    The JPEG is None when the newest frame is still `since`. Raises
+    KeyError for a camera this process does not run.
+    """
+    stream = stream_registry.get(device_id)
+    if stream is None:
+        raise KeyError(device_id)
+    capture = stream.capture
+    latest = capture.read(timeout=0) if capture else None
+    if latest is None:
+        return None
+    seq, frame, _ = latest
+    # Sequence numbers start over with every connection
+    frame_id = (id(capture), seq)
+    if frame_id == since:
+        return frame_id, None
+    return frame_id, preview_cache.jpeg(device_id, frame_id, frame, width, quality)
+
+@app.route('/debug/trace', methods=['GET'])
+def trace_endpoint():
+    """Spans of the traced frames from the last `seconds`, as Chrome trace-event JSON for Perfetto."""
+    seconds = request.args.get('seconds', 30.0, type=float)
+    device_id = request.args.get('device_id')
+    if supervisor:
+        events = supervisor.trace(seconds, device_id)
+    else:
+        events = tracer.export(seconds, device_id)
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+@app.route('/debug/trace', methods=['POST'])
+def trace_sample_rate_endpoint():
+    """Change the fraction of sampled frames that are traced, 0 turns tracing off."""
+    sample_rate = float(request.json['sample_rate'])
+    if not 0 <= sample_rate <= 1:
+        raise ValueError("sample_rate must be between 0 and 1")
+    if supervisor:
+        supervisor.set_trace_sample_rate(sample_rate)
+    else:
+        set_trace_sample_rate(sample_rate)
+    return {"sample_rate": sample_rate}
+
+def set_trace_sample_rate(sample_rate):
+    tracer.sample_rate = sample_rate
+
 @app.route('/active_threads', methods=['GET'])
 def active_threads():
     return {"active_threads": threading.active_count()}
 
-def process_stream(rtsp_url, device_id, event_id):
-    # Append the transport protocol to the RTSP URL
-    rtsp_url_with_tcp = rtsp_url + "?rtsp_transport=tcp&timeout=3000"
-    cap = cv2.VideoCapture(rtsp_url_with_tcp)
+@app.route('/workers', methods=['GET'])
+def workers_endpoint():
+    return {"workers": supervisor.workers() if supervisor else []}
+
+@app.route('/cluster', methods=['GET'])
+def cluster_endpoint():
+    if cluster is None:
+        return {"node_id": None, "nodes": {}}
+    return {"node_id": cluster.node_id, "nodes": cluster.nodes()}
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    if supervisor:
+        text = metrics.merge_expositions(supervisor.metrics())
+    else:
+        text = metrics.REGISTRY.render()
+    return Response(text, content_type=metrics.CONTENT_TYPE)
+
+def collect_pipeline_metrics():
+    # Read at scrape time from the state the pipeline keeps anyway
+    streams = stream_registry.streams() if stream_registry else []
+    yield ('citra_stream_reconnects_total', 'counter', "Reconnect attempts after a stream dropped or failed to open",
+           [({"camera": stream.device_id}, stream.reconnects) for stream in streams])
+    yield ('citra_stream_state', 'gauge', "1 for the state each stream is currently in",
+           [({"camera": stream.device_id, "state": stream.state}, 1) for stream in streams])
+    engine_stats = detection_engine.stats() if detection_engine else {}
+    yield ('citra_detection_queue_depth', 'gauge', "Frames waiting for a detection worker",
+           [({"camera": device_id}, counters["queued"]) for device_id, counters in engine_stats.items()])
+    yield ('citra_frames_dropped_total', 'counter', "Frames dropped because detection fell behind",
+           [({"camera": device_id}, counters["dropped"]) for device_id, counters in engine_stats.items()])
+    sampling = sampling_scheduler.stats() if sampling_scheduler else {}
+    yield ('citra_sample_rate_fps', 'gauge', "Rate the scheduler currently samples each camera at",
+           [({"camera": device_id}, values["sample_fps"]) for device_id, values in sampling.items()])
+    upload_stats = uploader.stats() if uploader else {}
+    if duplicate_cache:
+        yield ('citra_duplicate_cache_entries', 'gauge', "Face hashes held by the duplicate cache",
+               [({}, duplicate_cache.stats()["entries"])])
+    yield ('citra_upload_queue_depth', 'gauge', "Uploads waiting for a worker",
+           [({}, upload_stats.get("queued", 0))])
+    yield ('citra_uploads_dropped_total', 'counter', "Uploads dropped because the upload queue was full",
+           [({}, upload_stats.get("dropped", 0))])
+    if "spooled" in upload_stats:
+        yield ('citra_spool_depth', 'gauge', "Uploads waiting in the on-disk spool",
+               [({}, upload_stats["spooled"])])
+        yield ('citra_spool_bytes', 'gauge', "Size of the images waiting in the on-disk spool",
+               [({}, upload_stats["spooled_bytes"])])
+        yield ('citra_spool_evicted_total', 'counter', "Uploads evicted from the spool by its size or age caps",
+               [({}, upload_stats["evicted"])])
+
+metrics.REGISTRY.register_collector(collect_pipeline_metrics)
+
+@app.route('/stream_stats', methods=['GET'])
+def stream_stats():
+    if supervisor:
+        return supervisor.stream_stats()
+    return local_stream_stats()
+
+def local_stream_stats():
+    stats = frame_age_stats.snapshot()
+    for stream in stream_registry.streams():
+        stats.setdefault(stream.device_id, {}).update(
+            state=stream.state,
+            reconnects=stream.reconnects,
+            detections_run=stream.motion_gate.runs,
+            detections_skipped=stream.motion_gate.skips,
+            tracks_active=len(stream.tracker.tracks),
+            crops_uploaded=stream.tracker.crops_uploaded,
+            crops_suppressed=stream.tracker.crops_suppressed,
+        )
+    for device_id, counters in detection_engine.stats().items():
+        stats.setdefault(device_id, {}).update(
+            frames_submitted=counters["submitted"],
+            frames_dropped=counters["dropped"],
+            frames_queued=counters["queued"],
+        )
+    for device_id, values in sampling_scheduler.stats().items():
+        stats.setdefault(device_id, {}).update(values)
+    # Leave out cameras this process no longer runs, they may have moved to another worker
+    known = {stream.device_id for stream in stream_registry.streams()}
+    stats = {device_id: values for device_id, values in stats.items() if device_id in known}
+    return {"streams": stats, "uploads": uploader.stats(),
+            "duplicates": duplicate_cache.stats() if duplicate_cache else None,
+            "previews": preview_cache.stats()}
+
+def process_stream(stream):
+    """Run one connection to a camera, returns when the stream drops or is stopped."""
+    rtsp_url = stream.rtsp_url
+    cap = open_capture(stream.options['capture_backend'], rtsp_url, stream.options['connect_timeout'],
+                       stream.options['read_timeout'])
     if not cap.isOpened():
-        print(f"Unable to open camera with URL {rtsp_url_with_tcp}")
+        print(f"Unable to open camera with URL {rtsp_url}")
+        stream.last_error = "Unable to open stream"
         return
 
-    while True:
-        ret, frame = cap.read()
-        if not ret:
+    ring = None
+
+    # Keep draining the stream here and hand sampled frames to the shared detection pool
+    def submit_frame(seq, frame, captured_at, trace=None):
+        nonlocal ring
+        if detector_pool is None:
+            if trace is not None:
+                trace.queued_at = time.monotonic()
+            detection_engine.submit(FrameJob(stream, frame, captured_at, seq, trace=trace))
+            return
+        # Detector processes read the frame from shared memory, it is never pickled
+        if ring is None or not ring.fits(frame):
+            if ring is not None:
+                ring.close()
+            # Room for the queued frames, the one being analysed and the one being written
+            ring = FrameRing.create(detection_engine.queue_depth + 3, frame.shape)
+        with span(trace, 'ring_write'):
+            slot, ring_seq = ring.write(frame, captured_at)
+        view = ring.read(slot, ring_seq)
+        if trace is not None:
+            trace.queued_at = time.monotonic()
+        detection_engine.submit(FrameJob(stream, view, captured_at, seq, (ring, slot, ring_seq), trace))
+
+    capture = LatestFrameCapture(cap, stream.device_id, sampling_scheduler.rate(stream), on_frame=submit_frame,
+                                 tracer=tracer)
+    stream.capture = capture
+    try:
+        # The stream may have been stopped or reconfigured while we were connecting,
+        # the registry then reconnects right away with the current configuration
+        if stream.stopping or stream.restart_requested or stream.rtsp_url != rtsp_url:
+            return
+        stream.set_state(RUNNING)
+        capture.run()
+        if not stream.stopping:
             print("Failed to grab frame")
-            break
-        time.sleep(2)
-        detected_objects = detect_objects(frame)
-        send_detection_results(detected_objects, device_id, event_id)
+            stream.last_error = "Failed to grab frame"
+    finally:
+        # The connection goes first, nothing after it may keep the camera open
+        cap.release()
+        if ring is not None:
+            ring.close()
+        detection_engine.discard(stream.device_id)
+        preview_cache.discard(stream.device_id)
+
+def analyze_frame(job):
+    stream = job.stream
+    device_id = stream.device_id
+    frame_age = time.monotonic() - job.captured_at
+    frame_age_stats.record(device_id, frame_age)
+    metrics.FRAME_AGE.labels(device_id).observe(frame_age)
+    trace = job.trace
+    if trace is not None:
+        trace.waited('detection_queued')
+    # Skip the cascade entirely while the scene is static
+    with span(trace, 'motion_gate'):
+        moved = stream.motion_gate.should_detect(job.frame)
+    if not moved:
+        metrics.FRAMES_SKIPPED.labels(device_id).inc()
+        stream.tracker.hold(job.captured_at)
+        sampling_scheduler.record(device_id, motion=False, faces=0)
+        return
+    options = stream.options
+    started = time.perf_counter()
+    params = {key: options[key] for key in ('detection_width', 'min_face_size', 'max_face_size', 'detector',
+                                            'detector_params', 'roi')}
+    if job.ring_ref is not None:
+        with span(trace, 'detect_remote', detector=options['detector']):
+            faces = detector_pool.detect(*job.ring_ref, **params)
+        if faces is None:
+            metrics.FRAMES_STALE.labels(device_id).inc()
+            return
+    else:
+        faces = detect_faces(job.frame, trace=trace, **params)
+    metrics.DETECTION_LATENCY.labels(device_id).observe(time.perf_counter() - started)
+    metrics.FRAMES_ANALYZED.labels(device_id).inc()
+    metrics.FACES_DETECTED.labels(device_id).inc(len(faces))
+    if len(faces):
+        stream.last_detection = time.time()
+    # With the gate off every frame passes, which says nothing about motion
+    sampling_scheduler.record(device_id, motion=stream.motion_gate.threshold > 0, faces=len(faces))
+    # Only new faces and periodic refreshes of known ones are uploaded
+    with span(trace, 'track', faces=len(faces)):
+        uploads = stream.tracker.update(job.frame, faces, job.captured_at)
+    if job.ring_ref is not None:
+        # Copy the crops out of the ring, then make sure the slot was not rewritten meanwhile
+        uploads = [(track_id, crop.copy()) for track_id, crop in uploads]
+        ring, slot, ring_seq = job.ring_ref
+        if not ring.is_current(slot, ring_seq):
+            metrics.FRAMES_STALE.labels(device_id).inc()
+            return
+    if duplicate_cache is not None and uploads:
+        kept = []
+        with span(trace, 'dedup'):
+            for track_id, crop in uploads:
+                if duplicate_cache.check(stream.event_id, device_id, crop):
+                    metrics.DUPLICATE_HITS.labels(device_id).inc()
+                else:
+                    metrics.DUPLICATE_MISSES.labels(device_id).inc()
+                    kept.append((track_id, crop))
+        uploads = kept
+    send_detection_results([crop for _, crop in uploads], stream.device_id, stream.event_id,
+                           track_ids=[track_id for track_id, _ in uploads], captured_at=job.captured_at, trace=trace,
+                           jpeg_quality=options['jpeg_quality'])
 
 #rtsp://localhost:8554/mystream
-def send_detection_results(objects, device_id, event_id):
-    for object in objects:
-        # Save the image to a temporary file
-        with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as temp_image:
-            cv2.imwrite(temp_image.name, object)
-
-            # Format the datetime to match JavaScript's `new Date()` output
-            current_utc = datetime.now(timezone.utc)
-            iso_format_with_milliseconds = current_utc.isoformat(timespec='milliseconds')
-
-            # Prepare the data payload
-            data = {
-                "cameraId": device_id,
-                "detectionTime": iso_format_with_milliseconds,
-                "eventId": event_id,
-            }
-            print(data)
-            
-            # Prepare the file payload
-            files = {'image': (temp_image.name, open(temp_image.name, 'rb'), 'image/jpeg')}
+def send_detection_results(objects, device_id, event_id, track_ids=None, captured_at=None, trace=None,
+                           jpeg_quality=JPEG_QUALITY):
+    if not len(objects):
+        return
+
+    # Format the datetime to match JavaScript's `new Date()` output
+    current_utc = datetime.now(timezone.utc)
+    iso_format_with_milliseconds = current_utc.isoformat(timespec='milliseconds')
 
-            # Send the POST request with data and file
-            response = requests.post("https://emotion-detection-app-bw5vqucpuq-ww.a.run.app", data=data, files=files)
-            print(response)
+    # Prepare the data payload
+    data = {
+        "cameraId": device_id,
+        "detectionTime": iso_format_with_milliseconds,
+        "eventId": event_id,
+    }
 
-            temp_image.close()
+    # Encode the crops in memory, the upload workers take it from here
+    images = []
+    with span(trace, 'jpeg_encode', crops=len(objects)):
+        for index, object in enumerate(objects):
+            ok, jpeg = cv2.imencode('.jpg', object, [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality])
+            if ok:
+                fields = {"trackId": track_ids[index]} if track_ids else {}
+                filename = f"{device_id}_{current_utc.strftime('%Y%m%dT%H%M%S%f')}_{index}.jpg"
+                images.append((filename, jpeg.tobytes(), fields))
+    uploader.submit(UploadJob(device_id, data, images, captured_at, trace))
             
-def detect_objects(frame):
-    # Convert the frame to grayscale (necessary for the Haarcascade classifier)
-    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-
-    # Detect faces
-    faces = face_cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5)
-
-    croppedFaces = []
-    # Loop over the detected faces
-    for (x, y, w, h) in faces:
-        # Crop the face from the frame
-        cropped_face = frame[y:y+h, x:x+w]
-        croppedFaces.append(cropped_face)
-        
-    return croppedFaces  
-
-def camera_listener():
-    while True:
-        rtsp_url, device_id, event_id = connection_queue.get()
-        thread = threading.Thread(target=process_stream, args=(rtsp_url, device_id, event_id))
-        thread.start()
+def detect_faces(frame, detection_width=0, min_face_size=0, max_face_size=0, detector='haar', roi=None, trace=None,
+                 detector_params=None):
+    """Return face boxes as (x, y, w, h) in full-resolution frame coordinates.
+
+    With `detection_width` set, the detector runs on a copy downscaled to that
+    width. Face size limits are given in full-resolution pixels and scaled
+    to match. `detector_params` are handed to the detector's `detect`. With
+    `roi` (see roi.parse_roi), only the merged bounding rectangles of the
+    regions are scanned and faces centred outside every region are dropped.
+    """
+    height, width = frame.shape[:2]
+    scale = 1.0
+    if detection_width and width > detection_width:
+        scale = detection_width / width
+
+    min_size = (0, 0)
+    if min_face_size:
+        side = round(min_face_size * scale)
+        min_size = (side, side)
+    max_size = (0, 0)
+    if max_face_size:
+        side = round(max_face_size * scale)
+        max_size = (side, side)
+
+    areas = [(0, 0, width, height)] if roi is None else roi_rects(roi, width, height)
+    found = []
+    for x, y, w, h in areas:
+        crop = frame[y:y + h, x:x + w]
+        if scale != 1.0:
+            with span(trace, 'resize'):
+                crop = cv2.resize(crop, (max(1, round(w * scale)), max(1, round(h * scale))),
+                                  interpolation=cv2.INTER_AREA)
+        # Detect faces
+        with span(trace, 'detect', detector=detector, width=crop.shape[1], height=crop.shape[0]):
+            faces = get_detector(detector).detect(crop, min_size, max_size, **(detector_params or {}))
+        if len(faces) == 0:
+            continue
+        if scale != 1.0:
+            # Map the boxes back onto the original frame
+            faces = np.round(np.asarray(faces) / scale).astype(int)
+        found.append(np.asarray(faces, dtype=int) + (x, y, 0, 0))
+    if not found:
+        return np.empty((0, 4), dtype=int)
+
+    faces = np.concatenate(found)
+    faces[:, 2] = np.minimum(faces[:, 2], width - faces[:, 0])
+    faces[:, 3] = np.minimum(faces[:, 3], height - faces[:, 1])
+    if roi is not None:
+        faces = inside_roi(roi, faces, width, height)
+    return faces
+
+def start_cameras(cameras, stagger):
+    # Spread the connects out, each camera still connects on its own thread
+    for index, camera in enumerate(cameras):
+        if index and stagger:
+            time.sleep(stagger)
+        try:
+            stream_registry.start(camera['rtsp_url'], camera['device_id'], camera['event_id'], camera_options(camera))
+        except (ValueError, RuntimeError) as err:
+            print(f"Unable to start device {camera['device_id']}: {err}")
+
+def resume_cameras(db_path, stagger, report_timeout):
+    """Start every camera saved in the GUIs' database and report how long until all of them are live.
+
+    Connects are spread `stagger` seconds apart so a restart does not hit the
+    recorders with every RTSP handshake at once. Each camera connects on its
+    own thread, so a slow one does not hold up the ones after it.
+    """
+    try:
+        cameras = load_cameras(db_path)
+    except sqlite3.Error as err:
+        print(f"Unable to resume cameras from {db_path}: {err}")
+        return
+    started = time.time()
+    resume_status.update(cameras=len(cameras), live=0, pending=[c['device_id'] for c in cameras],
+                         all_live_seconds=None, live_seconds={})
+    print(f"Resuming {len(cameras)} cameras from {db_path}")
+    start_cameras(cameras, stagger)
+
+    pending = set(resume_status['pending'])
+    while pending and time.time() - started < report_timeout:
+        time.sleep(0.5)
+        for stream in stream_registry.snapshot():
+            if stream['device_id'] in pending and (stream['live_since'] or 0) >= started:
+                resume_status['live_seconds'][stream['device_id']] = round(stream['live_since'] - started, 2)
+                pending.discard(stream['device_id'])
+        resume_status.update(live=len(cameras) - len(pending), pending=sorted(pending))
+
+    if pending:
+        print(f"{len(cameras) - len(pending)} of {len(cameras)} cameras live after {report_timeout:.0f}s, "
+              f"still waiting for {', '.join(sorted(pending))}")
+    else:
+        resume_status['all_live_seconds'] = max(resume_status['live_seconds'].values(), default=0.0)
+        print(f"All {len(cameras)} cameras live after {resume_status['all_live_seconds']}s")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="CITRA stream processing server")
+    parser.add_argument('--processes', type=int, default=1,
+                        help="worker processes to shard cameras over, 1 runs everything in this process")
+    parser.add_argument('--detection-workers', type=int,
+                        help="size of the detection pool shared by the cameras of a process "
+                             "(default: number of cores divided by --processes)")
+    parser.add_argument('--detection-processes', type=int, default=0,
+                        help="run the face detector in this many separate processes, frames reach them "
+                             "through shared memory (not combined with --processes)")
+    parser.add_argument('--detector', choices=sorted(DETECTORS), default=DEFAULT_DETECTOR,
+                        help="default face detector, cameras can pick their own with detector")
+    parser.add_argument('--ssd-config', help="deploy.prototxt of the 'ssd' detector (default: models/)")
+    parser.add_argument('--ssd-weights', help="caffemodel of the 'ssd' detector (default: models/)")
+    parser.add_argument('--ssd-confidence', type=float, default=0.6,
+                        help="minimum confidence of an 'ssd' detection")
+    parser.add_argument('--detector-batch', type=int, default=8,
+                        help="frames from different cameras the 'ssd' detector runs in one forward pass")
+    parser.add_argument('--queue-depth', type=int, default=2,
+                        help="frames queued per camera before the oldest one is dropped")
+    parser.add_argument('--min-sample-fps', type=float,
+                        help="default lowest rate an idle camera is sampled at (default: its sample_fps)")
+    parser.add_argument('--max-sample-fps', type=float,
+                        help="default highest rate a camera with faces or motion is sampled at "
+                             "(default: its sample_fps)")
+    parser.add_argument('--sample-budget-fps', type=float, default=0,
+                        help="frames per second all cameras together may send to detection, 0 for no limit")
+    parser.add_argument('--cpu-budget', type=float, default=0,
+                        help="lower sample rates while the server uses more than this percentage of all cores")
+    parser.add_argument('--detection-width', type=int, default=DEFAULT_DETECTION_WIDTH,
+                        help="default width frames are downscaled to before detection, 0 for full resolution")
+    parser.add_argument('--capture-backend', choices=sorted(CAPTURE_BACKENDS), default=DEFAULT_CAPTURE_BACKEND,
+                        help="default capture backend, cameras can pick their own with capture_backend")
+    parser.add_argument('--connect-timeout', type=float, default=DEFAULT_CONNECT_TIMEOUT,
+                        help="seconds to wait for a camera to accept the connection")
+    parser.add_argument('--resume', action='store_true',
+                        help="start every camera saved in --cameras-db at startup")
+    parser.add_argument('--cameras-db', default='cameras.db',
+                        help="SQLite database the configuration GUIs save cameras to, profile changes are saved "
+                             "there as well")
+    parser.add_argument('--connect-stagger', type=float, default=0.1,
+                        help="seconds between camera connects when resuming or registering cameras in bulk")
+    parser.add_argument('--resume-report-timeout', type=float, default=300.0,
+                        help="how long to wait for resumed cameras before reporting the ones still down")
+    parser.add_argument('--reconnect-initial-backoff', type=float, default=1.0,
+                        help="seconds to wait before the first reconnect of a dropped stream")
+    parser.add_argument('--reconnect-max-backoff', type=float, default=60.0,
+                        help="upper bound for the exponential reconnect backoff")
+    parser.add_argument('--dedup-ttl', type=float, default=5.0,
+                        help="seconds a face uploaded by one camera suppresses the same face from the "
+                             "event's other cameras, 0 turns the duplicate check off")
+    parser.add_argument('--dedup-distance', type=int, default=10,
+                        help="most bits two 64-bit face hashes may differ by to count as the same face")
+    parser.add_argument('--dedup-max-entries', type=int, default=10000,
+                        help="face hashes kept across all events")
+    parser.add_argument('--preview-width', type=int, default=640,
+                        help="default width of /snapshot and /preview images, 0 for the camera's resolution")
+    parser.add_argument('--preview-quality', type=int, default=70,
+                        help="default JPEG quality of /snapshot and /preview images")
+    parser.add_argument('--preview-fps', type=float, default=PREVIEW_FPS,
+                        help="most frames per second a /preview stream sends")
+    parser.add_argument('--trace-sample-rate', type=float, default=0,
+                        help="fraction of sampled frames whose stages are traced for /debug/trace, 0 for none")
+    parser.add_argument('--trace-spans', type=int, default=4096,
+                        help="spans kept per camera for /debug/trace")
+    parser.add_argument('--port', type=int, default=5000,
+                        help="port the control endpoints listen on")
+    parser.add_argument('--cluster-db',
+                        help="SQLite file shared with other servers, cameras are then spread over all of them "
+                             "with leases kept in that file")
+    parser.add_argument('--node-id',
+                        help="name of this server in the cluster (default: host name and process id)")
+    parser.add_argument('--cluster-url',
+                        help="URL other nodes send /snapshot and /preview clients to (default: http://<host>:<port>)")
+    parser.add_argument('--cluster-capacity', type=float, default=1.0,
+                        help="share of the cluster's cameras this node takes relative to the others")
+    parser.add_argument('--cluster-lease', type=float, default=15.0,
+                        help="seconds a camera's lease lasts, the cameras of a node that died move within it")
+    parser.add_argument('--upload-url', default=UPLOAD_URL,
+                        help="endpoint that receives the face crops")
+    parser.add_argument('--upload-workers', type=int, default=4,
+                        help="number of concurrent uploads to the detection API")
+    parser.add_argument('--upload-queue-size', type=int, default=256,
+                        help="uploads kept waiting before the oldest one is dropped")
+    parser.add_argument('--batch-uploads', action='store_true',
+                        help="send all faces found in one frame in a single request")
+    parser.add_argument('--spool-path',
+                        help="SQLite file to spool uploads to before sending, keeps them through outages and restarts")
+    parser.add_argument('--spool-max-mb', type=float, default=512,
+                        help="spool size cap, the oldest uploads are evicted beyond it")
+    parser.add_argument('--spool-max-age', type=float, default=24,
+                        help="hours an upload may wait in the spool before it is evicted")
+    parser.add_argument('--spool-bulk-size', type=int, default=50,
+                        help="uploads each worker takes from the spool at a time")
+    args = parser.parse_args()
+    if args.processes > 1 and args.detection_processes:
+        parser.error("--detection-processes cannot be combined with --processes")
+    return args
+
+def configure_detectors(args):
+    global DEFAULT_DETECTOR
+    DEFAULT_DETECTOR = args.detector
+    ssd = {"confidence": args.ssd_confidence, "max_batch": args.detector_batch}
+    if args.ssd_config:
+        ssd["config"] = args.ssd_config
+    if args.ssd_weights:
+        ssd["weights"] = args.ssd_weights
+    detector_settings['ssd'] = ssd
+    # Fail at startup rather than on the first frame
+    get_detector(DEFAULT_DETECTOR)
+
+def start_pipeline(args, slot=None):
+    """Build the detection, upload and stream stages of this process from the command line options."""
+    global DEFAULT_DETECTION_WIDTH, DEFAULT_CAPTURE_BACKEND, DEFAULT_CONNECT_TIMEOUT, DEFAULT_MIN_SAMPLE_FPS, \
+        DEFAULT_MAX_SAMPLE_FPS, CONNECT_STAGGER, PREVIEW_FPS, CAMERAS_DB, detection_engine, uploader, stream_registry, \
+        detector_pool, sampling_scheduler, duplicate_cache, preview_cache, tracer
+    DEFAULT_DETECTION_WIDTH = args.detection_width
+    DEFAULT_CAPTURE_BACKEND = args.capture_backend
+    DEFAULT_CONNECT_TIMEOUT = args.connect_timeout
+    DEFAULT_MIN_SAMPLE_FPS = args.min_sample_fps
+    DEFAULT_MAX_SAMPLE_FPS = args.max_sample_fps
+    CONNECT_STAGGER = args.connect_stagger
+    PREVIEW_FPS = args.preview_fps
+    CAMERAS_DB = args.cameras_db
+    configure_detectors(args)
+    detection_workers = args.detection_workers or max(1, (os.cpu_count() or 1) // args.processes)
+    if detection_workers > 1 and args.detector == 'haar':
+        # The pool already keeps every core busy, nested OpenCV threads only add contention.
+        # The batched dnn detector runs on one thread and needs OpenCV's threads.
+        cv2.setNumThreads(1)
+    if args.detection_processes:
+        detector_pool = DetectorPool(args.detection_processes, run_detector, (args,))
+        detector_pool.start()
+    if args.dedup_ttl > 0:
+        duplicate_cache = DuplicateCache(args.dedup_distance, args.dedup_ttl, args.dedup_max_entries)
+    preview_cache = PreviewCache(args.preview_width, args.preview_quality)
+    tracer = Tracer(args.trace_sample_rate, args.trace_spans)
+    detection_engine = DetectionEngine(analyze_frame, workers=detection_workers, queue_depth=args.queue_depth)
+    detection_engine.start()
+    spool = None
+    if args.spool_path:
+        # Every worker process drains a spool file of its own
+        spool_path = args.spool_path if slot is None else f"{args.spool_path}.{slot}"
+        spool = UploadSpool(spool_path, max_bytes=int(args.spool_max_mb * 2**20),
+                            max_age=args.spool_max_age * 3600)
+    uploader = Uploader(args.upload_url, workers=args.upload_workers,
+                        queue_size=args.upload_queue_size, batch=args.batch_uploads,
+                        spool=spool, bulk_size=args.spool_bulk_size)
+    uploader.start()
+    stream_registry = StreamRegistry(process_stream, StreamContext,
+                                     initial_backoff=args.reconnect_initial_backoff,
+                                     max_backoff=args.reconnect_max_backoff)
+    # Workers split the frame budget, the CPU budget is a share of the machine either way
+    sampling_scheduler = SamplingScheduler(stream_registry.streams, budget_fps=args.sample_budget_fps / args.processes,
+                                           cpu_budget=args.cpu_budget / args.processes)
+    sampling_scheduler.start()
+
+def run_detector(args, jobs, replies):
+    # Entry point of a detector process in --detection-processes mode
+    configure_detectors(args)
+    if args.detector == 'haar':
+        cv2.setNumThreads(1)
+    serve_detection(detect_faces, jobs, replies)
+
+def run_worker(slot, args, commands, replies):
+    # Entry point of a worker process in --processes mode, the parent routes commands here
+    start_pipeline(args, slot)
+    serve_commands({
+        'start': stream_registry.start,
+        'stop': lambda device_id: stream_registry.stop(device_id, wait=False),
+        'release': lambda device_id: stream_registry.remove(device_id, wait=False),
+        'streams': stream_registry.snapshot,
+        'stream_stats': local_stream_stats,
+        'metrics': metrics.REGISTRY.render,
+        'preview': latest_preview,
+        'trace': lambda seconds, device_id: tracer.export(seconds, device_id),
+        'trace_sample_rate': set_trace_sample_rate,
+    }, commands, replies)
 
 if __name__ == "__main__":
-    listener_thread = threading.Thread(target=camera_listener)
-    listener_thread.start()
-    app.run(host='0.0.0.0', port=5000)
+    args = parse_args()
+    if args.processes > 1:
+        # Capture and detection run in worker processes, this one only serves the control endpoints
+        DEFAULT_DETECTION_WIDTH = args.detection_width
+        DEFAULT_CAPTURE_BACKEND = args.capture_backend
+        DEFAULT_CONNECT_TIMEOUT = args.connect_timeout
+        DEFAULT_MIN_SAMPLE_FPS = args.min_sample_fps
+        DEFAULT_MAX_SAMPLE_FPS = args.max_sample_fps
+        CONNECT_STAGGER = args.connect_stagger
+        PREVIEW_FPS = args.preview_fps
+        CAMERAS_DB = args.cameras_db
+        configure_detectors(args)
+        # A worker answers one command at a time, keep its reply timeout well above a connect
+        supervisor = Supervisor(args.processes, run_worker, args, reply_timeout=args.connect_timeout + 10.0)
+        supervisor.start_workers()
+        stream_registry = supervisor
+    else:
+        start_pipeline(args)
+
+    if args.cluster_db:
+        # Control endpoints of every node put cameras into the shared store, the leases decide who runs them
+        cluster = ClusterNode(LeaseStore(args.cluster_db), stream_registry, args.node_id,
+                              args.cluster_url or f"http://{socket.gethostname()}:{args.port}",
+                              args.cluster_capacity, args.cluster_lease)
+        cluster.start_node()
+        stream_registry = cluster
+
+    if args.resume:
+        threading.Thread(target=resume_cameras, args=(args.cameras_db, args.connect_stagger, args.resume_report_timeout),
+                         name="resume", daemon=True).start()
+
+    try:
+        app.run(host='0.0.0.0', port=args.port)
+    finally:
+        if cluster:
+            # Hand the cameras over now instead of after the leases run out
+            cluster.leave()
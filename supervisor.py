@@ -0,0 +1,257 @@
+import hashlib
+import itertools
+import logging
+import multiprocessing
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def owner_of(device_id, slots):
+    """Pick the slot a camera belongs to with rendezvous hashing.
+
+    The choice only depends on the device_id and the set of live slots, so
+    it is stable across restarts, and when a slot leaves or joins only the
+    cameras that hash to that slot move.
+    """
+    return max(slots, key=lambda slot: hashlib.sha1(f"{device_id}:{slot}".encode()).digest())
+
+
+class WorkerProcess:
+    def __init__(self, slot, context, target, args):
+        self.slot = slot
+        self.commands = context.Queue()
+        self.replies = context.Queue()
+        self.process = context.Process(target=target, args=(slot, args, self.commands, self.replies),
+                                       name=f"pipeline-worker-{slot}", daemon=True)
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        # Cameras this particular process has been asked to run
+        self.cameras = set()
+        self.process.start()
+
+    def is_alive(self):
+        return self.process.is_alive()
+
+
+class Supervisor:
+    """Shards cameras over worker processes so capture and detection escape the GIL.
+
+    Each worker runs its own pipeline and answers `(request_id, command,
+    args)` messages, see `serve_commands`. The supervisor keeps the desired
+    set of cameras, places each one with `owner_of` over the live workers,
+    respawns dead workers and moves cameras whenever the set of live workers
+    changes. It offers the same start/stop/snapshot calls as
+    `registry.StreamRegistry`, so the control endpoints can use either.
+    """
+
+    def __init__(self, processes, target, args, reply_timeout=10.0, respawn_delay=1.0):
+        self.processes = processes
+        self.target = target
+        self.args = args
+        self.reply_timeout = reply_timeout
+        self.respawn_delay = respawn_delay
+
+        # Spawn, forking a process that already runs threads and OpenCV is not safe
+        self._context = multiprocessing.get_context('spawn')
+        self._lock = threading.RLock()
+        self._cameras = {}
+        self._assignment = {}
+        self._workers = {}
+        self._request_ids = itertools.count()
+        self._stopping = threading.Event()
+        self._monitor = None
+
+    def start_workers(self):
+        for slot in range(self.processes):
+            self._workers[slot] = WorkerProcess(slot, self._context, self.target, self.args)
+        self._monitor = threading.Thread(target=self._watch, name="supervisor", daemon=True)
+        self._monitor.start()
+
+    def shutdown(self):
+        self._stopping.set()
+        for worker in self._workers.values():
+            worker.process.terminate()
+        for worker in self._workers.values():
+            worker.process.join()
+
+    def live_slots(self):
+        return sorted(slot for slot, worker in self._workers.items() if worker.is_alive())
+
+    def start(self, rtsp_url, device_id, event_id, options):
+        with self._lock:
+            self._cameras[device_id] = (rtsp_url, event_id, options)
+            slots = self.live_slots()
+            if not slots:
+                raise RuntimeError("No pipeline worker is running")
+            slot = owner_of(device_id, slots)
+            previous = self._assignment.get(device_id)
+            if previous is not None and previous != slot and previous in slots:
+                self._stop_on(previous, device_id, release=True)
+            self._assignment[device_id] = slot
+        return self._start_on(slot, rtsp_url, device_id, event_id, options)
+
+    def stop(self, device_id):
+        with self._lock:
+            self._cameras.pop(device_id, None)
+            slot = self._assignment.pop(device_id, None)
+        if slot is None:
+            return False
+        return self._stop_on(slot, device_id)
+
+    def remove(self, device_id, wait=False):
+        """Stop a camera and have its worker forget it, workers never wait for the stream to end."""
+        with self._lock:
+            self._cameras.pop(device_id, None)
+            slot = self._assignment.pop(device_id, None)
+        if slot is None:
+            return False
+        return self._stop_on(slot, device_id, release=True)
+
+    def stop_all(self):
+        for device_id in list(self._cameras):
+            self.stop(device_id)
+
+    def configuration(self, device_id):
+        with self._lock:
+            return self._cameras.get(device_id)
+
+    def snapshot(self):
+        streams = []
+        for slot, result in self._gather('streams'):
+            for stream in result:
+                streams.append(dict(stream, worker=slot))
+        return streams
+
+    def stream_stats(self):
+        stats = {"streams": {}, "uploads": {}, "duplicates": {}, "previews": {}}
+        for slot, result in self._gather('stream_stats'):
+            stats["streams"].update(result["streams"])
+            stats["uploads"][slot] = result["uploads"]
+            stats["duplicates"][slot] = result.get("duplicates")
+            stats["previews"][slot] = result.get("previews")
+        return stats
+
+    def call_owner(self, device_id, command, *args):
+        """Run `command` on the worker that runs `device_id`, raises KeyError for unknown cameras."""
+        with self._lock:
+            slot = self._assignment.get(device_id)
+        if slot is None:
+            raise KeyError(device_id)
+        return self._call(slot, command, *args)
+
+    def metrics(self):
+        return [(slot, text) for slot, text in self._gather('metrics')]
+
+    def trace(self, seconds, device_id=None):
+        events = []
+        for slot, result in self._gather('trace', seconds, device_id):
+            events.extend(result)
+        return events
+
+    def set_trace_sample_rate(self, sample_rate):
+        # Workers respawned later start from the command line rate again
+        self._gather('trace_sample_rate', sample_rate)
+
+    def workers(self):
+        return [{"worker": slot, "pid": worker.process.pid, "alive": worker.is_alive(),
+                 "started_at": worker.started_at,
+                 "cameras": sorted(d for d, s in self._assignment.items() if s == slot)}
+                for slot, worker in sorted(self._workers.items())]
+
+    def _start_on(self, slot, rtsp_url, device_id, event_id, options):
+        worker = self._workers[slot]
+        started = self._call(slot, 'start', rtsp_url, device_id, event_id, options)
+        worker.cameras.add(device_id)
+        return started
+
+    def _stop_on(self, slot, device_id, release=False):
+        # A released camera is forgotten by the worker instead of being listed as stopped
+        worker = self._workers[slot]
+        worker.cameras.discard(device_id)
+        return self._call(slot, 'release' if release else 'stop', device_id)
+
+    def _gather(self, command, *args):
+        results = []
+        for slot in self.live_slots():
+            try:
+                results.append((slot, self._call(slot, command, *args)))
+            except RuntimeError as err:
+                logger.warning("Worker %s did not answer %s: %s", slot, command, err)
+        return results
+
+    def _call(self, slot, command, *args):
+        worker = self._workers[slot]
+        with worker.lock:
+            request_id = next(self._request_ids)
+            worker.commands.put((request_id, command, args))
+            deadline = time.monotonic() + self.reply_timeout
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not worker.is_alive():
+                    raise RuntimeError(f"Worker {slot} did not answer {command}")
+                try:
+                    reply_id, ok, result = worker.replies.get(timeout=min(remaining, 1.0))
+                except queue.Empty:
+                    continue
+                # Replies to requests that timed out earlier are skipped
+                if reply_id == request_id:
+                    if not ok:
+                        raise RuntimeError(result)
+                    return result
+
+    def _watch(self):
+        while not self._stopping.wait(1.0):
+            dead = [slot for slot, worker in self._workers.items() if not worker.is_alive()]
+            if not dead:
+                continue
+            for slot in dead:
+                logger.warning("Pipeline worker %s exited with code %s", slot, self._workers[slot].process.exitcode)
+            # Move the cameras off the dead workers right away, then bring the workers back
+            self._rebalance()
+            time.sleep(self.respawn_delay)
+            for slot in dead:
+                if self._stopping.is_set():
+                    return
+                self._workers[slot] = WorkerProcess(slot, self._context, self.target, self.args)
+            self._rebalance()
+
+    def _rebalance(self):
+        with self._lock:
+            slots = self.live_slots()
+            if not slots:
+                return
+            moves = []
+            for device_id, (rtsp_url, event_id, options) in self._cameras.items():
+                slot = owner_of(device_id, slots)
+                previous = self._assignment.get(device_id)
+                if previous == slot and device_id in self._workers[slot].cameras:
+                    continue
+                moves.append((device_id, previous, slot, rtsp_url, event_id, options))
+                self._assignment[device_id] = slot
+
+            for device_id, previous, slot, rtsp_url, event_id, options in moves:
+                try:
+                    if previous is not None and previous != slot and previous in slots:
+                        self._stop_on(previous, device_id, release=True)
+                    self._start_on(slot, rtsp_url, device_id, event_id, options)
+                except RuntimeError as err:
+                    logger.warning("Moving device %s to worker %s failed: %s", device_id, slot, err)
+            if moves:
+                logger.warning("Rebalanced %d cameras over workers %s", len(moves), slots)
+
+
+def serve_commands(handlers, commands, replies):
+    """Worker side: answer supervisor requests with `handlers[command](*args)` until the queue closes."""
+    while True:
+        try:
+            request_id, command, args = commands.get()
+        except (EOFError, OSError):
+            return
+        try:
+            replies.put((request_id, True, handlers[command](*args)))
+        except Exception as err:
+            logger.exception("Command %s failed", command)
+            replies.put((request_id, False, str(err)))
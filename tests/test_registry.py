@@ -0,0 +1,172 @@
+import threading
+import time
+
+import pytest
+
+import registry
+from registry import BACKOFF, RUNNING, STOPPED, ManagedStream, StreamRegistry
+
+
+class FakeCapture:
+    def __init__(self):
+        self.stopped = threading.Event()
+
+    def stop(self):
+        self.stopped.set()
+
+
+class BackoffEvent(threading.Event):
+    """A wake event that records the backoffs waited out on it instead of sleeping through them."""
+
+    def __init__(self):
+        super().__init__()
+        self.delays = []
+
+    def wait(self, timeout=None):
+        if timeout is not None:
+            self.delays.append(timeout)
+        return super().wait(0)
+
+
+class RecordingStream(ManagedStream):
+    restart_options = ('read_timeout',)
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self._wake = BackoffEvent()
+        self.delays = self._wake.delays
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("Timed out")
+        time.sleep(0.01)
+
+
+def run_until_stopped(runs):
+    def run_stream(stream):
+        runs.append((stream.rtsp_url, dict(stream.options)))
+        capture = stream.capture = FakeCapture()
+        stream.set_state(RUNNING)
+        capture.stopped.wait()
+    return run_stream
+
+
+def test_start_keeps_one_pipeline_per_device():
+    runs = []
+    streams = StreamRegistry(run_until_stopped(runs))
+    assert streams.start('rtsp://a', 'cam', 'event', {})
+    wait_for(lambda: streams.get('cam').state == RUNNING)
+    assert not streams.start('rtsp://a', 'cam', 'event', {})
+    assert len(runs) == 1
+    assert [stream['device_id'] for stream in streams.snapshot()] == ['cam']
+    streams.stop('cam')
+    assert streams.get('cam').state == STOPPED
+    assert streams.configuration('cam') is None
+
+
+def test_changed_configuration_restarts_only_when_needed():
+    runs = []
+    streams = StreamRegistry(run_until_stopped(runs), stream_factory=RecordingStream)
+    streams.start('rtsp://a', 'cam', 'event', {'read_timeout': 5, 'jpeg_quality': 90})
+    wait_for(lambda: len(runs) == 1)
+
+    # Not a restart option, applied in place
+    assert not streams.start('rtsp://a', 'cam', 'event', {'read_timeout': 5, 'jpeg_quality': 60})
+    assert streams.get('cam').options['jpeg_quality'] == 60
+    time.sleep(0.1)
+    assert len(runs) == 1
+
+    assert not streams.start('rtsp://a', 'cam', 'event', {'read_timeout': 7, 'jpeg_quality': 60})
+    wait_for(lambda: len(runs) == 2)
+    assert runs[1][1]['read_timeout'] == 7
+    # A requested restart reconnects without backing off
+    assert streams.get('cam').delays == [0]
+    streams.stop('cam')
+
+
+def test_backoff_grows_and_starts_over_after_running(monkeypatch):
+    monkeypatch.setattr(registry.random, 'uniform', lambda low, high: high)
+    outcomes = iter(['fail', 'fail', 'fail', 'run', 'fail'])
+    done = threading.Event()
+
+    def run_stream(stream):
+        outcome = next(outcomes, None)
+        if outcome is None:
+            done.set()
+            stream._stop.set()
+        elif outcome == 'run':
+            stream.set_state(RUNNING)
+        else:
+            raise ConnectionError("unreachable")
+
+    streams = StreamRegistry(run_stream, stream_factory=RecordingStream, initial_backoff=1.0, max_backoff=3.0)
+    streams.start('rtsp://a', 'cam', 'event', {})
+    assert done.wait(5)
+    wait_for(lambda: streams.get('cam').state == STOPPED)
+    stream = streams.get('cam')
+    assert stream.delays == [1.0, 2.0, 3.0, 1.0, 2.0]
+    assert stream.reconnects == 5
+    assert stream.last_error == "unreachable"
+
+
+def test_start_does_not_wait_for_a_stopping_pipeline():
+    connecting = threading.Event()
+    release = threading.Event()
+    runs = []
+
+    def run_stream(stream):
+        runs.append(stream.rtsp_url)
+        if len(runs) == 1:
+            # Stuck connecting, deaf to stop like a blocking open
+            connecting.set()
+            release.wait(5)
+            return
+        run_until_stopped([])(stream)
+
+    streams = StreamRegistry(run_stream)
+    streams.start('rtsp://old', 'cam', 'event', {})
+    assert connecting.wait(5)
+    streams.stop('cam', wait=False)
+
+    started = time.monotonic()
+    assert streams.start('rtsp://new', 'cam', 'event', {})
+    assert streams.snapshot()
+    assert time.monotonic() - started < 1.0
+
+    release.set()
+    wait_for(lambda: streams.get('cam').state == RUNNING)
+    assert runs == ['rtsp://old', 'rtsp://new']
+    streams.stop('cam')
+    assert streams.get('cam').state == STOPPED
+
+
+def test_stop_cancels_a_start_waiting_for_the_old_pipeline():
+    release = threading.Event()
+    runs = []
+
+    def run_stream(stream):
+        runs.append(stream.rtsp_url)
+        release.wait()
+
+    streams = StreamRegistry(run_stream)
+    streams.start('rtsp://a', 'cam', 'event', {})
+    wait_for(lambda: runs)
+    streams.stop('cam', wait=False)
+    streams.start('rtsp://b', 'cam', 'event', {})
+    streams.stop('cam', wait=False)
+    release.set()
+    wait_for(lambda: streams.get('cam').state == STOPPED)
+    assert runs == ['rtsp://a']
+
+
+@pytest.mark.parametrize('wait', [True, False])
+def test_remove_forgets_the_camera(wait):
+    streams = StreamRegistry(run_until_stopped([]))
+    streams.start('rtsp://a', 'cam', 'event', {})
+    wait_for(lambda: streams.get('cam').state == RUNNING)
+    assert streams.remove('cam', wait=wait)
+    assert streams.get('cam') is None
+    assert not streams.stop('cam')
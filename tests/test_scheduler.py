@@ -0,0 +1,64 @@
+import types
+
+import pytest
+
+from scheduler import SamplingScheduler, fair_shares
+
+
+def camera(device_id, low=1.0, high=10.0):
+    return types.SimpleNamespace(device_id=device_id, options={'min_sample_fps': low, 'max_sample_fps': high},
+                                 capture=types.SimpleNamespace(sample_interval=None))
+
+
+def rates(scheduler, streams):
+    scheduler.rebalance()
+    return {stream.device_id: pytest.approx(1.0 / stream.capture.sample_interval) for stream in streams}
+
+
+def test_fair_shares_never_give_more_than_asked():
+    assert fair_shares({'a': 1, 'b': 2}, 10) == {'a': 1, 'b': 2}
+
+
+def test_fair_shares_split_what_is_left_equally():
+    shares = fair_shares({'a': 1, 'b': 6, 'c': 9}, 10)
+    assert shares == {'a': 1, 'b': pytest.approx(4.5), 'c': pytest.approx(4.5)}
+    assert sum(shares.values()) == pytest.approx(10)
+
+
+def test_quiet_cameras_sample_at_their_minimum_without_a_budget():
+    streams = [camera('a', 1, 10), camera('b', 2, 4)]
+    scheduler = SamplingScheduler(lambda: streams)
+    assert rates(scheduler, streams) == {'a': 1.0, 'b': 2.0}
+
+
+def test_activity_raises_the_rate_up_to_the_maximum():
+    streams = [camera('a', 1, 10), camera('b', 1, 10)]
+    scheduler = SamplingScheduler(lambda: streams)
+    scheduler.record('a', motion=True, faces=3)
+    scheduler.record('b', motion=True, faces=0)
+    # Faces count fully, motion alone half
+    assert rates(scheduler, streams) == {'a': 10.0, 'b': 5.5}
+
+
+def test_budget_keeps_minimums_and_shares_the_rest_fairly():
+    streams = [camera('busy', 1, 10), camera('also_busy', 1, 10), camera('quiet', 1, 10)]
+    scheduler = SamplingScheduler(lambda: streams, budget_fps=9)
+    scheduler.record('busy', motion=False, faces=1)
+    scheduler.record('also_busy', motion=False, faces=1)
+    assert rates(scheduler, streams) == {'busy': 4.0, 'also_busy': 4.0, 'quiet': 1.0}
+
+
+def test_minimums_shrink_alike_when_they_do_not_fit():
+    streams = [camera('a', 2, 10), camera('b', 4, 10)]
+    scheduler = SamplingScheduler(lambda: streams, budget_fps=3)
+    assert rates(scheduler, streams) == {'a': 1.0, 'b': 2.0}
+
+
+def test_cameras_without_a_capture_are_left_out():
+    streams = [camera('a'), camera('connecting')]
+    streams[1].capture = None
+    scheduler = SamplingScheduler(lambda: streams)
+    scheduler.rebalance()
+    assert set(scheduler.stats()) == {'a'}
+    # A camera the scheduler has not placed yet samples as fast as it may
+    assert scheduler.rate(streams[1]) == 10.0
@@ -0,0 +1,132 @@
+import sqlite3
+import threading
+import time
+
+import pytest
+
+import uploader
+from spool import UploadSpool
+
+
+def request(device_id='cam', size=10, captured_at=None):
+    return device_id, {"eventId": "event"}, [(f'{device_id}.jpg', b'x' * size, {"trackId": 1})], captured_at
+
+
+@pytest.fixture
+def spool(tmp_path):
+    spool = UploadSpool(str(tmp_path / 'spool.db'))
+    yield spool
+    spool.close()
+
+
+def test_claimed_rows_come_back_whole_and_stay_hidden_until_acked(spool):
+    ids = spool.put([request('a', captured_at=123.0), request('b')])
+    entries = spool.claim(10)
+    assert [entry.id for entry in entries] == ids
+    assert entries[0].device_id == 'a'
+    assert entries[0].data == {"eventId": "event"}
+    assert entries[0].images == [('a.jpg', b'x' * 10, {"trackId": 1})]
+    assert entries[0].captured_at == 123.0
+    assert entries[1].captured_at is None
+    assert spool.claim(10) == []
+
+    spool.ack(ids)
+    assert spool.depth() == (0, 0)
+
+
+def test_claim_takes_the_oldest_first(spool):
+    ids = spool.put([request(str(i)) for i in range(5)])
+    assert [entry.id for entry in spool.claim(2)] == ids[:2]
+    assert [entry.id for entry in spool.claim(10)] == ids[2:]
+
+
+def test_retry_waits_out_the_delay_and_counts_attempts(spool):
+    ids = spool.put([request('a'), request('b')])
+    spool.claim(10)
+    spool.retry([ids[0]], 0)
+    spool.retry([ids[1]], 3600)
+    entries = spool.claim(10)
+    assert [(entry.id, entry.attempts) for entry in entries] == [(ids[0], 1)]
+
+
+def test_release_hands_rows_back_untouched(spool):
+    ids = spool.put([request()])
+    spool.claim(10)
+    spool.release(ids)
+    assert [(entry.id, entry.attempts) for entry in spool.claim(10)] == [(ids[0], 0)]
+
+
+def test_rows_claimed_by_a_previous_run_are_sent_again(tmp_path):
+    path = str(tmp_path / 'spool.db')
+    spool = UploadSpool(path)
+    ids = spool.put([request()])
+    spool.claim(10)
+    spool.close()
+
+    spool = UploadSpool(path)
+    assert [entry.id for entry in spool.claim(10)] == ids
+    assert spool.depth() == (1, 10)
+    spool.close()
+
+
+def test_row_cap_evicts_the_oldest(tmp_path):
+    spool = UploadSpool(str(tmp_path / 'spool.db'), max_rows=3)
+    ids = spool.put([request(str(i)) for i in range(5)])
+    assert spool.depth() == (3, 30)
+    assert spool.evicted == 2
+    assert [entry.id for entry in spool.claim(10)] == ids[2:]
+    spool.close()
+
+
+def test_byte_cap_evicts_the_oldest(tmp_path):
+    spool = UploadSpool(str(tmp_path / 'spool.db'), max_bytes=25)
+    ids = spool.put([request('a')])
+    ids += spool.put([request('b')])
+    ids += spool.put([request('c')])
+    assert spool.depth() == (2, 20)
+    assert [entry.id for entry in spool.claim(10)] == ids[1:]
+    spool.close()
+
+
+def test_expired_rows_are_evicted_at_most_once_per_interval(tmp_path):
+    spool = UploadSpool(str(tmp_path / 'spool.db'), max_age=0, expiry_interval=3600)
+    spool.put([request()])
+    time.sleep(0.01)
+    spool.evict_expired()
+    assert spool.depth() == (0, 0)
+    assert spool.evicted == 1
+
+    spool.put([request()])
+    time.sleep(0.01)
+    spool.evict_expired()
+    assert spool.depth() == (1, 10)
+    spool.close()
+
+
+def test_drainer_survives_spool_errors(spool, monkeypatch):
+    monkeypatch.setattr(uploader, 'SPOOL_ERROR_DELAY', 0.01)
+    claim = spool.claim
+    failures = []
+    posted = threading.Event()
+
+    def failing_claim(limit):
+        if len(failures) < 2:
+            failures.append(limit)
+            raise sqlite3.OperationalError("disk I/O error")
+        return claim(limit)
+
+    monkeypatch.setattr(spool, 'claim', failing_claim)
+    uploads = uploader.Uploader('http://upstream.invalid/', workers=1, spool=spool)
+
+    def post(device_id, data, images):
+        posted.set()
+        return 'sent'
+
+    monkeypatch.setattr(uploads, '_post', post)
+    spool.put([request()])
+    uploads.start()
+    try:
+        assert posted.wait(5)
+    finally:
+        uploads.stop()
+    assert len(failures) == 2
@@ -0,0 +1,122 @@
+import collections
+import itertools
+import os
+import random
+import threading
+import time
+import zlib
+
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NO_SPAN = _NoSpan()
+
+
+class _Span:
+    __slots__ = ('trace', 'name', 'args', 'start')
+
+    def __init__(self, trace, name, args):
+        self.trace = trace
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        self.trace.add(self.name, self.start, time.monotonic(), **self.args)
+        return False
+
+
+class FrameTrace:
+    """Spans of one sampled frame, written straight into its camera's ring.
+
+    `queued_at` is set by a stage that hands the frame to a queue, so the
+    next stage can record how long it waited.
+    """
+
+    __slots__ = ('ring', 'frame', 'queued_at')
+
+    def __init__(self, ring, frame):
+        self.ring = ring
+        self.frame = frame
+        self.queued_at = None
+
+    def add(self, name, start, end, **args):
+        self.ring.append((name, start, end - start, threading.get_ident(), self.frame, args))
+
+    def waited(self, name):
+        if self.queued_at is not None:
+            self.add(name, self.queued_at, time.monotonic())
+
+
+def span(trace, name, **args):
+    """Time a block as a span of `trace`. Frames that are not traced pass None and get a shared no-op."""
+    if trace is None:
+        return NO_SPAN
+    return _Span(trace, name, args)
+
+
+class Tracer:
+    """Flight recorder of per-stage timings for a sample of frames.
+
+    `start_frame` picks `sample_rate` of the frames, and the stages record
+    spans for those as they pass. Each camera keeps its last
+    `spans_per_camera` spans in a ring, so memory stays fixed however long
+    it runs. With `sample_rate` 0 nothing is recorded and a frame costs one
+    comparison. Timestamps are `time.monotonic()`, shared by all processes
+    of the machine, so traces from worker processes line up.
+    """
+
+    def __init__(self, sample_rate=0.0, spans_per_camera=4096):
+        self.sample_rate = sample_rate
+        self.spans_per_camera = spans_per_camera
+
+        self._lock = threading.Lock()
+        self._rings = {}
+        self._frames = itertools.count(1)
+
+    def start_frame(self, device_id):
+        """A FrameTrace if this frame is picked for tracing, otherwise None."""
+        if not self.sample_rate or random.random() >= self.sample_rate:
+            return None
+        ring = self._rings.get(device_id)
+        if ring is None:
+            with self._lock:
+                ring = self._rings.setdefault(device_id, collections.deque(maxlen=self.spans_per_camera))
+        return FrameTrace(ring, next(self._frames))
+
+    def export(self, seconds=None, device_id=None):
+        """Chrome trace events of the spans that ended in the last `seconds`, one track per camera."""
+        since = time.monotonic() - seconds if seconds else float('-inf')
+        threads = {thread.ident: thread.name for thread in threading.enumerate()}
+        with self._lock:
+            rings = [(camera, list(ring)) for camera, ring in self._rings.items()
+                     if device_id is None or camera == device_id]
+
+        events = []
+        for camera, spans in rings:
+            # A stable id, so the same camera gets the same track in every process
+            pid = zlib.crc32(camera.encode()) & 0x7fffffff
+            events.append({"name": "process_name", "ph": "M", "pid": pid, "args": {"name": f"camera {camera}"}})
+            seen_threads = set()
+            for name, start, duration, tid, frame, args in spans:
+                if start + duration < since:
+                    continue
+                if tid not in seen_threads:
+                    seen_threads.add(tid)
+                    events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid,
+                                   "args": {"name": f"{threads.get(tid, tid)} ({os.getpid()})"}})
+                events.append({"name": name, "cat": "pipeline", "ph": "X", "pid": pid, "tid": tid,
+                               "ts": round(start * 1e6, 1), "dur": round(duration * 1e6, 1),
+                               "args": dict(args, frame=frame, camera=camera)})
+        return events
@@ -0,0 +1,118 @@
+import uuid
+
+import cv2
+
+
+def iou(a, b):
+    ax, ay, aw, ah = a
+    bx, by, bw, bh = b
+    w = min(ax + aw, bx + bw) - max(ax, bx)
+    h = min(ay + ah, by + bh) - max(ay, by)
+    if w <= 0 or h <= 0:
+        return 0.0
+    inter = w * h
+    return inter / (aw * ah + bw * bh - inter)
+
+
+def crop_score(crop):
+    # Sharpness of a normalised copy, weighted by size so a close-up beats a tiny sharp face
+    gray = cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY) if crop.ndim == 3 else crop
+    sharpness = cv2.Laplacian(cv2.resize(gray, (64, 64), interpolation=cv2.INTER_AREA), cv2.CV_64F).var()
+    return sharpness * (crop.shape[0] * crop.shape[1]) ** 0.5
+
+
+class Track:
+    __slots__ = ('track_id', 'box', 'last_seen', 'last_upload', 'best_crop', 'best_score')
+
+    def __init__(self, box, now):
+        self.track_id = uuid.uuid4().hex
+        self.box = box
+        self.last_seen = now
+        self.last_upload = now
+        self.best_crop = None
+        self.best_score = 0.0
+
+
+class FaceTracker:
+    """Follows faces across samples of one camera so each person is uploaded sparingly.
+
+    Boxes are matched to existing tracks greedily by IoU, falling back to
+    centroid distance because people can move a long way between samples.
+    A new track is uploaded straight away. After that, the best crop seen
+    since the last upload is sent every `refresh_interval` seconds (never if
+    0). Tracks not seen for `max_age` seconds are forgotten.
+    """
+
+    def __init__(self, refresh_interval=30.0, max_age=10.0, iou_threshold=0.3, centroid_factor=0.75):
+        self.refresh_interval = refresh_interval
+        self.max_age = max_age
+        self.iou_threshold = iou_threshold
+        self.centroid_factor = centroid_factor
+        self.tracks = []
+        self.crops_uploaded = 0
+        self.crops_suppressed = 0
+
+    def update(self, frame, boxes, now):
+        """Feed the faces found in one frame, returns the `(track_id, crop)` pairs to upload."""
+        self.tracks = [track for track in self.tracks if now - track.last_seen <= self.max_age]
+        matches = self._match(boxes)
+
+        uploads = []
+        for index, box in enumerate(boxes):
+            x, y, w, h = (int(v) for v in box)
+            crop = frame[y:y+h, x:x+w]
+            if crop.size == 0:
+                continue
+            track = matches.get(index)
+            if track is None:
+                track = Track((x, y, w, h), now)
+                self.tracks.append(track)
+                uploads.append((track.track_id, crop))
+                continue
+
+            track.box = (x, y, w, h)
+            track.last_seen = now
+            score = crop_score(crop)
+            # A flat crop scores 0, it still has to stand in until a better one comes along
+            if track.best_crop is None or score > track.best_score:
+                # Copy so the track does not keep the whole frame alive
+                track.best_crop = crop.copy()
+                track.best_score = score
+
+            if self.refresh_interval and now - track.last_upload >= self.refresh_interval and \
+                    track.best_crop is not None:
+                uploads.append((track.track_id, track.best_crop))
+                track.last_upload = now
+                track.best_crop = None
+                track.best_score = 0.0
+            else:
+                self.crops_suppressed += 1
+
+        self.crops_uploaded += len(uploads)
+        return uploads
+
+    def hold(self, now):
+        """Keep all tracks alive through a frame that was not analysed, e.g. a static scene."""
+        for track in self.tracks:
+            track.last_seen = now
+
+    def _match(self, boxes):
+        candidates = []
+        for index, box in enumerate(boxes):
+            bx, by, bw, bh = box
+            for track in self.tracks:
+                overlap = iou(track.box, box)
+                tx, ty, tw, th = track.box
+                distance = ((bx + bw / 2 - tx - tw / 2) ** 2 + (by + bh / 2 - ty - th / 2) ** 2) ** 0.5
+                size = (bw + bh + tw + th) / 4
+                if overlap >= self.iou_threshold or distance <= self.centroid_factor * size:
+                    candidates.append((overlap, -distance, index, track))
+
+        matches = {}
+        used = set()
+        for _, _, index, track in sorted(candidates, key=lambda c: (c[0], c[1]), reverse=True):
+            if index in matches or id(track) in used:
+                continue
+            matches[index] = track
+            used.add(id(track))
+        return matches
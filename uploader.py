@@ -0,0 +1,242 @@
+import collections
+import logging
+import queue
+import random
+import sqlite3
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+# Form fields shared by all images, plus a list of (filename, jpeg_bytes, fields) where
+# `fields` holds the form values that belong to that image alone. `captured_at` is the
+# time.monotonic() timestamp of the frame the images come from, `trace` its
+# tracing.FrameTrace if the frame is traced.
+UploadJob = collections.namedtuple('UploadJob', ['device_id', 'data', 'images', 'captured_at', 'trace'],
+                                   defaults=(None,))
+
+
+# Statuses worth retrying from the spool, anything else non-2xx is rejected for good
+RETRYABLE_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+# Traced uploads waiting in the spool, the oldest traces are dropped beyond this
+MAX_SPOOL_TRACES = 1000
+# Seconds the drainer waits after the spool itself failed, e.g. on a full disk
+SPOOL_ERROR_DELAY = 5.0
+
+
+class Uploader:
+    """Posts detection results from a bounded queue on a few worker threads.
+
+    All workers share one pooled `requests.Session`, so connections to the
+    upstream are kept alive between requests. `submit` never blocks: when
+    the queue is full the oldest pending upload is dropped to make room.
+    With `batch` set, all images of a job go out in one multipart request
+    and per-image fields are repeated in image order, otherwise each image
+    is posted on its own. `on_done(job)` is called after each job has been
+    attempted, or written to the spool.
+
+    With a `spool` (see spool.UploadSpool) jobs are written to disk first
+    and the workers drain it in bulk instead, retrying failed requests with
+    exponential backoff, so nothing is lost while the upstream is down.
+    """
+
+    def __init__(self, url, workers=4, queue_size=256, batch=False, timeout=10, on_done=None,
+                 spool=None, bulk_size=50, initial_backoff=1.0, max_backoff=300.0):
+        self.url = url
+        self.workers = workers
+        self.batch = batch
+        self.timeout = timeout
+        self.on_done = on_done
+        self.spool = spool
+        self.bulk_size = bulk_size
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._counters = collections.Counter()
+        self._threads = []
+        self._stopping = threading.Event()
+        self._spooled = threading.Event()
+        # Traces of spooled rows by row id, they only live in memory
+        self._spool_traces = {}
+
+    def start(self):
+        self._stopping.clear()
+        target = self._drain_spool if self.spool is not None else self._worker
+        for i in range(self.workers):
+            thread = threading.Thread(target=target, name=f"uploader-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stopping.set()
+        self._spooled.set()
+        if self.spool is None:
+            for _ in self._threads:
+                self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def submit(self, job):
+        if self.spool is not None:
+            # The spool outlives this process, so it keeps the capture time on the wall clock
+            captured_at = None if job.captured_at is None else time.time() - (time.monotonic() - job.captured_at)
+            with span(job.trace, 'spool_write'):
+                ids = self.spool.put([(job.device_id, data, images, captured_at)
+                                      for data, images in self._requests(job)])
+            if job.trace is not None:
+                job.trace.queued_at = time.monotonic()
+                with self._lock:
+                    for id in ids:
+                        self._spool_traces[id] = job.trace
+                    # Rows evicted before they were sent would keep their traces forever
+                    while len(self._spool_traces) > MAX_SPOOL_TRACES:
+                        del self._spool_traces[next(iter(self._spool_traces))]
+            self._spooled.set()
+            if self.on_done is not None:
+                self.on_done(job)
+            return
+
+        if job.trace is not None:
+            job.trace.queued_at = time.monotonic()
+        while True:
+            try:
+                self._queue.put_nowait(job)
+                return
+            except queue.Full:
+                try:
+                    self._queue.get_nowait()
+                except queue.Empty:
+                    continue
+                self._queue.task_done()
+                self._count("dropped")
+
+    def join(self):
+        """Block until every submitted upload has been attempted (in-memory queue only)."""
+        self._queue.join()
+
+    def _requests(self, job):
+        """Split a job into the `(data, images)` of each request it is sent as."""
+        if self.batch:
+            data = dict(job.data)
+            for _, _, fields in job.images:
+                for key, value in fields.items():
+                    data.setdefault(key, []).append(value)
+            return [(data, job.images)]
+        return [(dict(job.data, **image[2]), [image]) for image in job.images]
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                if job.trace is not None:
+                    job.trace.waited('upload_queued')
+                for data, images in self._requests(job):
+                    with span(job.trace, 'upload', images=len(images)):
+                        self._post(job.device_id, data, images)
+                if job.captured_at is not None:
+                    metrics.END_TO_END_LATENCY.labels(job.device_id).observe(time.monotonic() - job.captured_at)
+                if self.on_done is not None:
+                    self.on_done(job)
+            finally:
+                self._queue.task_done()
+
+    def _drain_spool(self):
+        failures = 0
+        while not self._stopping.is_set():
+            entries = []
+            try:
+                self.spool.evict_expired()
+                entries = self.spool.claim(self.bulk_size)
+                if not entries:
+                    self._spooled.wait(1.0)
+                    self._spooled.clear()
+                    continue
+                failures = self._send_spooled(entries, failures)
+            except sqlite3.Error:
+                # The thread has to outlive a spool error, submit keeps writing to the spool
+                logger.exception("Upload spool failed, draining again in %.0fs", SPOOL_ERROR_DELAY)
+                try:
+                    self.spool.release([entry.id for entry in entries])
+                except sqlite3.Error:
+                    pass
+                self._stopping.wait(SPOOL_ERROR_DELAY)
+
+    def _send_spooled(self, entries, failures):
+        # Post claimed entries in order, returns the number of failed passes in a row
+        done, retry = [], []
+        for index, entry in enumerate(entries):
+            if self._stopping.is_set():
+                self.spool.release([e.id for e in entries[index:]])
+                break
+            with self._lock:
+                trace = self._spool_traces.pop(entry.id, None)
+            if trace is not None:
+                trace.waited('upload_queued')
+            with span(trace, 'upload', images=len(entry.images), attempts=entry.attempts + 1):
+                outcome = self._post(entry.device_id, entry.data, entry.images)
+            if outcome == 'sent' and entry.captured_at is not None:
+                metrics.END_TO_END_LATENCY.labels(entry.device_id).observe(time.time() - entry.captured_at)
+            if outcome == 'retry':
+                # The upstream is most likely down, hand the rest back untried
+                retry.append(entry.id)
+                self.spool.release([e.id for e in entries[index + 1:]])
+                break
+            done.append(entry.id)
+
+        self.spool.ack(done)
+        if not retry:
+            return 0
+        failures += 1
+        delay = min(self.max_backoff, self.initial_backoff * 2 ** (failures - 1)) * random.uniform(0.5, 1.0)
+        self.spool.retry(retry, delay)
+        self._stopping.wait(delay)
+        return failures
+
+    def _post(self, device_id, data, images):
+        """Send one request, returns 'sent', 'retry' or 'rejected'."""
+        files = [('image', (filename, jpeg, 'image/jpeg')) for filename, jpeg, _ in images]
+        started = time.perf_counter()
+        try:
+            response = self.session.post(self.url, data=data, files=files, timeout=self.timeout)
+        except requests.exceptions.RequestException as err:
+            logger.warning("Upload for device %s failed: %s", device_id, err)
+            metrics.UPLOAD_RESPONSES.labels(device_id, 'error').inc()
+            self._count("failed")
+            return 'retry'
+        finally:
+            metrics.UPLOAD_LATENCY.labels(device_id).observe(time.perf_counter() - started)
+        metrics.UPLOAD_RESPONSES.labels(device_id, str(response.status_code)).inc()
+        if response.ok:
+            self._count("sent")
+            return 'sent'
+        logger.warning("Upload for device %s rejected with status %s", device_id, response.status_code)
+        self._count("failed")
+        return 'retry' if response.status_code in RETRYABLE_STATUSES else 'rejected'
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters, queued=self._queue.qsize())
+        if self.spool is not None:
+            stats["spooled"], stats["spooled_bytes"] = self.spool.depth()
+            stats["evicted"] = self.spool.evicted
+        return stats